@@ -12,10 +12,14 @@ Created on Fri Jul 31 10:35:56 2020
 # 6 website shows graphs and such
 import sys
 import math
+import queue
 import numpy as np
 
+#max time in seconds to wait for new stats before checking whether to stop
+IDLE_TIMEOUT = 0.5
+
 #TODO I think averages are correct, could be good to double check
-def main(out_q, buf_num ,num_cams, avgs, avg_lock, errs, ocpts, dists):
+def main(out_q, buf_num ,num_cams, avgs, avg_lock, errs, ocpts, dists, stop=None):
     # all_out = [[[None]*3]* buf_num] * num_cams
     # errs = [[None]* buf_num for _ in range(num_cams)]
     # # ocpts = [[None]* buf_num for _ in range(num_cams)]
@@ -29,47 +33,49 @@ def main(out_q, buf_num ,num_cams, avgs, avg_lock, errs, ocpts, dists):
     last = buf_num * -1
     #not sure that a is cycling through the buffers in the best way
     try:
-        while(True):
+        while stop is None or not stop.is_set():
             #location of oldest entry in mega list
             index = index % buf_num
-            if not out_q.empty():
-                # total = total+1
-                rollover = rollover + 1
-                data = out_q.get()
-                #camera number
-                i = data[0]
-               
-                #updates camera buffer at oldest index
-                errs[i].append(data[1])
-                ocpts[i].append(data[2])
-                dists[i].append(data[3])
+            try:
+                data = out_q.get(timeout=IDLE_TIMEOUT)
+            except queue.Empty:
+                continue
+            # total = total+1
+            rollover = rollover + 1
+            #camera number
+            i = data[0]
+           
+            #updates camera buffer at oldest index
+            errs[i].append(data[1])
+            ocpts[i].append(data[2])
+            dists[i].append(data[3])
 
+            
+            while len(errs[i]) > buf_num:
+                errs[i].pop(0)
+            
+            while len(ocpts[i]) > buf_num:
+                ocpts[i].pop(0)
                 
-                while len(errs[i]) > buf_num:
-                    errs[i].pop(0)
-                
-                while len(ocpts[i]) > buf_num:
-                    ocpts[i].pop(0)
-                    
-                while len(dists[i]) > buf_num:
-                    dists[i].pop(0)
-                
-                #this section just for debugging
-                # avg_lock.acquire()
-                # avgs[0] = str(dists[i])
-                # avgs[1] = str(ocpts[i])
+            while len(dists[i]) > buf_num:
+                dists[i].pop(0)
             
-                # avgs[2] = get_o_avg(ocpts, i)
-                # avgs[3] = get_e_avg(errs, i)
-                # avgs[4] = get_dist_avg(dists, i)
-              
-                # avg_lock.release()
+            #this section just for debugging
+            # avg_lock.acquire()
+            # avgs[0] = str(dists[i])
+            # avgs[1] = str(ocpts[i])
+        
+            # avgs[2] = get_o_avg(ocpts, i)
+            # avgs[3] = get_e_avg(errs, i)
+            # avgs[4] = get_dist_avg(dists, i)
+          
+            # avg_lock.release()
 
 
-                if rollover == (num_cams):
-                    rollover = 0
-                    index = index + 1
-                
+            if rollover == (num_cams):
+                rollover = 0
+                index = index + 1
+            
     except:
         avgs[0] = 'Error'
         avgs[4] =  str(sys.exc_info())
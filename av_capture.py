@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+FFmpeg capture backend through PyAV, a drop in for cv2.VideoCapture in the
+streamers (grab/retrieve/read/release).
+
+Decoding runs on FFmpeg's own thread pool, and frames are scaled down to the
+requested width as part of the colour conversion, so a 4K camera never gets
+converted to a full size BGR image. Optionally only keyframes are decoded.
+Works the same on rtsp urls and local files, on CPU only machines.
+
+Select it per camera in the transforms csv with backend=pyav, plus any of
+width=<px>, keyframes=True, threads=<n>.
+
+@author: Nikki
+"""
+
+try:
+    import av
+except ImportError:
+    av = None
+
+#FFmpeg decoder threads, 0 lets it pick from the core count
+THREADS = 0
+#same id as cv2.CAP_PROP_POS_MSEC, so callers can treat both backends alike
+CAP_PROP_POS_MSEC = 0
+#options handed to FFmpeg when opening rtsp streams, plus the socket timeout (see rtsp_options)
+RTSP_OPTIONS = {'rtsp_transport': 'tcp'}
+#microseconds an rtsp read can stall before it fails
+RTSP_TIMEOUT = 5000000
+
+
+###---------------------------------------------------------------------------
+#   Usage:
+#       cap = AVCapture(ip, width=640)
+#       ret_val, frame = cap.read()
+#       cap.release()
+#
+#   width - width in pixels frames are output at, height keeps the aspect ratio.
+#           None for the native size
+#   keyframes - only decode keyframes, the rest are dropped before decoding
+#
+#   An rtsp read that stalls for RTSP_TIMEOUT raises instead of blocking, so the
+#   streamer's reconnect loop (ip_streamer.stream_all) can bring the camera back.
+
+class AVCapture():
+
+    def __init__(self, ip, width=None, keyframes=False, threads=THREADS):
+        if av is None:
+            raise ImportError('"av" not found, install PyAV to use the pyav capture backend')
+        options = rtsp_options() if str(ip).startswith('rtsp://') else {}
+        self.container = av.open(ip, options=options)
+        self.stream = self.container.streams.video[0]
+        ctx = self.stream.codec_context
+        #frame threading decodes several frames at once, slice threading splits each frame
+        ctx.thread_type = 'AUTO'
+        ctx.thread_count = threads
+        if keyframes:
+            ctx.skip_frame = 'NONKEY'
+
+        self.native_size = (ctx.height, ctx.width)
+        if width is None or width >= ctx.width:
+            self.size = self.native_size
+        else:
+            #even sizes keep the scaler happy with subsampled chroma
+            height = int(round(ctx.height * width / ctx.width / 2)) * 2
+            self.size = (height, width)
+        self.frames = self.container.decode(self.stream)
+        self.frame = None
+
+    def isOpened(self):
+        return self.container is not None
+
+    ###-----------------------------------------------------------------------
+    #   Decodes the next frame but leaves it in its native format
+    #
+    #   returns - False at the end of the stream
+
+    def grab(self):
+        try:
+            self.frame = next(self.frames)
+        except (StopIteration, av.error.EOFError):
+            self.frame = None
+        return self.frame is not None
+
+    ###-----------------------------------------------------------------------
+    #   Converts the grabbed frame to a BGR array, scaling it on the way
+
+    def retrieve(self):
+        if self.frame is None:
+            return False, None
+        height, width = self.size
+        frame = self.frame.reformat(width=width, height=height, format='bgr24')
+        return True, frame.to_ndarray()
+
+    ###-----------------------------------------------------------------------
+    #   Only the stream position (cv2.CAP_PROP_POS_MSEC) is supported, anything else is 0
+
+    def get(self, prop):
+        if prop == CAP_PROP_POS_MSEC and self.frame is not None and self.frame.time is not None:
+            return self.frame.time * 1000
+        return 0
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        if self.container is not None:
+            self.container.close()
+            self.container = None
+
+
+###---------------------------------------------------------------------------
+#   RTSP_OPTIONS with the socket timeout under the name this FFmpeg knows it by.
+#   libavformat 59 (FFmpeg 5) dropped stimeout for timeout, while before that
+#   timeout meant how long to wait for an incoming connection in listen mode.
+
+def rtsp_options():
+    options = dict(RTSP_OPTIONS)
+    major = av.library_versions.get('libavformat', (0,))[0]
+    options['timeout' if major >= 59 else 'stimeout'] = str(RTSP_TIMEOUT)
+    return options
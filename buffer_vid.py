@@ -26,6 +26,7 @@ import datetime
 import sys
 from threading import Thread
 from queue import Queue
+import tracing
 #uncomment to verify that GPU is being used
 tf.debugging.set_log_device_placement(True)
 
@@ -96,6 +97,9 @@ def main():
             
         time.sleep(1.0)
         
+        #per stage timings, printed every tracing.REPORT_EVERY seconds and when the video ends
+        tracer = tracing.get_tracer('buffer video')
+        
         try:
 
             while not buf.empty():
@@ -108,40 +112,30 @@ def main():
                 frame_size = frame.shape[:2]
                 
                 #resize image and add another dimension
-                cur_frame = np.copy(frame)
-                
-                image_data = utils.image_preprocess(cur_frame, [INPUT_SIZE, INPUT_SIZE]) 
-                image_data = image_data[np.newaxis, ...].astype(np.float32)
-                
-                prev_time = time.time()
-                
-                with tf.device('/GPU:0'):
-                    image_data = tf.convert_to_tensor(image_data)
-                    print(image_data.device)
+                with tracer.stage('preprocess'):
+                    cur_frame = np.copy(frame)
                     
-                curr_time = time.time()
-                exec_time = curr_time - prev_time
-                info = "time1: %.2f ms" %(1000*exec_time)
-                print(info)
-                prev_time = time.time()
+                    image_data = utils.image_preprocess(cur_frame, [INPUT_SIZE, INPUT_SIZE]) 
+                    image_data = image_data[np.newaxis, ...].astype(np.float32)
                 
+                with tracer.stage('to_gpu'):
+                    with tf.device('/GPU:0'):
+                        image_data = tf.convert_to_tensor(image_data)
                 
                 #make bboxes
-                pred_bbox = model.predict(image_data)
-                pred_bbox = utils.postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE)
-                bboxes = utils.postprocess_boxes(pred_bbox, frame_size, INPUT_SIZE, 0.25)
-                bboxes = utils.nms(bboxes, 0.213, method='nms')
-                
+                with tracer.stage('inference'):
+                    pred_bbox = model.predict(image_data)
+                with tracer.stage('postprocess'):
+                    pred_bbox = utils.postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE)
+                    bboxes = utils.postprocess_boxes(pred_bbox, frame_size, INPUT_SIZE, 0.25)
+                    bboxes = utils.nms(bboxes, 0.213, method='nms')
                 
                 #output bbox info to file and show image
-                #calculate and display time it took to process frame
-                utils.video_write_info(frame, f, bboxes, dt)
-                image = utils.draw_some_bbox(frame, bboxes)
-                
-                curr_time = time.time()
-                exec_time = curr_time - prev_time
-                info = "time2: %.2f ms" %(1000*exec_time)
-                print(info)
+                with tracer.stage('render'):
+                    utils.video_write_info(frame, f, bboxes, dt)
+                    image = utils.draw_some_bbox(frame, bboxes)
+                tracer.sample_queue('frame buffer', buf)
+                tracer.maybe_report()
                 
                 result = np.asarray(image)
                 cv2.namedWindow("result", cv2.WINDOW_NORMAL)
@@ -150,6 +144,7 @@ def main():
                 if cv2.waitKey(1) & 0xFF == ord('q'): break
         
             #end video, close viewer, stop writing to file
+            print(tracer.summary())
             vid.release()
             cv2.destroyAllWindows()
             f.close()
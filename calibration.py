@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Int8 calibration data from our own cameras.
+
+Frames are sampled from recorded videos (listed directly, in a folder, or in
+the transforms csv), spread evenly across cameras and, within each camera,
+across times of day, so night footage gets as much say in the activation
+ranges as the busy afternoons. Each frame goes through the same letterboxing
+as inference and the resulting tensors are cached on disk, so repeated
+conversions don't re-decode the videos.
+
+Also reports how much quantization costs: per layer error from tflite's
+quantization debugger, and person AP of the int8 model measured against the
+float model's detections on frames held out of calibration.
+
+@author: Nikki
+"""
+
+import io
+import os
+import csv
+import glob
+import json
+import hashlib
+import datetime
+import cv2
+import numpy as np
+import tensorflow as tf
+from core import utils
+
+#frames sampled in total, split evenly between cameras
+SAMPLES = 300
+#times of day each camera's frames are spread across, 4 gives 6 hour blocks starting at midnight
+TIME_BINS = 4
+#every HOLDOUT-th sample is kept out of calibration and used for the accuracy report
+HOLDOUT = 5
+#iou a detection needs with a float model detection to count as the same person
+AP_IOU = 0.5
+VIDEO_EXTS = ('.mp4', '.avi', '.mkv', '.mov')
+
+
+###---------------------------------------------------------------------------
+#   Finds the recorded videos to calibrate on
+#
+#   source - transforms csv (first column of each row), a folder of videos, a glob,
+#            or a list of any of those
+#
+#   returns - list of video paths, live streams and missing files are reported and left out
+
+def find_videos(source):
+    if isinstance(source, (list, tuple)):
+        return [path for s in source for path in find_videos(s)]
+
+    if source.lower().endswith('.csv'):
+        with open(source, newline='') as f:
+            paths = [row[0] for row in csv.reader(f) if len(row) > 0]
+    elif os.path.isdir(source):
+        paths = sorted(os.path.join(source, name) for name in os.listdir(source)
+                       if name.lower().endswith(VIDEO_EXTS))
+    elif glob.has_magic(source):
+        paths = sorted(glob.glob(source))
+    else:
+        paths = [source]
+
+    videos = []
+    for path in paths:
+        if '://' in path:
+            print('Skipping live stream for calibration: ' + path)
+        elif not os.path.exists(path):
+            print('Skipping missing calibration video: ' + path)
+        else:
+            videos.append(path)
+    return videos
+
+###---------------------------------------------------------------------------
+#   Time of day bin of every frame in a recording. The file's modification
+#   time is taken as the end of the recording.
+#
+#   returns - array of bins, one per frame
+
+def frame_bins(path, num_frames, fps, bins=TIME_BINS):
+    start = os.path.getmtime(path) - num_frames / fps
+    start = datetime.datetime.fromtimestamp(start)
+    start = start.hour * 3600 + start.minute * 60 + start.second
+    seconds = (start + np.arange(num_frames) / fps) % 86400
+    return (seconds * bins // 86400).astype(int)
+
+###---------------------------------------------------------------------------
+#   Picks which frames to sample, the same number from every camera and, within
+#   a camera, the same number from every time of day it has footage for, evenly
+#   spaced through each
+#
+#   returns - list of (path, frame index, time bin)
+
+def sample_plan(videos, num=SAMPLES, bins=TIME_BINS):
+    plan = []
+    per_cam = -(-num // len(videos))
+    for path in videos:
+        cap = cv2.VideoCapture(path)
+        num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30
+        cap.release()
+        if num_frames <= 0:
+            print('Skipping unreadable calibration video: ' + path)
+            continue
+
+        frame_bin = frame_bins(path, num_frames, fps, bins)
+        present = np.unique(frame_bin)
+        for k, b in enumerate(present):
+            quota = per_cam // len(present) + (1 if k < per_cam % len(present) else 0)
+            idx = np.flatnonzero(frame_bin == b)
+            picks = idx[np.linspace(0, len(idx) - 1, min(quota, len(idx))).astype(int)]
+            plan.extend((path, int(i), int(b)) for i in picks)
+    return plan
+
+###---------------------------------------------------------------------------
+#   Reads the planned frames, each video is opened once and read in frame order
+#
+#   letterbox - letterbox to input_size exactly as inference does, instead of
+#               returning the full size RGB frames
+#
+#   returns - frames - in plan order, float32 array [N, input_size, input_size, 3] when
+#                      letterboxed, otherwise a list of uint8 RGB frames
+#             read - the plan entries that were read, frames that failed are left out of both
+
+def read_frames(plan, input_size=None, letterbox=False):
+    if letterbox:
+        frames = np.empty([len(plan), input_size, input_size, 3], dtype=np.float32)
+    else:
+        frames = [None] * len(plan)
+    ok = np.zeros(len(plan), dtype=bool)
+    cap = None
+    path = None
+    for k in sorted(range(len(plan)), key=lambda k: plan[k][:2]):
+        if plan[k][0] != path:
+            if cap is not None:
+                cap.release()
+            path = plan[k][0]
+            cap = cv2.VideoCapture(path)
+        i = plan[k][1]
+        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ret_val, frame = cap.read()
+        if not ret_val:
+            print('Could not read frame ' + str(i) + ' of ' + path)
+            continue
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        frames[k] = utils.image_preprocess(frame, [input_size, input_size]) if letterbox else frame
+        ok[k] = True
+    if cap is not None:
+        cap.release()
+
+    read = [p for p, good in zip(plan, ok) if good]
+    if letterbox:
+        return (frames if ok.all() else frames[ok]), read
+    return [f for f, good in zip(frames, ok) if good], read
+
+###---------------------------------------------------------------------------
+#   Calibration tensors for the given videos, from the cache when it was built
+#   from the same videos and settings
+#
+#   cache - path without extension, tensors go in .npy and what they were built from in .json
+#
+#   returns - float32 array [N, input_size, input_size, 3], memory mapped when cached
+
+def load_tensors(source, input_size, num=SAMPLES, bins=TIME_BINS, cache=None):
+    videos = find_videos(source)
+    if len(videos) == 0:
+        raise IOError('No calibration videos found in ' + str(source))
+
+    #videos are identified by path, size and modification time, re-hashing gigabytes of video isn't worth it
+    key = [[v, os.path.getsize(v), os.path.getmtime(v)] for v in videos]
+    key = hashlib.sha1(json.dumps([key, input_size, num, bins]).encode()).hexdigest()
+    if cache is not None and os.path.exists(cache + '.json') and os.path.exists(cache + '.npy'):
+        with open(cache + '.json') as f:
+            index = json.load(f)
+        if index.get('key') == key:
+            print('Calibration tensors loaded from ' + cache + '.npy')
+            return np.load(cache + '.npy', mmap_mode='r')
+
+    plan = sample_plan(videos, num, bins)
+    tensors, read = read_frames(plan, input_size, letterbox=True)
+    counts = {}
+    for path, _, b in read:
+        counts.setdefault(path, [0] * bins)[b] += 1
+    print('Calibration frames per camera and time of day:')
+    for path, per_bin in counts.items():
+        print('  ' + os.path.basename(path) + ': ' + str(per_bin))
+
+    if cache is not None:
+        tmp = cache + '.%d.tmp.npy' % os.getpid()
+        np.save(tmp, tensors)
+        os.replace(tmp, cache + '.npy')
+        utils.write_json(cache + '.json', {'key': key, 'videos': videos, 'input_size': input_size,
+                                           'samples': len(tensors), 'bins': bins, 'counts': counts})
+    return tensors
+
+###---------------------------------------------------------------------------
+#   Splits tensors into calibration and held out report sets
+
+def split(tensors, holdout=HOLDOUT):
+    idx = np.arange(len(tensors))
+    return tensors[idx % holdout != 0], tensors[idx % holdout == 0]
+
+#representative_dataset for the tflite converter, one image per step
+def representative_dataset(tensors):
+    def gen():
+        for i in range(len(tensors)):
+            yield [np.array(tensors[i:i + 1])]
+    return gen
+
+
+###---------------------------------------------------------------------------
+#   Per layer quantization error, using tflite's quantization debugger on a
+#   converter already set up for full int8
+#
+#   path - csv the full per layer stats are written to
+#
+#   returns - list of (layer, rmse / scale), worst first
+
+def layer_report(converter, tensors, path=None, top=10):
+    try:
+        debugger = tf.lite.experimental.QuantizationDebugger(
+            converter=converter, debug_dataset=representative_dataset(tensors))
+    except AttributeError:
+        print('This tensorflow has no quantization debugger, skipping the per layer report')
+        return []
+    debugger.run()
+    #the dump is the only place the stats sit next to each layer's quantization scale
+    dump = io.StringIO()
+    debugger.layer_statistics_dump(dump)
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(dump.getvalue())
+
+    errors = []
+    dump.seek(0)
+    for row in csv.DictReader(dump):
+        scale = float(row['scale'] or 0)
+        #error in units of the quantization step, about 0.29 is the best rounding can do
+        if scale > 0:
+            errors.append((row['tensor_name'], float(np.sqrt(float(row['mean_squared_error'])) / scale)))
+    errors.sort(key=lambda e: -e[1])
+    print('Layers with the largest quantization error (rmse / scale):')
+    for name, err in errors[:top]:
+        print('  %.3f  %s' % (err, name))
+    return errors
+
+###---------------------------------------------------------------------------
+#   VOC style average precision of dets against gts, all point interpolated
+#
+#   dets, gts - lists (one entry per image) of [N, 5+] arrays of x_min, y_min, x_max, y_max, score
+
+def average_precision(dets, gts, iou_thresh=AP_IOU):
+    total = sum(len(g) for g in gts)
+    scores = []
+    hits = []
+    for det, gt in zip(dets, gts):
+        det = np.asarray(det).reshape(-1, 6)
+        gt = np.asarray(gt).reshape(-1, 6)
+        used = np.zeros(len(gt), dtype=bool)
+        for box in det[np.argsort(-det[:, 4])]:
+            hit = False
+            if len(gt) > 0:
+                ious = utils.bboxes_iou(box[np.newaxis, :4], gt[:, :4])
+                ious[used] = 0
+                j = np.argmax(ious)
+                if ious[j] >= iou_thresh:
+                    used[j] = hit = True
+            scores.append(box[4])
+            hits.append(hit)
+    if total == 0:
+        return 1.0 if len(scores) == 0 else 0.0
+    if len(scores) == 0:
+        return 0.0
+
+    order = np.argsort(-np.array(scores), kind='stable')
+    tp = np.cumsum(np.array(hits)[order])
+    recall = np.concatenate([[0], tp / total, [1]])
+    precision = np.concatenate([[0], tp / np.arange(1, len(tp) + 1), [0]])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    changed = np.flatnonzero(recall[1:] != recall[:-1]) + 1
+    return float(np.sum((recall[changed] - recall[changed - 1]) * precision[changed]))
+
+###---------------------------------------------------------------------------
+#   Person AP of a tflite model, taking the float model's detections on the same
+#   frames as ground truth. 1.0 means quantization didn't change who was found.
+#
+#   float_model - keras model with the raw (not end to end) yolo outputs
+#
+#   returns - ap, number of float model people, number of tflite people
+
+def person_ap_drift(float_model, tflite_path, tensors, num_threads=None):
+    import detector
+    interpreter = detector.TFLiteBackend(tflite_path, num_threads)
+    size = tensors.shape[1]
+
+    gts = []
+    dets = []
+    for i in range(len(tensors)):
+        image = np.array(tensors[i:i + 1])
+        pred = [np.array(p) for p in float_model(image, training=False)]
+        gts.append(detector.filter_bboxes(pred, (size, size), size))
+        dets.append(detector.filter_bboxes(interpreter.predict(image), (size, size), size))
+
+    ap = average_precision(dets, gts)
+    people = (sum(len(g) for g in gts), sum(len(d) for d in dets))
+    print('Person AP of the tflite model against the float model: %.3f (%d vs %d people on %d frames)'
+          % (ap, people[0], people[1], len(tensors)))
+    return ap, people[0], people[1]
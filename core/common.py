@@ -74,5 +74,8 @@ def residual_block(input_layer, input_channel, filter_num1, filter_num2, activat
     return residual_output
 
 def upsample(input_layer):
+    # models built for any input size only know their feature map size at run time
+    if input_layer.shape[1] is None or input_layer.shape[2] is None:
+        return tf.image.resize(input_layer, tf.shape(input_layer)[1:3] * 2, method='nearest')
     return tf.image.resize(input_layer, (input_layer.shape[1] * 2, input_layer.shape[2] * 2), method='nearest')
 
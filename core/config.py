@@ -51,3 +51,20 @@ __C.TEST.SCORE_THRESHOLD      = 0.25
 __C.TEST.IOU_THRESHOLD        = 0.5
 
 
+
+# Live detection options
+__C.DETECT                    = edict()
+
+# Inference backend for the live pipeline: keras, saved_model or tflite
+__C.DETECT.BACKEND            = "keras"
+__C.DETECT.SAVED_MODEL        = "./checkpoints/yolov4"
+__C.DETECT.TFLITE             = "./data/yolov4.tflite"
+# Interpreter threads for tflite, None to use the worker's thread budget
+__C.DETECT.NUM_THREADS        = None
+# Build the model with its output convs cut down to these classes, person first then the
+# objects it is commonly mistaken for. About 7x less head output to decode and filter.
+__C.DETECT.PERSON_HEAD        = False
+__C.DETECT.HEAD_CLASSES       = [0, 9, 10, 11, 12, 13]
+# Most people the end to end graph returns per image, anything past this is dropped by its nms.
+# Set well above the densest plaza, so crowds and tiles are never cut short
+__C.DETECT.MAX_BOXES          = 1000
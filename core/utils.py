@@ -1,131 +1,211 @@
+import os
 import cv2
+import json
 import random
+import hashlib
 import colorsys
 import numpy as np
 import tensorflow as tf
 from core.config import cfg
 import csv
 
+#cache converted darknet weights next to the .weights file so later processes can memory map them
+WEIGHTS_CACHE = True
+#objects commonly mistaken for people (traffic light, fire hydrant, stop sign, parking meter, bench)
+VETO_CLASSES = [9, 10, 11, 12, 13]
+
+###---------------------------------------------------------------------------
+#   Loads darknet weights into the tf model, from the converted cache when it is
+#   up to date, otherwise by parsing the .weights file and rebuilding the cache
+#
+#   num_convs - number of conv layers in the model
+#   out_convs - conv layers with a bias instead of batch norm (the output layers)
+#   head_classes - for a model built with a pruned head, the classes it keeps, in
+#                  order. The full head is read from the file (and cached) as usual
+#                  and the output convs are sliced down to those classes.
+
+def load_darknet(model, weights_file, num_convs, out_convs, head_classes=None):
+    num_class = None
+    if head_classes is not None:
+        num_class = len(read_class_names(cfg.YOLO.CLASSES))
+    
+    tensors = None
+    if WEIGHTS_CACHE:
+        tensors = read_weights_cache(weights_file, num_convs)
+    if tensors is None:
+        tensors = read_darknet(model, weights_file, num_convs, out_convs, num_class)
+        if WEIGHTS_CACHE:
+            try:
+                write_weights_cache(weights_file, num_convs, tensors)
+            except OSError as e:
+                print('Could not write weights cache:', e)
+
+    layers = {layer.name: layer for layer in model.layers}
+    out_names = set(conv_name(i) for i in out_convs)
+    for name, weights in tensors:
+        if head_classes is not None and name in out_names:
+            keep = head_channels(head_classes, num_class)
+            weights = [weights[0][..., keep], weights[1][keep]]
+        layers[name].set_weights(weights)
+
+def conv_name(i):
+    return 'conv2d_%d' %i if i > 0 else 'conv2d'
+
+###---------------------------------------------------------------------------
+#   Output channels of a yolo head that belong to the given classes. Each of the
+#   3 anchors has x, y, w, h, objectness then one channel per class.
+#
+#   returns - channel indices into the full head, in the pruned head's order
+
+def head_channels(head_classes, num_class):
+    per_anchor = np.concatenate([np.arange(5), 5 + np.asarray(head_classes)])
+    return np.concatenate([a * (5 + num_class) + per_anchor for a in range(3)])
+
+###---------------------------------------------------------------------------
+#   Parses a darknet .weights file, using the model's conv layers for the shapes
+#
+#   num_class - classes in the file's output convs, only needed when the model's
+#               own head has been pruned to fewer
+#
+#   returns - list of (layer name, [weight arrays]) in tf layout
+
+def read_darknet(model, weights_file, num_convs, out_convs, num_class=None):
+    layers = {layer.name: layer for layer in model.layers}
+    tensors = []
+    with open(weights_file, 'rb') as wf:
+        major, minor, revision, seen, _ = np.fromfile(wf, dtype=np.int32, count=5)
+
+        j = 0
+        for i in range(num_convs):
+            conv_layer_name = conv_name(i)
+            bn_layer_name = 'batch_normalization_%d' %j if j > 0 else 'batch_normalization'
+
+            conv_layer = layers[conv_layer_name]
+            filters = conv_layer.filters
+            if i in out_convs and num_class is not None:
+                filters = 3 * (5 + num_class)
+            k_size = conv_layer.kernel_size[0]
+            in_dim = conv_layer.input_shape[-1]
+
+            if i not in out_convs:
+                # darknet weights: [beta, gamma, mean, variance]
+                bn_weights = np.fromfile(wf, dtype=np.float32, count=4 * filters)
+                # tf weights: [gamma, beta, mean, variance]
+                bn_weights = bn_weights.reshape((4, filters))[[1, 0, 2, 3]]
+                j += 1
+            else:
+                conv_bias = np.fromfile(wf, dtype=np.float32, count=filters)
+
+            # darknet shape (out_dim, in_dim, height, width)
+            conv_shape = (filters, in_dim, k_size, k_size)
+            conv_weights = np.fromfile(wf, dtype=np.float32, count=np.prod(conv_shape))
+            # tf shape (height, width, in_dim, out_dim)
+            conv_weights = conv_weights.reshape(conv_shape).transpose([2, 3, 1, 0])
+
+            if i not in out_convs:
+                tensors.append((conv_layer_name, [conv_weights]))
+                tensors.append((bn_layer_name, list(bn_weights)))
+            else:
+                tensors.append((conv_layer_name, [conv_weights, conv_bias]))
+
+        assert len(wf.read()) == 0, 'failed to read all data'
+    return tensors
+
+###---------------------------------------------------------------------------
+#   The cache is a flat float32 .npy holding every tensor back to back, plus a
+#   json index of where each tensor starts and its shape. It is tied to the
+#   source file by sha1, with size and mtime checked first so the hash is only
+#   recomputed when the file looks like it changed.
+
+def weights_cache_paths(weights_file):
+    return weights_file + '.cache.npy', weights_file + '.cache.json'
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+###---------------------------------------------------------------------------
+#   returns - list of (layer name, [weight arrays]) memory mapped from the cache,
+#             or None if there is no cache or it doesn't match the weights file
+
+def read_weights_cache(weights_file, num_convs):
+    data_f, index_f = weights_cache_paths(weights_file)
+    try:
+        with open(index_f) as f:
+            index = json.load(f)
+        data = np.load(data_f, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    
+    if index.get('num_convs') != num_convs:
+        return None
+    stat = os.stat(weights_file)
+    if (stat.st_size, stat.st_mtime_ns) != (index.get('size'), index.get('mtime_ns')):
+        if file_sha1(weights_file) != index.get('sha1'):
+            print('Weights cache is stale, rebuilding')
+            return None
+        #same contents, just touched - record the new stat so the hash isn't redone every start
+        index['size'], index['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        try:
+            write_json(index_f, index)
+        except OSError:
+            pass
+    
+    tensors = []
+    for name, entries in index['tensors']:
+        weights = []
+        for offset, shape in entries:
+            weights.append(data[offset:offset + int(np.prod(shape))].reshape(shape))
+        tensors.append((name, weights))
+    return tensors
+
+def write_weights_cache(weights_file, num_convs, tensors):
+    data_f, index_f = weights_cache_paths(weights_file)
+    total = sum(w.size for _, weights in tensors for w in weights)
+    
+    entries = []
+    offset = 0
+    #several workers may build the cache at once, so write to temp files and swap them in
+    tmp_data = data_f + '.%d.tmp' % os.getpid()
+    data = np.lib.format.open_memmap(tmp_data, mode='w+', dtype=np.float32, shape=(total,))
+    for name, weights in tensors:
+        layer = []
+        for w in weights:
+            data[offset:offset + w.size] = w.ravel()
+            layer.append([offset, list(w.shape)])
+            offset += w.size
+        entries.append([name, layer])
+    data.flush()
+    del data
+    
+    stat = os.stat(weights_file)
+    index = {'sha1': file_sha1(weights_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'num_convs': num_convs, 'tensors': entries}
+    os.replace(tmp_data, data_f)
+    write_json(index_f, index)
+
+def write_json(path, obj):
+    tmp = path + '.%d.tmp' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
 def load_weights_tiny(model, weights_file):
-    wf = open(weights_file, 'rb')
-    major, minor, revision, seen, _ = np.fromfile(wf, dtype=np.int32, count=5)
-
-    j = 0
-    for i in range(13):
-        conv_layer_name = 'conv2d_%d' % i if i > 0 else 'conv2d'
-        bn_layer_name = 'batch_normalization_%d' % j if j > 0 else 'batch_normalization'
-
-        conv_layer = model.get_layer(conv_layer_name)
-        filters = conv_layer.filters
-        k_size = conv_layer.kernel_size[0]
-        in_dim = conv_layer.input_shape[-1]
-
-        if i not in [9, 12]:
-            # darknet weights: [beta, gamma, mean, variance]
-            bn_weights = np.fromfile(wf, dtype=np.float32, count=4 * filters)
-            # tf weights: [gamma, beta, mean, variance]
-            bn_weights = bn_weights.reshape((4, filters))[[1, 0, 2, 3]]
-            bn_layer = model.get_layer(bn_layer_name)
-            j += 1
-        else:
-            conv_bias = np.fromfile(wf, dtype=np.float32, count=filters)
-
-        # darknet shape (out_dim, in_dim, height, width)
-        conv_shape = (filters, in_dim, k_size, k_size)
-        conv_weights = np.fromfile(wf, dtype=np.float32, count=np.product(conv_shape))
-        # tf shape (height, width, in_dim, out_dim)
-        conv_weights = conv_weights.reshape(conv_shape).transpose([2, 3, 1, 0])
-
-        if i not in [9, 12]:
-            conv_layer.set_weights([conv_weights])
-            bn_layer.set_weights(bn_weights)
-        else:
-            conv_layer.set_weights([conv_weights, conv_bias])
-
-    assert len(wf.read()) == 0, 'failed to read all data'
-    wf.close()
+    load_darknet(model, weights_file, 13, [9, 12])
 
 def load_weights_v3(model, weights_file):
-    wf = open(weights_file, 'rb')
-    major, minor, revision, seen, _ = np.fromfile(wf, dtype=np.int32, count=5)
-
-    j = 0
-    for i in range(75):
-        conv_layer_name = 'conv2d_%d' % i if i > 0 else 'conv2d'
-        bn_layer_name = 'batch_normalization_%d' % j if j > 0 else 'batch_normalization'
-
-        conv_layer = model.get_layer(conv_layer_name)
-        filters = conv_layer.filters
-        k_size = conv_layer.kernel_size[0]
-        in_dim = conv_layer.input_shape[-1]
-
-        if i not in [58, 66, 74]:
-            # darknet weights: [beta, gamma, mean, variance]
-            bn_weights = np.fromfile(wf, dtype=np.float32, count=4 * filters)
-            # tf weights: [gamma, beta, mean, variance]
-            bn_weights = bn_weights.reshape((4, filters))[[1, 0, 2, 3]]
-            bn_layer = model.get_layer(bn_layer_name)
-            j += 1
-        else:
-            conv_bias = np.fromfile(wf, dtype=np.float32, count=filters)
-
-        # darknet shape (out_dim, in_dim, height, width)
-        conv_shape = (filters, in_dim, k_size, k_size)
-        conv_weights = np.fromfile(wf, dtype=np.float32, count=np.product(conv_shape))
-        # tf shape (height, width, in_dim, out_dim)
-        conv_weights = conv_weights.reshape(conv_shape).transpose([2, 3, 1, 0])
-
-        if i not in [58, 66, 74]:
-            conv_layer.set_weights([conv_weights])
-            bn_layer.set_weights(bn_weights)
-        else:
-            conv_layer.set_weights([conv_weights, conv_bias])
-
-    assert len(wf.read()) == 0, 'failed to read all data'
-    wf.close()
+    load_darknet(model, weights_file, 75, [58, 66, 74])
 
 ###---------------------------------------------------------------------------
 #   Loads existing yolo weights into tf model
+#
+#   head_classes - classes kept by a model built with a pruned head, see load_darknet
 
-def load_weights(model, weights_file):
-    wf = open(weights_file, 'rb')
-    major, minor, revision, seen, _ = np.fromfile(wf, dtype=np.int32, count=5)
-
-    j = 0
-    for i in range(110):
-        conv_layer_name = 'conv2d_%d' %i if i > 0 else 'conv2d'
-        bn_layer_name = 'batch_normalization_%d' %j if j > 0 else 'batch_normalization'
-
-
-        conv_layer = model.get_layer(conv_layer_name)
-        filters = conv_layer.filters
-        k_size = conv_layer.kernel_size[0]
-        in_dim = conv_layer.input_shape[-1]
-
-        if i not in [93, 101, 109]:
-            # darknet weights: [beta, gamma, mean, variance]
-            bn_weights = np.fromfile(wf, dtype=np.float32, count=4 * filters)
-            # tf weights: [gamma, beta, mean, variance]
-            bn_weights = bn_weights.reshape((4, filters))[[1, 0, 2, 3]]
-            bn_layer = model.get_layer(bn_layer_name)
-            j += 1
-        else:
-            conv_bias = np.fromfile(wf, dtype=np.float32, count=filters)
-
-        # darknet shape (out_dim, in_dim, height, width)
-        conv_shape = (filters, in_dim, k_size, k_size)
-        conv_weights = np.fromfile(wf, dtype=np.float32, count=np.product(conv_shape))
-        # tf shape (height, width, in_dim, out_dim)
-        conv_weights = conv_weights.reshape(conv_shape).transpose([2, 3, 1, 0])
-
-        if i not in [93, 101, 109]:
-            conv_layer.set_weights([conv_weights])
-            bn_layer.set_weights(bn_weights)
-        else:
-            conv_layer.set_weights([conv_weights, conv_bias])
-
-    assert len(wf.read()) == 0, 'failed to read all data'
-    wf.close()
+def load_weights(model, weights_file, head_classes=None):
+    load_darknet(model, weights_file, 110, [93, 101, 109], head_classes)
 
  
 def read_class_names(class_file_name):
@@ -159,10 +239,10 @@ def image_preprocess(image, target_size, gt_boxes=None):
     nw, nh  = int(scale * w), int(scale * h)
     image_resized = cv2.resize(image, (nw, nh))
 
-    image_paded = np.full(shape=[ih, iw, 3], fill_value=128.0)
+    image_paded = np.full(shape=[ih, iw, 3], fill_value=128.0, dtype=np.float32)
     dw, dh = (iw - nw) // 2, (ih-nh) // 2
     image_paded[dh:nh+dh, dw:nw+dw, :] = image_resized
-    image_paded = image_paded / 255.
+    image_paded /= 255.
 
     if gt_boxes is None:
         return image_paded
@@ -172,6 +252,57 @@ def image_preprocess(image, target_size, gt_boxes=None):
         gt_boxes[:, [1, 3]] = gt_boxes[:, [1, 3]] * scale + dh
         return image_paded, gt_boxes
 
+###---------------------------------------------------------------------------
+#   Letterboxes frames straight into a preallocated float32 batch buffer. The
+#   resize geometry for each (source size, input size) is worked out once and
+#   cached, along with a scratch buffer for the resized image, and the BGR->RGB
+#   swap and /255 normalisation happen in the same pass that writes the batch slot.
+#   Replaces image_preprocess + cvtColor + np.copy + astype on the hot path.
+
+class Preprocessor():
+
+    def __init__(self, input_size, batch_size=1):
+        self.input_size = input_size
+        self.batch = np.full([batch_size, input_size, input_size, 3], 128 / 255., dtype=np.float32)
+        self.geometry = {}
+        #source size each slot's padding was last laid out for
+        self.slot_sizes = [None] * batch_size
+
+    ###-----------------------------------------------------------------------
+    #   Cached resize geometry for frames of the given (height, width)
+    #
+    #   returns - (scale, nw, nh, dw, dh, resized buffer)
+
+    def get_geometry(self, frame_size):
+        geometry = self.geometry.get(frame_size)
+        if geometry is None:
+            h, w = frame_size
+            scale = min(self.input_size / w, self.input_size / h)
+            nw, nh = int(scale * w), int(scale * h)
+            dw, dh = (self.input_size - nw) // 2, (self.input_size - nh) // 2
+            geometry = (scale, nw, nh, dw, dh, np.empty((nh, nw, 3), dtype=np.uint8))
+            self.geometry[frame_size] = geometry
+        return geometry
+
+    ###-----------------------------------------------------------------------
+    #   Letterboxes a BGR uint8 frame into batch slot
+    #
+    #   returns - view of the filled slot
+
+    def load(self, slot, frame):
+        frame_size = frame.shape[:2]
+        scale, nw, nh, dw, dh, resized = self.get_geometry(frame_size)
+        out = self.batch[slot]
+
+        #padding only needs redrawing when the slot last held a different sized frame
+        if self.slot_sizes[slot] != frame_size:
+            out.fill(128 / 255.)
+            self.slot_sizes[slot] = frame_size
+
+        cv2.resize(frame, (nw, nh), dst=resized)
+        np.multiply(resized[..., ::-1], np.float32(1 / 255.), out=out[dh:nh+dh, dw:nw+dw, :])
+        return out
+
 ###---------------------------------------------------------------------------
 #   Given bbox info, draws rectangle around object
  
@@ -213,16 +344,15 @@ def draw_bbox(image, bboxes, classes=read_class_names(cfg.YOLO.CLASSES), show_la
     return image
 
 def find_blur_face(coor, image):
-    x_min = coor[0]
-    y_min = coor[1]
-    x_max = coor[2]
-    y_max = y_min + (coor[3] - coor[1])//3
+    image_h, image_w = image.shape[:2]
+    x_min = max(coor[0], 0)
+    y_min = max(coor[1], 0)
+    x_max = min(coor[2], image_w)
+    y_max = min(coor[1] + (coor[3] - coor[1])//3, image_h)
     
+    #pixelates in place, face is a view into image
     face = image[y_min:y_max, x_min:x_max]
-    
-    blurred_face = anonymize_face_pixelate(face, blocks=6)
-    
-    image[y_min:y_max, x_min:x_max] = blurred_face
+    anonymize_face_pixelate(face, blocks=6)
     return image
     
     
@@ -244,29 +374,17 @@ def anonymize_face_simple(image, factor=3.0):
 	return cv2.GaussianBlur(image, (kW, kH), 0)
 #from https://www.pyimagesearch.com/2020/04/06/blur-and-anonymize-faces-with-opencv-and-python/
 
+###---------------------------------------------------------------------------
+#   Pixelates image in place into (at most) blocks x blocks tiles: one area
+#   downscale averages each tile, then a nearest neighbour upscale paints it back
+
 def anonymize_face_pixelate(image, blocks=3):
-	# divide the input image into NxN blocks
-	(h, w) = image.shape[:2]
-	xSteps = np.linspace(0, w, blocks + 1, dtype="int")
-	ySteps = np.linspace(0, h, blocks + 1, dtype="int")
-	# loop over the blocks in both the x and y direction
-	for i in range(1, len(ySteps)):
-		for j in range(1, len(xSteps)):
-			# compute the starting and ending (x, y)-coordinates
-			# for the current block
-			startX = xSteps[j - 1]
-			startY = ySteps[i - 1]
-			endX = xSteps[j]
-			endY = ySteps[i]
-			# extract the ROI using NumPy array slicing, compute the
-			# mean of the ROI, and then draw a rectangle with the
-			# mean RGB values over the ROI in the original image
-			roi = image[startY:endY, startX:endX]
-			(B, G, R) = [int(x) for x in cv2.mean(roi)[:3]]
-			cv2.rectangle(image, (startX, startY), (endX, endY),
-				(B, G, R), -1)
-	# return the pixelated blurred image
-	return image
+    (h, w) = image.shape[:2]
+    if h == 0 or w == 0:
+        return image
+    small = cv2.resize(image, (min(blocks, w), min(blocks, h)), interpolation=cv2.INTER_AREA)
+    cv2.resize(small, (w, h), dst=image, interpolation=cv2.INTER_NEAREST)
+    return image
 
 def bboxes_iou(boxes1, boxes2):
 
@@ -322,7 +440,7 @@ def bboxes_ciou(boxes1, boxes2):
     return iou - ciou_term
 
 ###---------------------------------------------------------------------------
-#   Filters out excessively overlapping bboxes (I think)
+#   Filters out excessively overlapping bboxes
    
 def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
     """
@@ -331,39 +449,112 @@ def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
     Note: soft-nms, https://arxiv.org/pdf/1704.04503.pdf
           https://github.com/bharatsingh430/soft-nms
     """
-    classes_in_img = list(set(bboxes[:, 5]))
-    best_bboxes = []
+    return nms_engine(bboxes, iou_threshold, sigma, method, overlap='iou')
 
-    for cls in classes_in_img:
-        cls_mask = (bboxes[:, 5] == cls)
-        cls_bboxes = bboxes[cls_mask]
+###---------------------------------------------------------------------------
+#   Same as nms, but suppresses with DIoU (IoU minus normalised centre distance),
+#   so boxes of people standing close together are less likely to be merged
 
-        while len(cls_bboxes) > 0:
-            max_ind = np.argmax(cls_bboxes[:, 4])
-            best_bbox = cls_bboxes[max_ind]
-            best_bboxes.append(best_bbox)
-            cls_bboxes = np.concatenate([cls_bboxes[: max_ind], cls_bboxes[max_ind + 1:]])
-            iou = bboxes_iou(best_bbox[np.newaxis, :4], cls_bboxes[:, :4])
-            weight = np.ones((len(iou),), dtype=np.float32)
+def diounms_sort(bboxes, iou_threshold, sigma=0.3, method='nms', beta_nms=0.6):
+    """
+    :param bboxes: (xmin, ymin, xmax, ymax, score, class)
 
-            assert method in ['nms', 'soft-nms']
+    Note: diou-nms, https://arxiv.org/pdf/1911.08287.pdf
+          beta_nms is the exponent on the centre distance term, as in darknet
+    """
+    return nms_engine(bboxes, iou_threshold, sigma, method, overlap='diou', beta_nms=beta_nms)
 
-            if method == 'nms':
-                iou_mask = iou > iou_threshold
-                weight[iou_mask] = 0.0
+###---------------------------------------------------------------------------
+#   Overlap between every box in boxes1 and every box in boxes2, iou or diou
+#
+#   returns - [N1, N2] float32 array of overlaps
+
+def pairwise_overlap(boxes1, boxes2, overlap='iou', beta_nms=0.6):
+    x1_min, y1_min, x1_max, y1_max = [np.ascontiguousarray(boxes1[:, k, np.newaxis], dtype=np.float32) for k in range(4)]
+    x2_min, y2_min, x2_max, y2_max = [np.ascontiguousarray(boxes2[np.newaxis, :, k], dtype=np.float32) for k in range(4)]
+    eps = np.finfo(np.float32).eps
+
+    inter_w = np.minimum(x1_max, x2_max)
+    inter_w -= np.maximum(x1_min, x2_min)
+    np.maximum(inter_w, 0.0, out=inter_w)
+    inter_h = np.minimum(y1_max, y2_max)
+    inter_h -= np.maximum(y1_min, y2_min)
+    np.maximum(inter_h, 0.0, out=inter_h)
+    inter_area = inter_w
+    inter_area *= inter_h
+
+    union_area = (x1_max - x1_min) * (y1_max - y1_min) + (x2_max - x2_min) * (y2_max - y2_min)
+    union_area -= inter_area
+    ious = inter_area
+    ious /= union_area
+    np.maximum(ious, eps, out=ious)
+
+    if overlap == 'diou':
+        enclose_w = np.maximum(x1_max, x2_max) - np.minimum(x1_min, x2_min)
+        enclose_h = np.maximum(y1_max, y2_max) - np.minimum(y1_min, y2_min)
+        c = enclose_w ** 2 + enclose_h ** 2
+        d = ((x1_min + x1_max) - (x2_min + x2_max)) ** 2 / 4 + ((y1_min + y1_max) - (y2_min + y2_max)) ** 2 / 4
+        ious -= np.power(d / np.maximum(c, eps), beta_nms)
 
-            if method == 'soft-nms':
-                weight = np.exp(-(1.0 * iou ** 2 / sigma))
+    return ious
 
-            cls_bboxes[:, 4] = cls_bboxes[:, 4] * weight
-            score_mask = cls_bboxes[:, 4] > 0.
-            cls_bboxes = cls_bboxes[score_mask]
+###---------------------------------------------------------------------------
+#   Vectorised nms shared by nms and diounms_sort. Boxes are sorted by score once,
+#   then overlaps are computed a block of rows at a time against every lower
+#   scoring box, skipping rows that are already suppressed - in a crowd most of the
+#   pairwise matrix is never needed. Every class is shifted into its own region of
+#   coordinate space first, so boxes of different classes never overlap and all
+#   classes are handled in one pass.
+#
+#   returns - best_bboxes - [K, 6] array of kept bboxes, highest score first
+
+def nms_engine(bboxes, iou_threshold, sigma=0.3, method='nms', overlap='iou', beta_nms=0.6, block=64):
+    assert method in ['nms', 'soft-nms']
+    assert overlap in ['iou', 'diou']
+
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    if len(bboxes) == 0:
+        return np.zeros((0, 6))
+
+    order = np.argsort(-bboxes[:, 4], kind='stable')
+    bboxes = bboxes[order]
+
+    offsets = bboxes[:, 5:6] * (np.abs(bboxes[:, :4]).max() * 2 + 1)
+    boxes = bboxes[:, :4] + offsets
+    num = len(bboxes)
+
+    if method == 'nms':
+        keep = np.zeros(num, dtype=bool)
+        suppressed = np.zeros(num, dtype=bool)
+        for start in range(0, num, block):
+            rows = start + np.flatnonzero(~suppressed[start:start + block])
+            if len(rows) == 0:
+                continue
+            overlaps = pairwise_overlap(boxes[rows], boxes[start:], overlap, beta_nms) > iou_threshold
+            for k, i in enumerate(rows):
+                if suppressed[i]:
+                    continue
+                keep[i] = True
+                suppressed[start:] |= overlaps[k]
+        return bboxes[keep]
+
+    #soft-nms - scores decay depending on what has already been picked, so the
+    #next best box has to be found again after every pick
+    overlaps = pairwise_overlap(boxes, boxes, overlap, beta_nms)
+    scores = bboxes[:, 4].copy()
+    remaining = np.ones(num, dtype=bool)
+    best_bboxes = []
+    while remaining.any():
+        i = np.argmax(np.where(remaining, scores, -np.inf))
+        remaining[i] = False
+        best_bbox = bboxes[i].copy()
+        best_bbox[4] = scores[i]
+        best_bboxes.append(best_bbox)
 
-    return best_bboxes
+        scores = scores * np.exp(-(1.0 * overlaps[i] ** 2 / sigma))
+        remaining &= scores > 0.
 
-def diounms_sort(bboxes, iou_threshold, sigma=0.3, method='nms', beta_nms=0.6):
-    best_bboxes = []
-    return best_bboxes
+    return np.array(best_bboxes)
 
 def postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE=[1,1,1]):
     # print(len(pred_bbox))
@@ -398,7 +589,11 @@ def postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE=[1,1,1]):
 #   Filters out bboxes that are not within the image, are not scaled properly, or are invalid
 #   Returns remaining bboxes
    
-def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold):
+#
+#   class_map - for a pruned head, the real class of each of its class channels, so
+#               the returned classes are still coco ids. probs stay in the pruned layout.
+
+def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold, class_map=None):
     
 
     valid_scale=[0, np.inf]
@@ -452,6 +647,8 @@ def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold):
     # # (5) discard some boxes with low scores
     classes = np.argmax(pred_prob, axis=-1)
     scores = pred_conf * pred_prob[np.arange(len(pred_coor)), classes]
+    if class_map is not None:
+        classes = np.asarray(class_map)[classes]
     # scores = pred_prob[np.arange(len(pred_coor)), classes]
     score_mask = scores > score_threshold
     mask = np.logical_and(scale_mask, score_mask)
@@ -465,22 +662,30 @@ def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold):
 
 ###---------------------------------------------------------------------------
 #   Filters out all but people and returns their bboxes
+#
+#   class_map - classes of the prob columns when they come from a pruned head,
+#               must include VETO_CLASSES
 
-def filter_people(bboxes, probs, classes):#, image_num):
+def filter_people(bboxes, probs, classes, class_map=None):#, image_num):
     #list of bboxes that mark a person
     people_bboxes = []
     # people_bboxes2 = []
+    
+    #columns of the commonly mistaken objects
+    veto = VETO_CLASSES
+    if class_map is not None:
+        veto = [list(class_map).index(c) for c in VETO_CLASSES]
 
     # takes objects primarily identified as a person and filters out ones with relatively high chances
     # of being non-human
     for i, prob in enumerate(probs): 
         if classes[i] == 0:
             #commonly mistaken objects
-            light = prob[9]
-            fire = prob[10]
-            stop = prob[11]
-            parking = prob[12]
-            bench = prob[13]
+            light = prob[veto[0]]
+            fire = prob[veto[1]]
+            stop = prob[veto[2]]
+            parking = prob[veto[3]]
+            bench = prob[veto[4]]
             #print(prob[9:14])
             if (light < 0.002 and fire < 0.002 and stop < 0.002 and parking < 0.002 and bench < 0.002): 
                 people_bboxes.append(bboxes[i])
@@ -518,7 +723,7 @@ def video_write_info(f, real_ftpts, dt, count, people, avg_dist, avg_min_dist):
 ###---------------------------------------------------------------------------
 #   Displays occupancy and compliance data in top right corner of video
         
-def overlay_occupancy(img, count, people, size):
+def overlay_occupancy(img, count, people, size, scale=1.0):
     
     occupants = 'Occupants : ' + str(people) + '  '
     
@@ -530,10 +735,13 @@ def overlay_occupancy(img, count, people, size):
     compliance = '%s: %.2f %s' % ('Compliance', comp, '%')
 
     #calculate size text will occupy, then adjust so overlay appears in top right corner
+    #text is sized for full resolution frames, scale shrinks it along with a downscaled frame
     x = size[1]
-    box = cv2.getTextSize(occupants + compliance, cv2.FONT_HERSHEY_DUPLEX, 2, 3)
+    font_scale = 2 * scale
+    thickness = max(int(round(3 * scale)), 1)
+    box = cv2.getTextSize(occupants + compliance, cv2.FONT_HERSHEY_DUPLEX, font_scale, thickness)
     offsetx = x//30 + box[0][0]
-    cv2.putText(img, occupants + compliance, ((x - offsetx), (x//30)) , cv2.FONT_HERSHEY_DUPLEX, 2, (0,0,0), 3)
+    cv2.putText(img, occupants + compliance, ((x - offsetx), (x//30)) , cv2.FONT_HERSHEY_DUPLEX, font_scale, (0,0,0), thickness)
 
 
 ###---------------------------------------------------------------------------
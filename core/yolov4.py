@@ -148,6 +148,74 @@ def decode(conv_output, NUM_CLASS, i=0):
 
     return tf.concat([conv_raw_xywh, pred_conf, pred_prob], axis=-1)
 
+def end_to_end(bbox_tensors, frame_sizes, input_size, STRIDES, ANCHORS, XYSCALE=[1,1,1], max_boxes=100,
+               score_threshold=0.25, iou_threshold=0.213, veto_classes=[9, 10, 11, 12, 13], veto_threshold=0.002):
+    """
+    In-graph replacement for postprocess_bbbox + postprocess_boxes + filter_people + nms.
+    bbox_tensors: outputs of decode, frame_sizes: [batch_size, 2] float (height, width) of the original frames
+    input_size: None when the model takes any input size
+    return tensor of shape [batch_size, max_boxes, 6] with (x_min, y_min, x_max, y_max, score, class)
+            in original frame pixels, unused rows are all zero
+    """
+    if input_size is None:
+        # model built for any input size, work it out from the finest grid
+        input_size = tf.cast(tf.shape(bbox_tensors[0])[1] * STRIDES[0], tf.float32)
+    all_xywh = []
+    all_conf = []
+    all_prob = []
+    for i, pred in enumerate(bbox_tensors):
+        conv_shape = tf.shape(pred)
+        batch_size = conv_shape[0]
+        output_size = conv_shape[1]
+        num_class = pred.shape[-1] - 5
+
+        conv_raw_dxdy, conv_raw_dwdh, pred_conf, pred_prob = tf.split(pred, (2, 2, 1, num_class), axis=-1)
+
+        x = tf.tile(tf.expand_dims(tf.range(output_size, dtype=tf.int32), axis=0), [output_size, 1])
+        y = tf.tile(tf.expand_dims(tf.range(output_size, dtype=tf.int32), axis=1), [1, output_size])
+        xy_grid = tf.expand_dims(tf.stack([x, y], axis=-1), axis=2)  # [gx, gy, 1, 2]
+        xy_grid = tf.cast(tf.expand_dims(xy_grid, axis=0), tf.float32)
+
+        pred_xy = ((tf.sigmoid(conv_raw_dxdy) * XYSCALE[i]) - 0.5 * (XYSCALE[i] - 1) + xy_grid) * STRIDES[i]
+        pred_wh = (tf.exp(conv_raw_dwdh) * ANCHORS[i])
+
+        all_xywh.append(tf.reshape(tf.concat([pred_xy, pred_wh], axis=-1), (batch_size, -1, 4)))
+        all_conf.append(tf.reshape(pred_conf, (batch_size, -1)))
+        all_prob.append(tf.reshape(pred_prob, (batch_size, -1, num_class)))
+
+    pred_xywh = tf.concat(all_xywh, axis=1)
+    pred_conf = tf.concat(all_conf, axis=1)
+    pred_prob = tf.concat(all_prob, axis=1)
+
+    # (x, y, w, h) --> (xmin, ymin, xmax, ymax) in letterboxed input pixels
+    pred_min = pred_xywh[..., :2] - pred_xywh[..., 2:] * 0.5
+    pred_max = pred_xywh[..., :2] + pred_xywh[..., 2:] * 0.5
+
+    # undo the letterbox scaling and padding for each frame
+    frame_sizes = tf.cast(frame_sizes, tf.float32)
+    org_hw = frame_sizes[:, tf.newaxis, :]
+    org_wh = org_hw[..., ::-1]
+    resize_ratio = tf.reduce_min(input_size / org_wh, axis=-1, keepdims=True)
+    dwdh = (input_size - resize_ratio * org_wh) / 2
+    pred_min = tf.maximum((pred_min - dwdh) / resize_ratio, 0.)
+    pred_max = tf.minimum((pred_max - dwdh) / resize_ratio, org_wh - 1)
+    valid = tf.reduce_all(pred_max > pred_min, axis=-1)
+
+    # keep boxes whose best class is a person and that don't look like a commonly mistaken object
+    is_person = tf.equal(tf.argmax(pred_prob, axis=-1), 0)
+    vetoed = tf.reduce_any(tf.gather(pred_prob, veto_classes, axis=-1) >= veto_threshold, axis=-1)
+    keep = tf.logical_and(tf.logical_and(valid, is_person), tf.logical_not(vetoed))
+    scores = pred_conf * pred_prob[..., 0] * tf.cast(keep, tf.float32)
+
+    # tf nms expects (ymin, xmin, ymax, xmax)
+    boxes = tf.concat([pred_min[..., ::-1], pred_max[..., ::-1]], axis=-1)
+    boxes, scores, classes, _ = tf.image.combined_non_max_suppression(
+        boxes[:, :, tf.newaxis, :], scores[..., tf.newaxis], max_boxes, max_boxes,
+        iou_threshold=iou_threshold, score_threshold=score_threshold, clip_boxes=False)
+    boxes = tf.concat([boxes[..., 1::-1], boxes[..., :1:-1]], axis=-1)
+
+    return tf.concat([boxes, scores[..., tf.newaxis], classes[..., tf.newaxis]], axis=-1)
+
 def decode_train(conv_output, NUM_CLASS, STRIDES, ANCHORS, i=0, XYSCALE=[1,1,1]):
     conv_shape = tf.shape(conv_output)
     batch_size = conv_shape[0]
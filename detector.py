@@ -12,12 +12,24 @@ import numpy as np
 import time
 
 import tensorflow as tf
-from core.yolov4 import YOLOv4, decode #, YOLOv3_tiny, YOLOv3
+from core.yolov4 import YOLOv4, decode, end_to_end #, YOLOv3_tiny, YOLOv3
 from core import utils
 from core.config import cfg
 from PIL import Image
 import pixel_gps as pg
 import scipy.spatial
+import scipy.spatial.distance
+import collections
+import tracing
+
+#the standalone runtimes are much smaller on edge boxes, full tensorflow works too
+try:
+    from ai_edge_litert.interpreter import Interpreter
+except ImportError:
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        Interpreter = tf.lite.Interpreter
 
 #uncomment to verify that GPU is being used
 #tf.debugging.set_log_device_placement(True)
@@ -25,9 +37,18 @@ import scipy.spatial
 STRIDES = np.array(cfg.YOLO.STRIDES)
 ANCHORS = utils.get_anchors(cfg.YOLO.ANCHORS)
 XYSCALE = cfg.YOLO.XYSCALE
-INPUT_SIZE = 419 #608 #230 #999 #800
+#default model input size, cameras can ask for their own (see align_size)
+INPUT_SIZE = 416 #608 #230 #999 #800
+#input sizes have to be a multiple of the coarsest stride for the grids to line up
+SIZE_STEP = 32
 NUM_CLASS = len(utils.read_class_names(cfg.YOLO.CLASSES))
 WEIGHTS = './data/yolov4.weights'
+#decode, filter and nms inside the model graph instead of in numpy on the host
+END_TO_END = True
+#max number of people returned per frame by the end to end model, a warning is printed if it is hit
+MAX_BOXES = cfg.DETECT.MAX_BOXES
+#whether this process has already warned about the end to end model running out of rows
+_warned_cap = False
 
 ###---------------------------------------------------------------------------
 #   get transformations for camera locations and angles
@@ -43,74 +64,297 @@ WEIGHTS = './data/yolov4.weights'
 ###---------------------------------------------------------------------------
 #   start people finding model
 #
-#   return - model - the object detection model
-def start_model(gpu):
+#   gpu - device string to place the model on, or None to use the default device
+#   batch_sizes - batch sizes to trace and warm up graphs for at startup
+#   e2e - whether box decoding, filtering and nms are built into the graph, only
+#         for the keras backend, exported models carry their own
+#   backend - keras, saved_model or tflite, defaults to cfg.DETECT.BACKEND
+#   num_threads - interpreter threads for tflite, cfg.DETECT.NUM_THREADS overrides it
+#   input_sizes - square input sizes to trace graphs for, keras only, exported models
+#                 run at the size they were exported with
+#   input_size - default size, for frames of cameras that don't ask for their own
+#
+#   return - model - the object detection model, anything with predict(image_data, frame_sizes),
+#                    e2e, input_size and input_sizes like CompiledModel
+
+def start_model(gpu=None, batch_sizes=(1,), e2e=END_TO_END, backend=None, num_threads=None, input_sizes=None,
+                input_size=INPUT_SIZE):
+    if backend is None:
+        backend = cfg.DETECT.BACKEND
+    if input_sizes is None:
+        input_sizes = []
+    #the default always gets a graph, whatever sizes the cameras ask for
+    input_size = align_size(input_size)
+    input_sizes = sorted(set(align_size(size) for size in input_sizes) | {input_size})
+    
+    if backend != 'keras':
+        if backend == 'saved_model':
+            model = SavedModelBackend(cfg.DETECT.SAVED_MODEL, gpu)
+        elif backend == 'tflite':
+            if cfg.DETECT.NUM_THREADS is not None:
+                num_threads = cfg.DETECT.NUM_THREADS
+            model = TFLiteBackend(cfg.DETECT.TFLITE, num_threads)
+        else:
+            raise ValueError('Unknown detection backend ' + str(backend))
+        if input_sizes != [model.input_size]:
+            print('Exported models only run at ' + str(model.input_size) + ', ignoring input sizes ' + str(input_sizes))
+        #run once per batch size so the first real frame doesn't pay for setup
+        for batch in batch_sizes:
+            model.predict(np.zeros([batch, model.input_size, model.input_size, 3], dtype=np.float32),
+                          np.full([batch, 2], model.input_size, dtype=np.float32))
+        return model
+
+    #generate model, one that takes any input size if more than one is wanted
+    build_size = input_size if len(input_sizes) == 1 else None
+    if gpu is None:
+        model = build_model(build_size, e2e=e2e)
+    else:
+        strategy = tf.distribute.OneDeviceStrategy(device=gpu)
+        with strategy.scope():
+            model = build_model(build_size, e2e=e2e)
     
+    return CompiledModel(model, batch_sizes, input_sizes, gpu, e2e, input_size)
+
+#nearest input size the model can run at
+def align_size(size):
+    return max(SIZE_STEP, int(round(size / SIZE_STEP)) * SIZE_STEP)
 
-    tf.executing_eagerly()
+###---------------------------------------------------------------------------
+#   Builds the keras YOLOv4 model and loads the darknet weights into it.
+#   The end to end model takes a second input holding the (height, width) of each
+#   original frame and outputs [batch, MAX_BOXES, 6] person bboxes in frame pixels.
+#
+#   input_size - None for a model that takes any (stride aligned) input size
+#   person_head - only build the output channels for cfg.DETECT.HEAD_CLASSES
+#
+#   return - model - keras model
+
+def build_model(input_size=INPUT_SIZE, e2e=False, person_head=None):
+    if person_head is None:
+        person_head = cfg.DETECT.PERSON_HEAD
+    head_classes = cfg.DETECT.HEAD_CLASSES if person_head else None
+    num_class = len(head_classes) if person_head else NUM_CLASS
     
-    #TODO will have to change when working with several gpus
-    strategy = tf.distribute.OneDeviceStrategy(device=gpu)
-   
-    # strategy = tf.distribute.MirroredStrategy()
-    with strategy.scope():
-
-        #generate model
-        input_layer = tf.keras.Input([INPUT_SIZE, INPUT_SIZE, 3])
-        
-        feature_maps = YOLOv4(input_layer, NUM_CLASS)
-        bbox_tensors = []
-        for i, fm in enumerate(feature_maps):
-            bbox_tensor = decode(fm, NUM_CLASS, i)
-            bbox_tensors.append(bbox_tensor)    
+    input_layer = tf.keras.Input([input_size, input_size, 3])
+    
+    feature_maps = YOLOv4(input_layer, num_class)
+    bbox_tensors = []
+    for i, fm in enumerate(feature_maps):
+        bbox_tensor = decode(fm, num_class, i)
+        bbox_tensors.append(bbox_tensor)    
+    if e2e:
+        size_layer = tf.keras.Input([2])
+        veto = veto_columns(head_classes)
+        bboxes = end_to_end(bbox_tensors, size_layer, input_size, STRIDES, ANCHORS, XYSCALE, MAX_BOXES,
+                            veto_classes=veto)
+        model = tf.keras.Model([input_layer, size_layer], bboxes)
+    else:
         model = tf.keras.Model(input_layer, bbox_tensors)
-        print('Model built')
-        
-        #force to run eagerly
-        model.run_eagerly = True
-        
-        #load existing weights into model
-        utils.load_weights(model, WEIGHTS)
+    print('Model built')
+    
+    #load existing weights into model, sliced down to the kept classes for a person head
+    utils.load_weights(model, WEIGHTS, head_classes)
     
     return model
 
-def start_model():
-    
+###---------------------------------------------------------------------------
+#   Wraps a keras model in tf.functions with fixed input signatures, one traced
+#   graph per (batch, input size). Graphs are traced and run once at startup so
+#   the first real frame doesn't pay for tracing, and are called directly rather
+#   than through model.predict, which rebuilds its data adapter on every call.
+#
+#   input_sizes - size, or list of sizes, to trace graphs for
+#   input_size - default size, traced too if it isn't in input_sizes. None for the first of input_sizes
 
-    tf.executing_eagerly()
+class CompiledModel():
     
-    #TODO will have to change when working with several gpus
-   
-    # strategy = tf.distribute.MirroredStrategy()
+    def __init__(self, model, batch_sizes=(1,), input_sizes=INPUT_SIZE, device=None, e2e=False, input_size=None):
+        self.model = model
+        if isinstance(input_sizes, int):
+            input_sizes = [input_sizes]
+        self.input_sizes = list(input_sizes)
+        if input_size is None:
+            input_size = self.input_sizes[0]
+        elif input_size not in self.input_sizes:
+            self.input_sizes.append(input_size)
+        self.input_size = input_size
+        self.device = device
+        self.e2e = e2e
+        self.graphs = {}
+        for size in self.input_sizes:
+            for batch in batch_sizes:
+                self.trace(batch, size)
+        print('Model compiled')
+        
+    ###-----------------------------------------------------------------------
+    #   Traces and warms up the graph for one batch and input size
+    
+    def trace(self, batch, size=None):
+        if size is None:
+            size = self.input_size
+        key = (batch, size)
+        spec = tf.TensorSpec([batch, size, size, 3], tf.float32)
+        model = self.model
+        
+        if self.e2e:
+            size_spec = tf.TensorSpec([batch, 2], tf.float32)
+            @tf.function(input_signature=[spec, size_spec])
+            def graph(image_data, frame_sizes):
+                return model([image_data, frame_sizes], training=False)
+        else:
+            @tf.function(input_signature=[spec])
+            def graph(image_data):
+                return model(image_data, training=False)
+        
+        self.graphs[key] = graph
+        self.predict(np.zeros(spec.shape, dtype=np.float32), np.full([batch, 2], size, dtype=np.float32))
+        return graph
+
+    ###-----------------------------------------------------------------------
+    #   Runs a batch through the graph matching its shape, tracing a new one if needed
+    #
+    #   frame_sizes - (height, width) of each original frame, only used by the end to end model
+    #
+    #   return - list of numpy arrays, one per output scale, or a single
+    #            [batch, MAX_BOXES, 6] array for the end to end model
+
+    def predict(self, image_data, frame_sizes=None):
+        key = (image_data.shape[0], image_data.shape[1])
+        graph = self.graphs.get(key)
+        if graph is None:
+            graph = self.trace(*key)
+        
+        args = [image_data]
+        if self.e2e:
+            args.append(np.asarray(frame_sizes, dtype=np.float32))
+        if self.device is None:
+            pred_bbox = graph(*args)
+        else:
+            with tf.device(self.device):
+                pred_bbox = graph(*args)
+        
+        if self.e2e:
+            return pred_bbox.numpy()
+        return [pred.numpy() for pred in pred_bbox]
+
+
+###---------------------------------------------------------------------------
+#   Runs a model exported by existing/save_model.py through its serving signature.
+#   Whether it is end to end and its input size are read from the signature.
 
-    #generate model
-    input_layer = tf.keras.Input([INPUT_SIZE, INPUT_SIZE, 3])
+class SavedModelBackend():
     
-    feature_maps = YOLOv4(input_layer, NUM_CLASS)
-    bbox_tensors = []
-    for i, fm in enumerate(feature_maps):
-        bbox_tensor = decode(fm, NUM_CLASS, i)
-        bbox_tensors.append(bbox_tensor)    
-    model = tf.keras.Model(input_layer, bbox_tensors)
-    print('Model built')
+    def __init__(self, path, device=None):
+        self.device = device
+        if device is None:
+            self.loaded = tf.saved_model.load(path)
+        else:
+            with tf.device(device):
+                self.loaded = tf.saved_model.load(path)
+        self.infer = self.loaded.signatures['serving_default']
+        
+        #image input is [batch, size, size, 3], the end to end model also takes [batch, 2] frame sizes
+        specs = self.infer.structured_input_signature[1]
+        self.inputs = sorted(specs, key=lambda name: -len(specs[name].shape))
+        self.e2e = len(self.inputs) == 2
+        self.input_size = int(specs[self.inputs[0]].shape[1])
+        self.input_sizes = [self.input_size]
+        print('SavedModel loaded')
     
-    #force to run eagerly
-    model.run_eagerly = True
+    def predict(self, image_data, frame_sizes=None):
+        args = {self.inputs[0]: tf.constant(image_data)}
+        if self.e2e:
+            args[self.inputs[1]] = tf.constant(np.asarray(frame_sizes, dtype=np.float32))
+        if self.device is None:
+            outputs = self.infer(**args)
+        else:
+            with tf.device(self.device):
+                outputs = self.infer(**args)
+        
+        outputs = [pred.numpy() for pred in outputs.values()]
+        if self.e2e:
+            return outputs[0]
+        return order_outputs(outputs)
+
+
+###---------------------------------------------------------------------------
+#   Runs a .tflite model from existing/convert_tflite.py, one interpreter per
+#   process. Inputs are copied straight into the interpreter's own buffers, which
+#   are only reallocated when the batch size changes, and int8 inputs and
+#   outputs are (de)quantized here so callers always see float32.
+#
+#   num_threads - threads the interpreter (and its XNNPACK delegate) uses, None for its default
+
+class TFLiteBackend():
     
-    #load existing weights into model
-    utils.load_weights(model, WEIGHTS)
+    def __init__(self, path, num_threads=None):
+        self.interpreter = Interpreter(model_path=path, num_threads=num_threads)
+        inputs = self.interpreter.get_input_details()
+        image = max(inputs, key=lambda d: len(d['shape']))
+        self.image_index = image['index']
+        self.size_index = next((d['index'] for d in inputs if d['index'] != image['index']), None)
+        self.e2e = self.size_index is not None
+        self.input_size = int(image['shape'][1])
+        self.input_sizes = [self.input_size]
+        self.batch = None
+        self.resize(int(image['shape'][0]))
+        print('TFLite model loaded')
+        
+    def resize(self, batch):
+        if batch == self.batch:
+            return
+        for detail in self.interpreter.get_input_details():
+            shape = list(detail['shape'])
+            shape[0] = batch
+            self.interpreter.resize_tensor_input(detail['index'], shape)
+        self.interpreter.allocate_tensors()
+        self.inputs = {d['index']: d for d in self.interpreter.get_input_details()}
+        self.outputs = self.interpreter.get_output_details()
+        self.batch = batch
+        
+    def predict(self, image_data, frame_sizes=None):
+        self.resize(len(image_data))
+        self.load(self.image_index, image_data)
+        if self.e2e:
+            self.load(self.size_index, frame_sizes)
+        self.interpreter.invoke()
+        
+        outputs = [self.output(detail) for detail in self.outputs]
+        if self.e2e:
+            return outputs[0]
+        return order_outputs(outputs)
     
-    return model
+    def load(self, index, data):
+        detail = self.inputs[index]
+        scale, zero = detail['quantization']
+        #view of the interpreter's input buffer, has to be dropped again before invoke
+        view = self.interpreter.tensor(index)()
+        if scale:
+            info = np.iinfo(view.dtype)
+            data = np.clip(np.round(np.asarray(data) / scale + zero), info.min, info.max)
+        np.copyto(view, data, casting='unsafe')
+        del view
+        
+    def output(self, detail):
+        out = self.interpreter.get_tensor(detail['index'])
+        scale, zero = detail['quantization']
+        if scale:
+            out = (out.astype(np.float32) - zero) * scale
+        return out
+
+#exported models don't keep keras' output order, put the scales back in stride order (largest grid first)
+def order_outputs(outputs):
+    return sorted(outputs, key=lambda pred: -pred.shape[1])
         
 
 ###---------------------------------------------------------------------------
 #   
 #FIXME frame, gpu
-def frame_to_gpu(frame, gpu):
-    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    cur_frame = np.copy(frame)
-    im_data = utils.image_preprocess(cur_frame, [INPUT_SIZE, INPUT_SIZE])
-    im_data = im_data[np.newaxis, ...].astype(np.float32)    
+def frame_to_gpu(frame, gpu, prep=None):
+    if prep is None:
+        prep = utils.Preprocessor(INPUT_SIZE)
+    prep.load(0, frame)
+    im_data = prep.batch[:1]
     with tf.device(gpu):
         im_data = tf.convert_to_tensor(im_data)
 
@@ -122,10 +366,61 @@ def frame_to_gpu(frame, gpu):
 def person_bboxes(model, image_data, frame_size):
     #make bboxes
     # print(image_data.shape)
+    if getattr(model, 'e2e', False):
+        return trim_bboxes(model.predict(image_data, [frame_size])[0])
     pred_bbox = model.predict(image_data)
+    return filter_bboxes(pred_bbox, frame_size, getattr(model, 'input_size', INPUT_SIZE))
+
+###---------------------------------------------------------------------------
+#   Drops the zero padded rows from a single image's end to end model output
+#
+#   If every row is used the graph's nms hit its cap (MAX_BOXES, or max_boxes of an
+#   exported model) and may have dropped people, which is counted and warned about.
+#
+#   returns - bboxes - array of [x_min, y_min, x_max, y_max, score, class] in frame pixels
+
+def trim_bboxes(bboxes):
+    global _warned_cap
+    kept = bboxes[bboxes[:, 4] > 0]
+    if len(kept) == len(bboxes) and len(bboxes) > 0:
+        tracing.get_tracer().count('boxes_capped')
+        if not _warned_cap:
+            print('End to end model returned its maximum of ' + str(len(bboxes))
+                  + ' people in a frame, some may be missing. Raise cfg.DETECT.MAX_BOXES')
+            _warned_cap = True
+    return kept
+
+###---------------------------------------------------------------------------
+#   Works out from its width whether raw model output came from a full or a person
+#   only head, so exported models of either kind just work
+#
+#   returns - class_map - coco class of each class channel, None for the full head
+
+def head_class_map(pred_bbox):
+    num_class = pred_bbox[0].shape[-1] - 5
+    if num_class == NUM_CLASS:
+        return None
+    if num_class == len(cfg.DETECT.HEAD_CLASSES):
+        return cfg.DETECT.HEAD_CLASSES
+    raise ValueError('Model outputs ' + str(num_class) + ' classes, expected ' + str(NUM_CLASS) +
+                     ' or a person head with ' + str(len(cfg.DETECT.HEAD_CLASSES)))
+
+#class channels the end to end graph checks for look-alikes
+def veto_columns(head_classes=None):
+    if head_classes is None:
+        return utils.VETO_CLASSES
+    return [head_classes.index(c) for c in utils.VETO_CLASSES]
+
+###---------------------------------------------------------------------------
+#   Turns raw model output for a single image into person bboxes
+#
+#   returns - bboxes - array of [x_min, y_min, x_max, y_max, score, class] in frame pixels
+
+def filter_bboxes(pred_bbox, frame_size, input_size=INPUT_SIZE):
+    class_map = head_class_map(pred_bbox)
     pred_bbox = utils.postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE)
-    all_bboxes, probs, classes = utils.postprocess_boxes(pred_bbox, frame_size, INPUT_SIZE, 0.25)#.25
-    bboxes = utils.filter_people(all_bboxes, probs, classes)
+    all_bboxes, probs, classes = utils.postprocess_boxes(pred_bbox, frame_size, input_size, 0.25, class_map)#.25
+    bboxes = utils.filter_people(all_bboxes, probs, classes, class_map)
 
     #only continue processing if there were people identified
     if len(bboxes) > 0:
@@ -135,121 +430,112 @@ def person_bboxes(model, image_data, frame_size):
     return bboxes
 
 ###---------------------------------------------------------------------------
-#   
-
-def batch_bboxes(model, frames):
+#   Runs frames from any number of cameras through the model in one forward pass.
+#   Each frame is letterboxed on its own, so frames of different sizes can share a
+#   batch, and the batch is padded up to batch_size so the model always sees the
+#   same input shape. Frames are written straight into the preprocessor's batch
+#   buffer, pass the same prep in every call so it gets reused.
+#
+#   prep - its input size picks which of the model's input sizes the batch runs at
+#
+#   returns - list of bbox arrays, one per frame, in that frame's own pixel coords
+
+def batch_bboxes(model, frames, batch_size=None, prep=None):
+    if batch_size is None:
+        batch_size = len(frames)
+    if prep is None:
+        prep = utils.Preprocessor(getattr(model, 'input_size', INPUT_SIZE), batch_size)
+    #the preprocessor decides the size the batch runs at
+    input_size = prep.input_size
     
-    all_image_data = [None] * len(frames)
-    sizes = [None] * len(frames)
-    bbbb = [[],[]]
+    image_data = prep.batch
+    sizes = np.full([batch_size, 2], input_size, dtype=np.float32)
     
-    for i, frame in enumerate(frames):
-        #move frame to GPU
-        all_image_data[i] = frame_to_gpu(frame)
-        sizes[i] = frame.shape[:2]
+    with tracing.stage('preprocess'):
+        for i, frame in enumerate(frames):
+            sizes[i] = frame.shape[:2]
+            prep.load(i, frame)
     
-    stacked = tf.stack(all_image_data, axis = 1)    
+    if getattr(model, 'e2e', False):
+        with tracing.stage('inference'):
+            pred_bbox = model.predict(image_data, sizes)
+        with tracing.stage('postprocess'):
+            return [trim_bboxes(pred_bbox[i]) for i in range(len(frames))]
     
-    trimmed = tf.squeeze(stacked)
-    # print(trimmed.shape)
+    with tracing.stage('inference'):
+        pred_bbox = model.predict(image_data)
     
-    # dataset = tf.data.Dataset.from_tensor_slices(stacked)
-    # dataset = dataset.batch(2)
-    # for im_data in dataset.as_numpy_iterator():
-    pred_bbox = model.predict(trimmed)
-    print('aww yeah')
+    #split the batch back up and scale each image's boxes to its own frame size
+    all_bboxes = [None] * len(frames)
+    with tracing.stage('postprocess'):
+        for i, frame_size in enumerate(sizes[:len(frames)]):
+            pred = [np.array(pred[i:i + 1]) for pred in pred_bbox]
+            all_bboxes[i] = filter_bboxes(pred, frame_size, input_size)
+    
+    return all_bboxes
 
+###---------------------------------------------------------------------------
+#   
 
-    pred_bbox = utils.postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE)
-    
-    all_bboxes, probs, classes, image_nums = utils.postprocess_boxes(pred_bbox, sizes[0], INPUT_SIZE, 0.25)#.25
-    bboxes = utils.filter_people(all_bboxes, probs, classes)
-    bboxes = utils.nms(bboxes, 0.213, method='nms')
-    bboxes = np.array(bboxes)
-    
-    # bboxes2 = utils.nms(bboxes2, 0.213, method='nms')
-    # bboxes2 = np.array(bboxes2)
+#distance in feet people should stay apart
+SAFE_DIST = 6
+
+#errors - number of people closer than radius to someone else
+#pairs - [P, 2] indices of every pair of people closer than radius
+#avg_dist - mean distance between every pair of people
+#min_dist - smallest distance between any two people
+#nn_dist - [N] distance from each person to their nearest neighbour
+DistStats = collections.namedtuple('DistStats', ['errors', 'pairs', 'avg_dist', 'min_dist', 'nn_dist'])
+
+###---------------------------------------------------------------------------
+#   Social distancing metrics for one frame, all from a single kd tree built over
+#   the real world points and queried for every point at once
+#
+#   real_pts - [N, 2] real world positions in ft
+#   mytree - optional, already built cKDTree over real_pts
+#
+#   returns - DistStats (avg_dist, min_dist are None with fewer than 2 people)
+
+def dist_stats(real_pts, radius=SAFE_DIST, mytree=None):
+    real_pts = np.asarray(real_pts, dtype=np.float64).reshape(-1, 2)
+    size = len(real_pts)
+    if size < 2:
+        return DistStats(0, np.zeros((0, 2), dtype=np.int64), None, None, np.full(size, np.inf))
     
-    print('frame1')
-    # print(bboxes)
-    # print('frame2')
-    # print(bboxes2)
+    if mytree is None:
+        mytree = scipy.spatial.cKDTree(real_pts)
     
+    #k=2 since each point's closest match is itself
+    dist, _ = mytree.query(real_pts, k=2)
+    nn_dist = dist[:, 1]
+    errors = int(np.count_nonzero(nn_dist < radius))
     
-    # for i, im_data in enumerate(dataset.as_numpy_iterator()):
-        
-        
-    #     pred_bbox = model.predict(im_data)
+    pairs = mytree.query_pairs(radius, output_type='ndarray')
+    if len(pairs) > 0:
+        #query_pairs includes pairs exactly radius apart, errors doesn't
+        gap = real_pts[pairs[:, 0]] - real_pts[pairs[:, 1]]
+        pairs = pairs[np.einsum('ij,ij->i', gap, gap) < radius * radius]
     
-    #     pred_bbox = utils.postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE)
-        
-    #     all_bboxes, probs, classes = utils.postprocess_boxes(pred_bbox, sizes[0], INPUT_SIZE, 0.25)#.25
-    #     bboxes = utils.filter_people(all_bboxes, probs, classes)
-    
-    #     #only continue processing if there were people identified
-    #     if len(bboxes) > 0:
-    #         #get rid of redundant boxes
-    #         bbbb[i].append(utils.nms(bboxes, 0.213, method='nms')) #.213
-    # # sep_bboxes = bbbb.unbatch()
-    # # print(sep_bboxes)
-    # print(bbbb)
-    # return bbbb
+    #every point's average distance to the others, averaged, is just the mean over all pairs
+    avg_dist = float(scipy.spatial.distance.pdist(real_pts).mean())
+    min_dist = float(nn_dist.min())
+    return DistStats(errors, pairs, avg_dist, min_dist, nn_dist)
 
 ###---------------------------------------------------------------------------
-#   
+#   Number of people closer than 6ft to someone else
 
 def compliance_count(mytree, real_pts):
-    errors = 0
-    for pt in real_pts:
-        dist, ind = mytree.query(pt, k=2)
-        closest = mytree.data[ind[1]]
-        #dist = pg.GPS_to_ft(gps_center, closest)
-        if dist[1] < 6:
-            errors = errors + 1
-    return errors    
+    return dist_stats(real_pts, mytree=mytree).errors
 
 ###---------------------------------------------------------------------------
 #   Finds average distance occupants are apart from each other
 ###
 
 def find_dist(mytree, real_pts):
-    size = len(real_pts)
-    # middle = size//2
-    # med_dists = [None] * size
-    avgs = [None] * size
-    for i, pt in enumerate(real_pts):
-        
-        dist, _ = mytree.query(pt, size)
-        # med_dists[i] = dist[middle]
-        
-        #do this for every pt in the tree - see if there is a built in function for this
-        others = dist[1:]
-        avgs[i] = sum(others)/len(others)
-        
-    # med_med = med_dists[middle]
-    # avg_med = sum(med_dists)/len(med_dists)
-    avg_avg = sum(avgs)/len(avgs)
-
-    return avg_avg
+    return dist_stats(real_pts, mytree=mytree).avg_dist
 
 def find_min_dist(mytree, real_pts):
-    size = len(real_pts)
-    # middle = size//2
-    # med_dists = [None] * size
-    all_mins = [None] * size
-    for i, pt in enumerate(real_pts):
-        
-        dist, _ = mytree.query(pt, 2)
-        # med_dists[i] = dist[middle]
-        
-        #do this for every pt in the tree - see if there is a built in function for this
-        all_mins[i] = dist[1]
-        print(all_mins)
-    # med_med = med_dists[middle]
-    # avg_med = sum(med_dists)/len(med_dists)
-    min_dist = min(all_mins)
-
-    return min_dist
+    return dist_stats(real_pts, mytree=mytree).min_dist
 
 
 # def find_occupants(frames, times, model, all_vid_info, files):
@@ -0,0 +1,87 @@
+import time
+import numpy as np
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import core.utils as utils
+
+flags.DEFINE_integer('repeat', 20, 'number of timed runs per box count')
+flags.DEFINE_integer('classes', 1, 'number of classes boxes are spread across')
+flags.DEFINE_float('iou', 0.213, 'nms iou threshold')
+flags.DEFINE_string('method', 'nms', 'nms or soft-nms')
+
+
+def loop_nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
+  # per class / per box implementation utils.nms used before it was vectorised, kept as the baseline
+  classes_in_img = list(set(bboxes[:, 5]))
+  best_bboxes = []
+
+  for cls in classes_in_img:
+    cls_mask = (bboxes[:, 5] == cls)
+    cls_bboxes = bboxes[cls_mask]
+
+    while len(cls_bboxes) > 0:
+      max_ind = np.argmax(cls_bboxes[:, 4])
+      best_bbox = cls_bboxes[max_ind]
+      best_bboxes.append(best_bbox)
+      cls_bboxes = np.concatenate([cls_bboxes[: max_ind], cls_bboxes[max_ind + 1:]])
+      iou = utils.bboxes_iou(best_bbox[np.newaxis, :4], cls_bboxes[:, :4])
+      weight = np.ones((len(iou),), dtype=np.float32)
+
+      if method == 'nms':
+        iou_mask = iou > iou_threshold
+        weight[iou_mask] = 0.0
+
+      if method == 'soft-nms':
+        weight = np.exp(-(1.0 * iou ** 2 / sigma))
+
+      cls_bboxes[:, 4] = cls_bboxes[:, 4] * weight
+      score_mask = cls_bboxes[:, 4] > 0.
+      cls_bboxes = cls_bboxes[score_mask]
+
+  return best_bboxes
+
+
+def crowd(num, rng):
+  # people sized boxes scattered over a 1080p frame, with several detections per person like the raw model output
+  people = max(num // 4, 1)
+  centers = rng.uniform([0, 0], [1920, 1080], size=(people, 2))
+  sizes = rng.uniform([20, 50], [60, 150], size=(people, 2))
+  owner = rng.integers(0, people, size=num)
+  jitter = rng.normal(0, 4, size=(num, 4))
+  xy_min = centers[owner] - sizes[owner] / 2
+  xy_max = centers[owner] + sizes[owner] / 2
+  coors = np.concatenate([xy_min, xy_max], axis=-1) + jitter
+  scores = rng.uniform(0.25, 1.0, size=(num, 1))
+  classes = rng.integers(0, FLAGS.classes, size=(num, 1))
+  return np.concatenate([coors, scores, classes], axis=-1)
+
+
+def time_fn(fn, bboxes):
+  times = []
+  for _ in range(FLAGS.repeat):
+    boxes = bboxes.copy()
+    prev_time = time.time()
+    fn(boxes, FLAGS.iou, method=FLAGS.method)
+    times.append(time.time() - prev_time)
+  return np.median(times) * 1000
+
+
+def main(_argv):
+  rng = np.random.default_rng(0)
+  for num in [10, 100, 1000]:
+    bboxes = crowd(num, rng)
+    kept_loop = len(loop_nms(bboxes.copy(), FLAGS.iou, method=FLAGS.method))
+    kept_vec = len(utils.nms(bboxes.copy(), FLAGS.iou, method=FLAGS.method))
+    loop_ms = time_fn(loop_nms, bboxes)
+    vec_ms = time_fn(utils.nms, bboxes)
+    info = "boxes: %d  kept: %d/%d  loop: %.3f ms  vectorised: %.3f ms  speedup: %.1fx" % (
+        num, kept_vec, kept_loop, loop_ms, vec_ms, loop_ms / vec_ms)
+    logging.info(info)
+    print(info)
+
+
+if __name__ == '__main__':
+  try:
+    app.run(main)
+  except SystemExit:
+    pass
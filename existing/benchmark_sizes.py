@@ -0,0 +1,82 @@
+import time
+import cv2
+import numpy as np
+from absl import app, flags, logging
+from absl.flags import FLAGS
+import core.utils as utils
+import calibration
+import detector
+
+flags.DEFINE_string('videos', './data/transforms.csv', 'transforms csv, folder or glob of recorded camera videos')
+flags.DEFINE_list('sizes', ['320', '416', '512', '608'], 'input sizes to compare, the largest is the reference for recall')
+flags.DEFINE_integer('samples', 64, 'frames sampled across cameras and times of day')
+flags.DEFINE_integer('batch', 4, 'frames per batch')
+flags.DEFINE_integer('repeat', 3, 'timed passes over the frames per size')
+flags.DEFINE_float('iou', 0.5, 'iou a person needs with a reference person to count as found')
+
+
+def run(model, frames, size):
+  prep = utils.Preprocessor(size, FLAGS.batch)
+  bboxes = []
+  for k in range(0, len(frames), FLAGS.batch):
+    bboxes.extend(detector.batch_bboxes(model, frames[k:k + FLAGS.batch], FLAGS.batch, prep))
+  return bboxes
+
+
+def recall(found, reference):
+  # greedy one to one matching of each frame's people against the reference size's people
+  hits = 0
+  total = 0
+  for det, ref in zip(found, reference):
+    det = np.asarray(det).reshape(-1, 6)
+    ref = np.asarray(ref).reshape(-1, 6)
+    total += len(ref)
+    used = np.zeros(len(det), dtype=bool)
+    for box in ref:
+      if len(det) == 0:
+        break
+      ious = utils.bboxes_iou(box[np.newaxis, :4], det[:, :4])
+      ious[used] = 0
+      j = np.argmax(ious)
+      if ious[j] >= FLAGS.iou:
+        used[j] = True
+        hits += 1
+  return hits / total if total > 0 else 1.0
+
+
+def main(_argv):
+  sizes = sorted(set(detector.align_size(int(s)) for s in FLAGS.sizes))
+  videos = calibration.find_videos(FLAGS.videos)
+  if len(videos) == 0:
+    logging.error('no videos found in {}'.format(FLAGS.videos))
+    return
+  frames, _ = calibration.read_frames(calibration.sample_plan(videos, FLAGS.samples))
+  # the preprocessor takes BGR frames, like the ones the streamers write
+  frames = [cv2.cvtColor(frame, cv2.COLOR_RGB2BGR) for frame in frames]
+  logging.info('{} frames from {} videos'.format(len(frames), len(videos)))
+
+  # one model with a traced graph per size, like a worker serving cameras of every size
+  model = detector.start_model(batch_sizes=(FLAGS.batch,), input_sizes=sizes)
+
+  results = {}
+  for size in sizes:
+    bboxes = run(model, frames[:FLAGS.batch], size)
+    start = time.perf_counter()
+    for _ in range(FLAGS.repeat):
+      bboxes = run(model, frames, size)
+    elapsed = (time.perf_counter() - start) / FLAGS.repeat
+    results[size] = (len(frames) / elapsed, bboxes)
+
+  reference = results[sizes[-1]][1]
+  print('size   frames/s   people   recall vs {}'.format(sizes[-1]))
+  for size in sizes:
+    fps, bboxes = results[size]
+    people = sum(len(b) for b in bboxes)
+    print('{:4d}   {:8.1f}   {:6d}   {:.3f}'.format(size, fps, people, recall(bboxes, reference)))
+
+
+if __name__ == '__main__':
+  try:
+    app.run(main)
+  except SystemExit:
+    pass
@@ -7,6 +7,7 @@ from core.yolov4 import YOLOv4, YOLOv3, YOLOv3_tiny, decode
 import core.utils as utils
 import os
 from core.config import cfg
+import calibration
 
 flags.DEFINE_string('weights', './data/yolov4.weights', 'path to weights file')
 flags.DEFINE_string('output', './data/yolov4.tflite', 'path to output')
@@ -14,10 +15,16 @@ flags.DEFINE_boolean('tiny', False, 'path to output')
 flags.DEFINE_integer('input_size', 416, 'path to output')
 flags.DEFINE_string('model', 'yolov4', 'yolov3 or yolov4')
 flags.DEFINE_string('quantize_mode', "int8", 'quantize mode (int8, float16, full_int8)')
-flags.DEFINE_string('dataset', "/media/user/Source/Data/coco_dataset/coco/5k.txt", 'path to dataset')
+flags.DEFINE_boolean('person_head', False, 'yolov4 only: prune the output convs to cfg.DETECT.HEAD_CLASSES')
+flags.DEFINE_string('dataset', "/media/user/Source/Data/coco_dataset/coco/5k.txt", 'path to dataset, only used without --calib')
+flags.DEFINE_string('calib', None, 'full_int8: transforms csv, folder or glob of recorded camera videos to calibrate on')
+flags.DEFINE_integer('calib_samples', calibration.SAMPLES, 'frames sampled across cameras and times of day')
+flags.DEFINE_string('calib_cache', './data/calibration', 'calibration tensors are cached here (.npy + .json)')
+flags.DEFINE_boolean('report', True, 'full_int8: report per layer quantization error and person AP drift')
 
 def representative_data_gen():
   fimage = open(FLAGS.dataset).read().split()
+  missing = 0
   for input_value in range(100):
     if os.path.exists(fimage[input_value]):
       original_image=cv2.imread(fimage[input_value])
@@ -27,7 +34,9 @@ def representative_data_gen():
       print(input_value)
       yield [img_in]
     else:
-      continue
+      missing += 1
+  if missing > 0:
+    logging.warning('{} of 100 calibration images were missing'.format(missing))
 
 def save_tflite():
   NUM_CLASS = len(utils.read_class_names(cfg.YOLO.CLASSES))
@@ -50,13 +59,16 @@ def save_tflite():
       model = tf.keras.Model(input_layer, bbox_tensors)
       utils.load_weights_v3(model, FLAGS.weights)
     elif FLAGS.model == 'yolov4':
+      head_classes = cfg.DETECT.HEAD_CLASSES if FLAGS.person_head else None
+      if head_classes is not None:
+        NUM_CLASS = len(head_classes)
       feature_maps = YOLOv4(input_layer, NUM_CLASS)
       bbox_tensors = []
       for i, fm in enumerate(feature_maps):
         bbox_tensor = decode(fm, NUM_CLASS, i)
         bbox_tensors.append(bbox_tensor)
       model = tf.keras.Model(input_layer, bbox_tensors)
-      utils.load_weights(model, FLAGS.weights)
+      utils.load_weights(model, FLAGS.weights, head_classes)
 
   model.summary()
 
@@ -75,13 +87,22 @@ def save_tflite():
     converter.optimizations = [tf.lite.Optimize.DEFAULT]
     converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
     converter.allow_custom_ops = True
-    converter.representative_dataset = representative_data_gen
+    if FLAGS.calib:
+      tensors = calibration.load_tensors(FLAGS.calib, FLAGS.input_size, FLAGS.calib_samples, cache=FLAGS.calib_cache)
+      calib_tensors, report_tensors = calibration.split(tensors)
+      converter.representative_dataset = calibration.representative_dataset(calib_tensors)
+    else:
+      converter.representative_dataset = representative_data_gen
 
   tflite_model = converter.convert()
   open(FLAGS.output, 'wb').write(tflite_model)
 
   logging.info("model saved to: {}".format(FLAGS.output))
 
+  if FLAGS.quantize_mode == 'full_int8' and FLAGS.calib and FLAGS.report:
+    calibration.layer_report(converter, report_tensors, os.path.splitext(FLAGS.output)[0] + '_layers.csv')
+    calibration.person_ap_drift(model, FLAGS.output, report_tensors)
+
 def demo():
   interpreter = tf.lite.Interpreter(model_path=FLAGS.output)
   interpreter.allocate_tensors()
@@ -1,15 +1,20 @@
 import tensorflow as tf
 from absl import app, flags, logging
 from absl.flags import FLAGS
-from core.yolov4 import YOLOv4, YOLOv3, YOLOv3_tiny, decode
+from core.yolov4 import YOLOv4, YOLOv3, YOLOv3_tiny, decode, end_to_end
+import numpy as np
 import core.utils as utils
 from core.config import cfg
+import detector
 
 flags.DEFINE_string('weights', './data/yolov4.weights', 'path to weights file')
 flags.DEFINE_string('output', './checkpoints/yolov4', 'path to output') #-416
 flags.DEFINE_boolean('tiny', False, 'is yolov3-tiny or not')
 flags.DEFINE_integer('input_size', 416, 'define input size of export model')
 flags.DEFINE_string('model', 'yolov4', 'yolov3 or yolov4')
+flags.DEFINE_boolean('end_to_end', False, 'build decoding, person filtering and nms into the exported graph')
+flags.DEFINE_integer('max_boxes', cfg.DETECT.MAX_BOXES, 'max detections per image returned by the end to end graph')
+flags.DEFINE_boolean('person_head', False, 'yolov4 only: prune the output convs to cfg.DETECT.HEAD_CLASSES')
 
 def save_tf():
   NUM_CLASS = len(utils.read_class_names(cfg.YOLO.CLASSES))
@@ -32,13 +37,26 @@ def save_tf():
       model = tf.keras.Model(input_layer, bbox_tensors)
       utils.load_weights_v3(model, FLAGS.weights)
     elif FLAGS.model == 'yolov4':
+      head_classes = cfg.DETECT.HEAD_CLASSES if FLAGS.person_head else None
+      if head_classes is not None:
+        NUM_CLASS = len(head_classes)
       feature_maps = YOLOv4(input_layer, NUM_CLASS)
       bbox_tensors = []
       for i, fm in enumerate(feature_maps):
         bbox_tensor = decode(fm, NUM_CLASS, i)
         bbox_tensors.append(bbox_tensor)
-      model = tf.keras.Model(input_layer, bbox_tensors)
-      utils.load_weights(model, FLAGS.weights)
+      utils.load_weights(tf.keras.Model(input_layer, bbox_tensors), FLAGS.weights, head_classes)
+      if FLAGS.end_to_end:
+        # extra input holds (height, width) of each original frame, output is [batch, max_boxes, 6]
+        size_layer = tf.keras.layers.Input([2])
+        # same look-alike columns as the live model, so the two heads can't drift apart
+        veto = detector.veto_columns(head_classes)
+        bboxes = end_to_end(bbox_tensors, size_layer, FLAGS.input_size, np.array(cfg.YOLO.STRIDES),
+                            utils.get_anchors(cfg.YOLO.ANCHORS), cfg.YOLO.XYSCALE, FLAGS.max_boxes,
+                            veto_classes=veto)
+        model = tf.keras.Model([input_layer, size_layer], bboxes)
+      else:
+        model = tf.keras.Model(input_layer, bbox_tensors)
     else:
       print("model option can be only 'yolov3' or 'yolov4'.")
       return
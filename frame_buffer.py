@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory ring buffer for camera frames.
+
+Each camera gets one FrameBuffer. The streamer process writes decoded frames
+into it and worker processes read NumPy views straight out of shared memory,
+so frames are never pickled or sent through a manager proxy.
+
+@author: Nikki
+"""
+
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+#header layout (int64 fields), followed by the stream stats (float64), per-slot
+#sequence numbers, per-slot capture times (float64) and finally the frame slots themselves
+_LATEST = 0
+_STATUS = 1
+_RECONNECTS = 2
+_HEADER_LEN = 3
+#time of the last frame grabbed (whether or not it was sent), decode frames per second
+_HEARTBEAT = 0
+_FPS = 1
+_STATS_LEN = 2
+
+#stream status, set by the streamer
+CONNECTING = 0
+LIVE = 1
+STALE = 2
+#seconds without a grab before a live stream is treated as stale anyway, in case the streamer hangs
+STALE_AFTER = 5.0
+
+
+###---------------------------------------------------------------------------
+#   Ring buffer of N fixed-shape frames living in one shared memory block.
+#   Sequence numbers start at 1 and increase by one for every frame written,
+#   0 means nothing has been written yet.
+#
+#   cond - optional mp.Condition notified after every write, can be shared by
+#          several buffers so readers can sleep until any camera has a new frame
+
+class FrameBuffer():
+
+    def __init__(self, shape, slots=4, dtype=np.uint8, name=None, create=True, cond=None):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+        self.cond = cond
+
+        header_bytes = 8 * _HEADER_LEN
+        stats_bytes = 8 * _STATS_LEN
+        seq_bytes = 8 * slots
+        time_bytes = 8 * slots
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        size = header_bytes + stats_bytes + seq_bytes + time_bytes + frame_bytes * slots
+
+        self._owner = create
+        if create:
+            self.shm = shared_memory.SharedMemory(create=True, size=size, name=name)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+        buf = self.shm.buf
+        offset = 0
+        self._header = np.ndarray((_HEADER_LEN,), dtype=np.int64, buffer=buf, offset=offset)
+        offset = offset + header_bytes
+        self._stats = np.ndarray((_STATS_LEN,), dtype=np.float64, buffer=buf, offset=offset)
+        offset = offset + stats_bytes
+        self._seqs = np.ndarray((slots,), dtype=np.int64, buffer=buf, offset=offset)
+        offset = offset + seq_bytes
+        self._times = np.ndarray((slots,), dtype=np.float64, buffer=buf, offset=offset)
+        offset = offset + time_bytes
+        self._frames = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=buf, offset=offset)
+
+        if create:
+            self._header[:] = 0
+            self._stats[:] = 0
+            self._seqs[:] = 0
+            self._times[:] = 0
+
+    #reattach by name when sent to another process instead of copying the block
+    def __getstate__(self):
+        return {'shape': self.shape, 'slots': self.slots, 'dtype': self.dtype.str, 'name': self.name,
+                'cond': self.cond}
+
+    def __setstate__(self, state):
+        self.__init__(state['shape'], state['slots'], state['dtype'], state['name'], create=False,
+                      cond=state['cond'])
+
+    @property
+    def seq(self):
+        return int(self._header[_LATEST])
+
+    ###-----------------------------------------------------------------------
+    #   Stream health, written by the streamer and read by anyone
+    
+    @property
+    def status(self):
+        return int(self._header[_STATUS])
+
+    def set_status(self, status):
+        if status == CONNECTING and self.status != CONNECTING:
+            self._header[_RECONNECTS] += 1
+        self._header[_STATUS] = status
+
+    @property
+    def reconnects(self):
+        return int(self._header[_RECONNECTS])
+
+    #marks that the stream is still producing frames
+    def beat(self, timestamp=None):
+        self._stats[_HEARTBEAT] = time.time() if timestamp is None else timestamp
+
+    @property
+    def fps(self):
+        return float(self._stats[_FPS])
+
+    def set_fps(self, fps):
+        self._stats[_FPS] = fps
+
+    #whether frames in the buffer are current, i.e. the stream is connected and still grabbing
+    def live(self, max_age=STALE_AFTER, now=None):
+        if now is None:
+            now = time.time()
+        return self.status == LIVE and now - self._stats[_HEARTBEAT] < max_age
+
+    def health(self):
+        return {'status': ['connecting', 'live', 'stale'][self.status], 'live': self.live(),
+                'fps': self.fps, 'reconnects': self.reconnects, 'seq': self.seq,
+                'age': time.time() - float(self._stats[_HEARTBEAT])}
+
+    ###-----------------------------------------------------------------------
+    #   Copies frame into the next slot and publishes it
+    #
+    #   returns - seq - sequence number assigned to the frame
+
+    def write(self, frame, timestamp=None):
+        if frame.shape != self.shape:
+            raise ValueError('Frame shape ' + str(frame.shape) + ' does not match buffer shape ' + str(self.shape))
+        if timestamp is None:
+            timestamp = time.time()
+
+        seq = self.seq + 1
+        slot = seq % self.slots
+
+        #mark slot as being written so readers don't pick up a torn frame
+        self._seqs[slot] = -1
+        np.copyto(self._frames[slot], frame)
+        self._times[slot] = timestamp
+        self._seqs[slot] = seq
+        self._header[_LATEST] = seq
+        
+        if self.cond is not None:
+            with self.cond:
+                self.cond.notify_all()
+        return seq
+
+    ###-----------------------------------------------------------------------
+    #   Blocks until a frame newer than seq has been written, needs cond
+    #
+    #   returns - True if there is a newer frame, False on timeout
+
+    def wait(self, seq, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.seq > seq, timeout)
+
+    ###-----------------------------------------------------------------------
+    #   Returns the most recent frame as a view into shared memory. The view stays
+    #   valid until the writer wraps around the ring (slots - 1 frames later), so
+    #   pass copy=True if it needs to be held longer than that.
+    #
+    #   returns - seq, timestamp, frame (seq is 0 and frame None if nothing written yet)
+
+    def latest(self, copy=False):
+        while True:
+            seq = self.seq
+            if seq == 0:
+                return 0, None, None
+            got = self.get(seq, copy)
+            if got is not None:
+                return seq, got[0], got[1]
+
+    ###-----------------------------------------------------------------------
+    #   Returns a specific frame if it is still in the ring
+    #
+    #   returns - (timestamp, frame) or None if it has been overwritten
+
+    def get(self, seq, copy=False):
+        if seq <= 0:
+            return None
+        slot = seq % self.slots
+        if self._seqs[slot] != seq:
+            return None
+        timestamp = float(self._times[slot])
+        frame = self._frames[slot]
+        if copy:
+            frame = frame.copy()
+        #check again in case the writer lapped us while copying
+        if self._seqs[slot] != seq:
+            return None
+        return timestamp, frame
+
+    def close(self):
+        #drop views before releasing the mapping
+        self._header = self._stats = self._seqs = self._times = self._frames = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
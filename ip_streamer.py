@@ -6,11 +6,46 @@ Created on Fri Jul 10 15:11:48 2020
 """
 
 import cv2
-import datetime
+import os
 import sys
+import json
 import multiprocessing as mp
 import time
-from ctypes import c_bool
+import numpy as np
+import frame_buffer
+from frame_buffer import FrameBuffer
+from av_capture import AVCapture
+import tracing
+
+#default sampling, can be overridden per camera (see SamplingPolicy.from_options)
+#max frames per second sent for analysis, None for every frame
+TARGET_FPS = None
+#mean abs difference (0-255) from the last frame sent needed to send another, None to send regardless of motion
+MOTION_THRESH = None
+#seconds after which a frame is sent even if nothing moved, so analytics keep ticking over
+KEEPALIVE = 30.0
+#width frames are shrunk to before scoring motion
+MOTION_WIDTH = 64
+#how much the send interval grows when workers didn't pick up the last frame, and shrinks when they did
+BACKOFF = 1.5
+RECOVER = 0.9
+#longest the adaptive interval can grow to
+MAX_INTERVAL = 2.0
+
+#seconds to wait before reconnecting a dropped stream, doubling on every failed attempt up to MAX_RECONNECT_DELAY
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 60.0
+#a connection that lasted this long resets the reconnect delay
+STABLE_AFTER = 10.0
+#grabs in a row with the stream position stuck before the stream is treated as frozen
+FROZEN_GRABS = 100
+#seconds between decode fps updates
+FPS_WINDOW = 1.0
+#frame size of every camera the last time it was probed, so one that is offline at startup
+#can still get a buffer and be brought up by the reconnect loop
+SIZE_CACHE = './data/frame_sizes.json'
+#(height, width) assumed for an offline camera that has never been probed and has no frame_size option
+DEFAULT_FRAME_SIZE = (1080, 1920)
 
 #ip streams
 #multiple video cap objsects
@@ -21,73 +56,327 @@ from ctypes import c_bool
 #need to check that frame grabbed exists and hasn't already been processed
 def main():
     ips = ['C:/Users/Nikki/Documents/work/inputs-outputs/video/AOTsample1_1.mp4','C:/Users/Nikki/Documents/work/inputs-outputs/video/AOTsample2_1.mp4']
-    m = mp.Manager()
-    updated = m.Value(c_bool, False)
-    frames = m.list([None] * len(ips))
-    times = m.list([None] * len(ips))
 
-    #lock = manager.Lock()
-    #start_lock = manager.Lock()
+    #one shared memory ring buffer per camera, sized from the first frame of each stream
+    #streamers notify cond after every frame so the display loop can sleep until there's something new
+    cond = mp.Condition()
+    bufs = [FrameBuffer(probe_shape(ip), cond=cond) for ip in ips]
+    stop = mp.Event()
+
     streamers = []
     try:
         for i, ip in enumerate(ips):
-            streamers.append(mp.Process(target=stream_all, args=(frames, times, ip, updated, i)))
+            streamers.append(mp.Process(target=stream_all, args=(bufs[i], ip, i, stop)))
         for streamer in streamers:
             streamer.start()
             
-        while updated.value == False:
-            continue
-        
+        shown = [0] * len(bufs)
         while True:
-            for i in range(len(ips)):
-                cv2.namedWindow("result" + str(i), cv2.WINDOW_NORMAL)
-                cv2.imshow("result" + str(i), frames[i])
+            with cond:
+                cond.wait_for(lambda: any(buf.seq > s for buf, s in zip(bufs, shown)), timeout=0.5)
+            for i, buf in enumerate(bufs):
+                seq, _, frame = buf.latest()
+                if seq > shown[i]:
+                    shown[i] = seq
+                    cv2.namedWindow("result" + str(i), cv2.WINDOW_NORMAL)
+                    cv2.imshow("result" + str(i), frame)
             if cv2.waitKey(1) & 0xFF == ord('q'): break
     except:
         print('Unexpected error: ', sys.exc_info())
-        for streamer in streamers:
+    stop.set()
+    for streamer in streamers:
+        streamer.join(1.0)
+        if streamer.is_alive():
             streamer.terminate()
-        cv2.destroyAllWindows()
+    cv2.destroyAllWindows()
+    for buf in bufs:
+        buf.close()
 
 
-def stream_all(frames, times, ip, updated, i):
-    #list of ip addresses to get video from
-    stream = open_cap(ip)
-    # frames = [None] * len(ips)
-    # times = [None] * len(ips)
-    print(frames[i])
-    print(times[i])
-    print(stream)
-    get_cap(stream, frames, times, i)
+###---------------------------------------------------------------------------
+#   Streams ip into buf until stop is set. Whenever the stream drops, returns no
+#   frame or freezes, the camera is marked stale so workers skip it, and the
+#   capture is reopened with exponential backoff.
+#
+#   claimed - shared array of the last seq workers took from each camera, lets
+#             the sampling policy back off when they fall behind
+#   options - per camera settings from the transforms csv, see SamplingPolicy.from_options
 
-    updated.value = True
-    try:
-        while(True):
-            get_cap(stream, frames, times, i)
-            updated.value = True
-           
+def stream_all(buf, ip, cam=None, stop=None, claimed=None, options=None):
+    tracer = tracing.get_tracer('streamer ' + str(cam))
+    policy = SamplingPolicy.from_options(options)
+    delay = RECONNECT_DELAY
+
+    while stop is None or not stop.is_set():
+        buf.set_status(frame_buffer.CONNECTING)
+        stream = None
+        opened = time.time()
+        try:
+            stream = open_cap(ip, options)
+            if not stream.isOpened():
+                raise IOError('Could not open ' + str(ip))
+            health = StreamHealth(buf)
+            while stop is None or not stop.is_set():
+                with tracer.stage('capture', cam):
+                    sent = sample_cap(stream, buf, policy, backlog(buf, claimed, cam), health)
+                if sent == 0:
+                    tracer.count('frames_skipped')
+                elif sent < 0:
+                    tracer.count('frames_still')
+                tracer.gauge('decode_fps', buf.fps)
+                tracer.maybe_report()
+        except Exception:
+            print('Stream ' + str(cam) + ' lost:', sys.exc_info()[1])
+        finally:
+            if stream is not None:
+                close_cap(stream)
         
-            # cv2.namedWindow("result" + str(i), cv2.WINDOW_NORMAL)
-            # cv2.imshow("result" + str(i), frames[i])
-            # if cv2.waitKey(1) & 0xFF == ord('q'): break
-    except:
-        print("Unexpected error:", sys.exc_info()[0])
-        close_cap(stream)
-        cv2.destroyAllWindows()
+        buf.set_status(frame_buffer.STALE)
+        buf.set_fps(0)
+        if stop is not None and stop.is_set():
+            break
+        tracer.count('reconnects')
+        if time.time() - opened >= STABLE_AFTER:
+            delay = RECONNECT_DELAY
+        print('Reconnecting stream ' + str(cam) + ' in ' + str(delay) + 's')
+        if stop is None:
+            time.sleep(delay)
+        elif stop.wait(delay):
+            break
+        delay = min(delay * 2, MAX_RECONNECT_DELAY)
     return
     
-#opens video capture objects for all input streams  
-def open_cap(ip):
+#opens a video capture object for an input stream
+#options - camera options, backend=pyav decodes through FFmpeg (see av_capture), default is opencv
+def open_cap(ip, options=None):
     print("Video from: ", ip)
-    stream = cv2.VideoCapture(ip)
+    if options is not None and options.get('backend') == 'pyav':
+        stream = AVCapture(ip, width=options.get('width'), keyframes=options.get('keyframes', False),
+                           threads=options.get('threads', 0))
+    else:
+        stream = cv2.VideoCapture(ip)
     print ("Capture opened")
     return stream
 
-#gets the next frame from each video capture object
-#at some point should read this directly into shared memory
-def get_cap(stream, frames, times, i):
-    times[i] = datetime.datetime.now()
-    ret_val, frames[i] = stream.read()
+#reads one frame to find the shape of the stream, used to size its frame buffer
+def probe_shape(ip, options=None):
+    return probe(ip, options)[0]
+
+#returns - shape of the frames the capture outputs, and the stream's native (height, width),
+#          which differ when the backend scales frames down while decoding
+def probe(ip, options=None):
+    stream = open_cap(ip, options)
+    ret_val, frame = stream.read()
+    native = getattr(stream, 'native_size', frame.shape[:2] if ret_val else None)
+    stream.release()
+    if not ret_val:
+        raise IOError('Could not read a frame from ' + str(ip))
+    remember_size(ip, frame.shape, native)
+    return frame.shape, native
+
+###---------------------------------------------------------------------------
+#   Same as probe, but a camera that can't be read right now gets the frame size
+#   from its frame_size=[height, width] option, or else the size it had the last
+#   time it was probed, or else DEFAULT_FRAME_SIZE. Its streamer keeps trying to
+#   connect as usual, and frames are resized to the buffer if the guess was wrong.
+#
+#   returns - shape, native, and whether the camera was actually read
+
+def probe_or_fallback(ip, options=None):
+    try:
+        shape, native = probe(ip, options)
+        return shape, native, True
+    except Exception as e:
+        error = e
+    if options is not None and options.get('frame_size') is not None:
+        height, width = options['frame_size'][:2]
+        shape, native = (height, width, 3), None
+    else:
+        known = read_sizes().get(str(ip))
+        if known is None:
+            print('Frame size of ' + str(ip) + ' is unknown, guessing ' + str(DEFAULT_FRAME_SIZE)
+                  + '. Set frame_size=[height, width] in its options if its transforms look wrong')
+            known = {'shape': list(DEFAULT_FRAME_SIZE) + [3], 'native': None}
+        shape, native = tuple(known['shape']), known['native']
+    print('Could not read ' + str(ip) + ' (' + str(error) + '), starting it offline with '
+          + str(shape[:2]) + ' frames')
+    return shape, native, False
+
+#last probed sizes, {ip: {'shape': [h, w, 3], 'native': [h, w]}}
+def read_sizes(path=None):
+    if path is None:
+        path = SIZE_CACHE
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def remember_size(ip, shape, native, path=None):
+    if path is None:
+        path = SIZE_CACHE
+    sizes = read_sizes(path)
+    entry = {'shape': list(shape), 'native': None if native is None else list(native[:2])}
+    if sizes.get(str(ip)) == entry:
+        return
+    sizes[str(ip)] = entry
+    try:
+        tmp = path + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(sizes, f)
+        os.replace(tmp, path)
+    except IOError:
+        print('Could not save frame size of ' + str(ip) + ' to ' + path)
+
+#gets the next frame from the video capture object and writes it into shared memory
+def get_cap(stream, buf):
+    timestamp = time.time()
+    ret_val, frame = stream.read()
+    if not ret_val:
+        raise IOError('Stream returned no frame')
+    return buf.write(frame, timestamp)
+
+###---------------------------------------------------------------------------
+#   Grabs the next frame and only retrieves and publishes it if the policy wants it.
+#   Skipped frames are grabbed without being retrieved. With opencv's FFmpeg backend
+#   grab() still decodes the frame, so skipping only saves the colour conversion and
+#   the copy into shared memory. To cut decoding itself use backend=pyav with
+#   keyframes=True (see av_capture), which drops non-keyframes before decoding.
+#
+#   returns - seq of the frame written, 0 if it was skipped on rate, -1 if it
+#             was decoded but had too little motion to send
+
+def sample_cap(stream, buf, policy, backlogged=False, health=None):
+    timestamp = time.time()
+    if not stream.grab():
+        raise IOError('Stream returned no frame')
+    if health is not None:
+        health.grabbed(stream, timestamp)
+    if not policy.due(timestamp, backlogged):
+        return 0
+    ret_val, frame = stream.retrieve()
+    if not ret_val:
+        raise IOError('Stream returned no frame')
+    if not policy.moved(frame, timestamp):
+        return -1
+    #a camera started offline may come up at another size than its buffer was made for
+    if frame.shape != buf.shape:
+        frame = cv2.resize(frame, (buf.shape[1], buf.shape[0]), interpolation=cv2.INTER_AREA)
+    return buf.write(frame, timestamp)
+
+#whether workers have yet to take the last frame written to buf
+def backlog(buf, claimed, cam):
+    if claimed is None or cam is None:
+        return False
+    return buf.seq > claimed[cam]
+
+
+###---------------------------------------------------------------------------
+#   Decides which frames a streamer retrieves and sends for analysis
+#
+#   target_fps - max frames per second to send, None for every frame
+#   adaptive - stretch the interval between frames while workers are behind
+#   motion_thresh - only send frames that differ from the last one sent by at
+#                   least this much (mean abs difference of a small grey copy)
+#   keepalive - send a frame at least this often even if nothing moves
+
+class SamplingPolicy():
+    
+    def __init__(self, target_fps=TARGET_FPS, adaptive=True, motion_thresh=MOTION_THRESH,
+                 keepalive=KEEPALIVE, motion_width=MOTION_WIDTH):
+        self.min_interval = 1.0 / target_fps if target_fps else 0.0
+        self.interval = self.min_interval
+        self.adaptive = adaptive
+        self.motion_thresh = motion_thresh
+        self.keepalive = keepalive
+        self.motion_width = motion_width
+        self.next_time = 0
+        self.last_sent = 0
+        self.prev = None
+        
+    ###-----------------------------------------------------------------------
+    #   Builds a policy from a camera's options, falling back to the module defaults
+    #   for anything not given, e.g. fps=5, motion=4, keepalive=60, adaptive=False
+    
+    @classmethod
+    def from_options(cls, options=None):
+        if options is None:
+            options = {}
+        return cls(target_fps=options.get('fps', TARGET_FPS),
+                   adaptive=options.get('adaptive', True),
+                   motion_thresh=options.get('motion', MOTION_THRESH),
+                   keepalive=options.get('keepalive', KEEPALIVE))
+    
+    ###-----------------------------------------------------------------------
+    #   Whether the frame grabbed at now should be retrieved
+    #
+    #   backlogged - workers haven't taken the last frame sent yet
+    
+    def due(self, now, backlogged=False):
+        if now < self.next_time:
+            return False
+        if self.adaptive:
+            if backlogged:
+                self.interval = min(max(self.interval, 0.01) * BACKOFF, MAX_INTERVAL)
+            else:
+                self.interval = max(self.interval * RECOVER, self.min_interval)
+        self.next_time = now + self.interval
+        return True
+    
+    ###-----------------------------------------------------------------------
+    #   Whether frame has changed enough since the last frame sent to be worth running
+    
+    def moved(self, frame, now):
+        if self.motion_thresh is None:
+            return True
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, (self.motion_width, max(1, h * self.motion_width // w)),
+                           interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        #compared against the last frame sent rather than the last one seen, so slow changes still add up
+        if self.prev is not None and now - self.last_sent < self.keepalive:
+            score = np.mean(cv2.absdiff(small, self.prev))
+            if score < self.motion_thresh:
+                return False
+        self.prev = small
+        self.last_sent = now
+        return True
+
+###---------------------------------------------------------------------------
+#   Keeps a camera's health fields in its frame buffer up to date, and catches
+#   streams that keep returning frames without the stream position moving
+
+class StreamHealth():
+    
+    def __init__(self, buf):
+        self.buf = buf
+        self.grabs = 0
+        self.window_start = time.time()
+        self.pos = None
+        self.stuck = 0
+        self.advancing = False
+        buf.beat(self.window_start)
+        buf.set_status(frame_buffer.LIVE)
+        
+    def grabbed(self, stream, now):
+        self.buf.beat(now)
+        self.grabs += 1
+        if now - self.window_start >= FPS_WINDOW:
+            self.buf.set_fps(self.grabs / (now - self.window_start))
+            self.grabs = 0
+            self.window_start = now
+        
+        #only trusted once the position has been seen to move, some sources always report 0
+        pos = stream.get(cv2.CAP_PROP_POS_MSEC)
+        if pos == self.pos:
+            self.stuck += 1
+            if self.advancing and self.stuck >= FROZEN_GRABS:
+                raise IOError('Stream frozen at ' + str(pos) + 'ms')
+        else:
+            self.advancing = self.advancing or self.pos is not None
+            self.stuck = 0
+            self.pos = pos
 
 #closes all video capture objects
 def close_cap(stream):
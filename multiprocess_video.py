@@ -13,8 +13,10 @@ import multiprocessing as mp
 import ip_streamer
 import cv2
 import sys
+import queue
 import numpy as np
 import time
+import datetime
 from ctypes import c_bool
 import scipy.spatial
 
@@ -26,18 +28,36 @@ import transform as tform
 import csv
 import ast
 import analyze_data as adat
-
-
-
-
-
-def main(errs, ocpts, dists, updated, frames, times, avgs, avg_lock, i_lock, ind,out_q, bbox_q, image_q):
+from frame_buffer import FrameBuffer
+import supervisor
+import worker_pool
+import subscribers
+import record_writer
+import tracing
+import tiling
+
+#max number of frames, across all cameras, run through the model at once
+BATCH_SIZE = 4
+#max time in seconds a partial batch waits for more frames before being run anyway
+MAX_WAIT = 0.05
+#how long workers sleep between checks for new frames, only used if the frame buffers have no condition to wait on
+POLL_INTERVAL = 0.002
+#max time in seconds blocking waits go before checking whether the pipeline is stopping
+IDLE_TIMEOUT = 0.5
+#also write each camera's records to a binary log with the points as floats, see record_writer.read_log
+BINARY_LOG = False
+
+
+
+def main(errs, ocpts, dists, avgs, avg_lock, i_lock, ind,out_q, bbox_q, image_q, stop=None, subs=None):
 # def main():
     #uncomment to verify that GPU is being used
     tf.debugging.set_log_device_placement(False)
+    #set to shut every process down cleanly
+    if stop is None:
+        stop = mp.Event()
     # importlib.reload(mp)
     ips = []
-    vids = np.array([[]])
     
     # file containing camera information
     transform_f = 'C:/Users/Nikki/Documents/work/inputs-outputs/transforms.csv'
@@ -48,7 +68,7 @@ def main(errs, ocpts, dists, updated, frames, times, avgs, avg_lock, i_lock, ind
     
     
     #create VidObjs to store information about each camera
-    vids = initialize_cams(transform_f, ips, vids)
+    vids = initialize_cams(transform_f, ips)
     
     num_cams = len(vids)
     #length of queues, kinda arbitrary - this is the number that will be used for moving avg analytics
@@ -74,9 +94,6 @@ def main(errs, ocpts, dists, updated, frames, times, avgs, avg_lock, i_lock, ind
     # manager = mp.Manager()
     # print('MP manager created')
     # #  create manager to handle shared variables across processes
-    # updated = manager.Value(c_bool, False)
-    # frames = manager.list([None]* num_cams)
-    # times = manager.list([None]* num_cams)
     # avgs = manager.list([None] * 5)
     # avg_lock = manager.Lock()
     # i_lock = manager.Lock()
@@ -102,112 +119,85 @@ def main(errs, ocpts, dists, updated, frames, times, avgs, avg_lock, i_lock, ind
 
     #stores frame data that has been transfered to GPU
     GPU_LIST = []#[0]
-    # workers = setup_gpus(vids, gpu_list = GPU_LIST)
+    #one model replica per gpu, or as many CPU replicas as the cores allow
+    replicas = worker_pool.plan(gpu_list = GPU_LIST)
+    print('Worker replicas: ', replicas)
     #start model
     # model = detector.start_model()
-    streamers = []
+    #locks the streamers and workers share: 'frames' is notified by the streamers after every
+    #frame so workers can sleep until there is work, 'claim' guards the claimed array.
+    #i_lock isn't used for claiming anymore, a manager lock can't be replaced if its holder dies
+    shared = {'frames': mp.Condition(), 'claim': mp.Lock()}
+    bufs = []
+    
+    #the supervisor swaps in new ones if a child dies holding one, and restarts everyone
+    #sharing them, the buffers carry the condition to the streamers and workers
+    def reset_locks():
+        shared['frames'] = mp.Condition()
+        shared['claim'] = mp.Lock()
+        for buf in bufs:
+            buf.cond = shared['frames']
+    sup = supervisor.Supervisor(stop, locks=lambda: [shared['claim'], shared['frames']], reset=reset_locks)
 
     try:
-        #grab video frames in separate process
+        #shared memory ring buffer per camera, frames are written here by the streamers
+        #and read in place by the workers
+        #also assigns the frame size of each stream, rescaling its homographies if the
+        #capture backend shrinks frames while decoding
+        #cameras that are offline right now start with their last known size, workers skip
+        #them until their streamers manage to connect
+        natives = []
         for i, ip in enumerate(ips):
-            streamer = mp.Process(target=ip_streamer.stream_all, args=(frames, times, ip, updated, i))
-            streamers.append(streamer)
-        for streamer in streamers:
-            streamer.daemon = True
-            
-            streamer.start()
-            print('Streamer processes started')
-        # analysis = mp.Process(target=adat.main, args=(all_output_stats, buf_num, avgs, removed))
-        analysis = mp.Process(target=adat.main, args=(out_q, buf_num, num_cams, avgs, avg_lock, errs, ocpts, dists)) 
-        analysis.daemon = True
-        analysis.start()
-        print('Analysis process started')
-        
-        
-            
-        errs[0][0] = 4
-        #wait until frames are starting to be read
-        while(not updated.value):   
-            continue
-        errs[0][0] = 5
-        time.sleep(2)
-        #find and assign the frame size of each stream
-        #TODO may have to resize frames or something for running through the model in batches
-        for i, vid in enumerate(vids):
-            #TODO coould make a set_size function for easier use
-            vid[7] = (frames[i].shape[:2])
-        prev_time = time.time()
-        
-        work_processes = []
-        logic_gpus = False
-        #need better gpu setup probably
-        if logic_gpus:
-            p_devices = tf.config.list_physical_devices('GPU')
-            gpu = p_devices[0]
-            #gtx 770 has 2048 mb total
-            tf.config.set_logical_device_configuration(gpu,[tf.config.LogicalDeviceConfiguration(memory_limit=100),
-                                                            tf.config.experimental.VirtualDeviceConfiguration(memory_limit=100),
-                                                            tf.config.experimental.VirtualDeviceConfiguration(memory_limit=100)])
-            logical_devices = tf.config.list_logical_devices('GPU')
-            print("Simulated GPUS: ", len(logical_devices))
-            # print(logical_devices)
-            # print(type(logical_devices[0]))
-            
+            shape, native, _ = ip_streamer.probe_or_fallback(ip, vids[i].options)
+            bufs.append(FrameBuffer(shape, cond=shared['frames']))
+            vids[i].set_size(shape[:2], native)
+            natives.append(native)
             
-            for gpu in logical_devices:
-                work_processes.append(mp.Process(target=proc_video, args=(ind, i_lock,frames, times, bbox_q, vids, gpu)))
-        else: 
-            if len(GPU_LIST) > 0:
-                for gpu in GPU_LIST:
-                    work_processes.append(mp.Process(target=proc_video, args=(ind, i_lock,frames,times,bbox_q, vids, gpu)))
-            else:
-                work_processes.append(mp.Process(target=proc_video, args=(ind, i_lock,frames,times,bbox_q, vids, gpu)))
-        for proc in work_processes:
-            proc.daemon = True
-            proc.start()
-        print('Worker processes started') 
-        
-        post_proc = mp.Process(target=post_processor, args=(bbox_q, vids, out_q, frames, times, image_q))
-        post_proc.daemon = True
-        post_proc.start()
-        print('Post process started')    
-        #make this main process be responsible for saving at intervals
-        
-        #itereate through frames with a shared ind 
+        #last sequence number claimed from each camera, shared between all workers
+        #streamers also read it to back off when the workers fall behind
+        claimed = mp.Array('q', num_cams, lock=False)
         
+        #grab video frames in separate process
+        for i, ip in enumerate(ips):
+            sup.add('streamer ' + str(i), ip_streamer.stream_all, (bufs[i], ip, i, stop, claimed, vids[i].options),
+                    shares_locks=True)
+        # analysis = mp.Process(target=adat.main, args=(all_output_stats, buf_num, avgs, removed))
+        sup.add('analysis', adat.main, (out_q, buf_num, num_cams, avgs, avg_lock, errs, ocpts, dists, stop))
         
-        #make a function that does this
-        #make a process for every worker
-        #every wr=orker will constantly eb running this
-        #needs an overarching queue or pointer o correct location in list to process
+        #model input size each camera runs at, size=N in its csv options, rounded to a usable size
+        input_sizes = [detector.align_size(vid.options.get('size', detector.INPUT_SIZE)) for vid in vids]
+        #cameras with a calibrated roi only run that region, split into tiles if they ask for it
+        tilings = [tiling.from_options(vid.options, vid.frame_size, native, size)
+                   for vid, native, size in zip(vids, natives, input_sizes)]
+        for vid, tiles, size in zip(vids, tilings, input_sizes):
+            if tiles is not None:
+                print(vid.name + ': ' + str(tiles) + ', ' + str(tiles.model_pixels(size)) + ' model pixels per frame')
+        for replica in replicas:
+            #args are built at every start, so a restarted worker gets the current claim lock
+            args = lambda replica=replica: (ind, shared['claim'], claimed, bufs, bbox_q, replica, stop,
+                                            input_sizes, tilings)
+            sup.add('worker ' + replica.name, proc_video, args, shares_locks=True)
         
-        #continuously loop until keyboard interrupt
+        sup.add('post processor', post_processor, (bbox_q, vids, out_q, bufs, image_q, stop, subs))
+        sup.start()
         
-        while(True):
-            continue
-            # with s_lock:
-            #     print(sample)
+        #blocks until stop is set, restarting any child process that dies
+        sup.run()
     #         curr_time = time.time()
             
     #         # save outputs every 5 minutes
     #         if (curr_time - prev_time) > (5 * 60):
-    #             save_files(vids)
+    #             save_files(writer)
     #             prev_time = curr_time
             
-  
     except:
         print("Unexpected error:", sys.exc_info())
-        cv2.destroyAllWindows()
-            
-        for streamer in streamers:
-            streamer.terminate()
-            
-        analysis.terminate()
-        
-        for proc in work_processes:
-            proc.terminate()
-            
-        post_proc.terminate()
+    
+    #stop everything, letting children exit cleanly before terminating them
+    sup.shutdown()
+    cv2.destroyAllWindows()
+    for buf in bufs:
+        buf.close()
     return
 
 ###---------------------------------------------------------------------------
@@ -215,12 +205,8 @@ def main(errs, ocpts, dists, updated, frames, times, avgs, avg_lock, i_lock, ind
           
 def outpt_frame(result, vid):
 
-    frame_dir = vid[5]
-    count = vid[6]
-    
-
-    cv2.imwrite(frame_dir + str(count) + '.jpg', result)
-    count = count + 1
+    cv2.imwrite(vid.frame_dir + str(vid.count) + '.jpg', result)
+    vid.count += 1
   
     
 ###---------------------------------------------------------------------------
@@ -234,60 +220,76 @@ def show_frame(result, i):
         
 
 ###---------------------------------------------------------------------------
-#   Overlays ellipses, bboxes, stats on frame
- 
-def prep_frame(ftpts, frame, vid, errors, occupants, bboxes):
+#   Reads frame seq out of a camera's ring buffer, downscaled to width if given
+#
+#   returns - frame, or None if it has already been overwritten
+
+def get_frame(buf, seq, width=None):
+    if width is None or width >= buf.shape[1]:
+        got = buf.get(seq, copy=True)
+        return None if got is None else got[1]
+    
+    got = buf.get(seq)
+    if got is None:
+        return None
+    h, w = buf.shape[:2]
+    frame = cv2.resize(got[1], (width, int(round(h * width / w))), interpolation=cv2.INTER_AREA)
+    #resized straight out of shared memory, check the writer didn't lap us meanwhile
+    if buf.get(seq) is None:
+        return None
+    return frame
 
-    pix_real = vid[2]
-    real_pix = vid[3]
-    origin = vid[4] 
+###---------------------------------------------------------------------------
+#   Overlays ellipses, bboxes, stats on frame, which may be a downscaled copy
+ 
+def prep_frame(ftpts, frame, vid, errors, occupants, bboxes, realpts=None, nn_dist=None):
 
-    frame_size = vid[7]
-    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    #detections are in full size frame coords
+    scale = frame.shape[1] / vid.frame_size[1]
 
+    #everything is drawn straight onto the BGR frame, no colour conversions or full frame copies
     if len(bboxes) > 0:
+        if scale != 1:
+            bboxes = np.array(bboxes, dtype=np.float64)
+            bboxes[:, :4] *= scale
         frame = utils.draw_bbox(frame, bboxes, show_label = False)
-        frame, x = pr.draw_radius(frame, ftpts, real_pix, pix_real, origin)
-    utils.overlay_occupancy(frame, errors, occupants, frame_size)
-    result = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        frame, x = pr.draw_radius(frame, ftpts, vid.real_pix, vid.pix_real, vid.origin, realpts, nn_dist, scale)
+    utils.overlay_occupancy(frame, errors, occupants, frame.shape[:2], scale)
 
-    return result
+    return frame
 
 
 
 ###---------------------------------------------------------------------------
-#   Closes and reopens csvfiles to save them
+#   Writes out every record buffered so far
    
-def save_files(vids):
-    # filename = vid[0]
-    # frame_save = vid[1]
-    # pix_real = vid[2]
-    # real_pix = vid[3]
-    # origin = vid[4] 
-    # frame_dir = vid[5]
-    # count = vid[6]
-    # frame_size = vid[7]
-    for vid in vids:
-        vid.base_f.close()
-        vid.base_f = open(vid.filename, 'a', newline='')
-        vid.csvfile = csv.writer(vid.base_f)
-        print('Saved')
+def save_files(writer):
+    writer.flush()
+    print('Saved')
 
 
 ###---------------------------------------------------------------------------
 #   Creates VidObjs from addresses listed in csvfile
+#
+#   rows are address, pix_real, real_pix, then optionally any number of
+#   key=value camera options, e.g. fps=5 or motion=4 (see ip_streamer.SamplingPolicy)
+#   or backend=pyav width=640 (see av_capture), size=320 sets the model input size,
+#   roi=[[x, y], ...] and tile=True crop and tile the frames (see tiling),
+#   frame_size=[height, width] for cameras that may be offline at startup
+#   ips - filled with the address of every camera that initialized, in the same order as the returned vids
    
-def initialize_cams(transform_f, ips, vids):
+def initialize_cams(transform_f, ips):
+    vids = []
     with open(transform_f, newline='') as csvfile:
         reader = csv.reader(csvfile)
         for i, row in enumerate(reader):
             try:
                 vid_path = row[0]
-                ips.append(vid_path)
                 pixr = row[1]
                 pix_real = ast.literal_eval(pixr)
                 realp = row[2]
                 real_pix = ast.literal_eval(realp)
+                options = parse_options(row[3:])
             
                 # pix_real = np.array(pix_real)
                 if vid_path[:3] == 'C:/':
@@ -303,10 +305,11 @@ def initialize_cams(transform_f, ips, vids):
                     name = extended[0]
                     print('IP cam ' + str(i +1) + ' path recognized: ' + name)
                 else:
-                    print('Invalid camera name')
+                    raise ValueError('Invalid camera name')
                 
-                cur_vid = fill_vid_array(name, pix_real, real_pix, save = False)
-                vids = np.append(vids,cur_vid) #True))
+                vids.append(VidObj(name, pix_real, real_pix, save = False, options = options))
+                #only added once the camera is set up, so ips and vids stay lined up
+                ips.append(vid_path)
                 print('Cam ' + str(i + 1) + ' initialized')
                 print()
                 
@@ -314,54 +317,56 @@ def initialize_cams(transform_f, ips, vids):
                 print('Cam ' + str(i + 1) + ' FAILED initialization')
                 print()
                 
-    size = np.size(vids)
-    cols = 8
-    rows = size//cols
-    
-    vids = np.reshape(vids, [rows, cols])        
     return vids
-###---------------------------------------------------------------------------
-#       
 
-def setup_gpus(vids, num = 0,  gpu_list = []):
-    
-    workers = []
-   
-    #load gpus from a list of numbers
-    for a in gpu_list:
-        workers.append(Worker(a, vids))
-        
-    #or load gpus starting at zero to a number
-    for i in range(num):
-        workers.append(Worker(i, vids))
-        
-    return workers
-    #set up a model on each gpu
-    #return a list of gpu workers
+#turns key=value csv cells into a dict, values are read as python literals where possible
+def parse_options(cells):
+    options = {}
+    for cell in cells:
+        if cell.strip() == '':
+            continue
+        key, value = cell.split('=', 1)
+        try:
+            value = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            value = value.strip()
+        options[key.strip()] = value
+    return options
 ###---------------------------------------------------------------------------
-#  
+#   One model replica running in a worker process
+#
+#   replica - worker_pool.Replica, or just a gpu number, a device
+#             string, or None for the CPU with tensorflow's default threading
+#   input_sizes - input sizes the cameras want, graphs are traced for each
 
 class Worker():
-    # def __init__(self,i,vids):
-    def __init__(self, i):
+    def __init__(self, replica=None, input_sizes=None):
         #whether gpu is available
         self.avail = True
-        # self.vids = vids
-        
-        #what gpu this worker is on
         
-        if isinstance(i, int):
-            self.gpu = "/gpu:" + str(i)            
-        elif isinstance(i, str):
-            self.gpu = i
-        elif i is None:
-            self.gpu = None
+        #what device this worker is on
+        if isinstance(replica, worker_pool.Replica):
+            #thread limits and gpu visibility have to be set before the model is built
+            device = replica.configure()
+        elif isinstance(replica, int):
+            device = "/gpu:" + str(replica)
+        elif isinstance(replica, str) or replica is None:
+            device = replica
         else:
             raise ValueError('The gpu is not properly setup, and the CPU is not working')
+        #CPU replicas run the model without a device scope, same as the default
+        if device is not None and device.lower().startswith('/cpu'):
+            device = None
+        self.gpu = device
             
-        #sets up a model on this gpu to predict with
-        if self.gpu is None:
-            self.model = detector.start_model()
+        #sets up a model on this device to predict with, tflite gets the replica's thread budget
+        threads = replica.intra if isinstance(replica, worker_pool.Replica) and replica.intra > 0 else None
+        self.model = detector.start_model(self.gpu, batch_sizes=(1, BATCH_SIZE), num_threads=threads,
+                                          input_sizes=input_sizes)
+        
+        #reusable letterbox buffers, one per input size, frames are written straight into the model's input batch
+        self.preps = {size: utils.Preprocessor(size, BATCH_SIZE) for size in self.model.input_sizes}
+        self.prep = self.preps[self.model.input_size]
     
     def mark_avail(self):
         self.avail = True
@@ -372,54 +377,210 @@ class Worker():
     def set_frame(self, frame):
         self.cur_frame = frame
         if self.gpu is None:
-            self.gpu_frame = self.cur_frame
+            self.prep.load(0, self.cur_frame)
+            self.gpu_frame = self.prep.batch[:1]
         else:
-            self.gpu_frame = detector.frame_to_gpu(self.cur_frame, self.gpu)
+            self.gpu_frame = detector.frame_to_gpu(self.cur_frame, self.gpu, self.prep)
             
         
     def get_bboxes(self, frame_size):
         return detector.person_bboxes(self.model, self.gpu_frame, frame_size)
+    
+    #size - input size to run the batch at, the model's default if it has no graph for it
+    #tilings - tiling.Tiling of each frame's camera (None to run it whole), None if no camera is tiled
+    def get_batch_bboxes(self, frames, size=None, tilings=None):
+        prep = self.preps.get(size, self.prep)
+        if tilings is None or all(t is None for t in tilings):
+            return detector.batch_bboxes(self.model, frames, BATCH_SIZE, prep)
+        return tiling.batch_bboxes(self.model, frames, tilings, BATCH_SIZE, prep)
+        
+###---------------------------------------------------------------------------
+#   Pulls the newest unprocessed frame from each camera and groups them into
+#   batches of up to batch_size frames. A batch is flushed as soon as it is full,
+#   or once max_wait seconds have passed since its first frame was claimed, so a
+#   slow camera doesn't hold up the rest.
+#
+#   claimed - shared array holding the last sequence number handed out for each
+#             camera, protected by claim_lock so two workers never take the same frame
+#   tracer - counts duplicates_skipped (cameras passed over because their latest
+#            frame was already run) and frames_dropped (frames overwritten before
+#            any worker got to them)
+#   sizes - model input size of each camera, a batch only holds cameras of one size
+
+class BatchScheduler():
+    
+    def __init__(self, bufs, claimed, claim_lock, ind, batch_size=BATCH_SIZE, max_wait=MAX_WAIT, tracer=None,
+                 sizes=None):
+        self.tracer = tracer if tracer is not None else tracing.get_tracer()
+        self.sizes = sizes
+        self.bufs = bufs
+        self.claimed = claimed
+        self.claim_lock = claim_lock
+        self.ind = ind
+        self.batch_size = batch_size
+        self.max_wait = max_wait
         
-    #given a shared variable i, loops constantly and processes frame at i
-    #i should probably have a lock      
+    ###-----------------------------------------------------------------------
+    #   Claims frames from cameras that have something new. Cameras that have
+    #   produced the most frames since they were last claimed go first, ties are
+    #   broken by the shared round robin index so every camera gets a fair turn
+    #
+    #   size - only claim from cameras of this input size, None for any
+    #
+    #   returns - list of [camera index, seq, timestamp, frame] for newly claimed frames
+    
+    def claim(self, limit, size=None):
+        items = []
+        num_cams = len(self.bufs)
+        with self.claim_lock:
+            start = self.ind.value
+            order = [(start + k) % num_cams for k in range(num_cams)]
+            order = [i for i in order if self.ready(i, size)]
+            #stable sort keeps round robin order between cameras with as much new data
+            order.sort(key=lambda i: self.claimed[i] - self.bufs[i].seq)
+            if size is None and self.sizes is not None and len(order) > 0:
+                #the busiest camera picks the size, the rest of the batch has to match it
+                size = self.sizes[order[0]]
+                order = [i for i in order if self.sizes[i] == size]
+            for i in order[:limit]:
+                seq, timestamp, frame = self.bufs[i].latest()
+                #everything between the last claimed frame and this one was never run
+                if self.claimed[i] > 0 and seq - self.claimed[i] > 1:
+                    self.tracer.count('frames_dropped', seq - self.claimed[i] - 1)
+                self.claimed[i] = seq
+                items.append([i, seq, timestamp, frame])
+                self.ind.value = (i + 1) % num_cams
+        return items
+    
+    ###-----------------------------------------------------------------------
+    #   Blocks until a batch is ready, or until timeout seconds pass with nothing to claim
+    #
+    #   returns - list of [camera index, seq, timestamp, frame], at most batch_size long
+    #             (empty if it timed out), all from cameras of the same input size
+    
+    def next_batch(self, timeout=None):
+        batch = []
+        deadline = None
+        start = time.time()
+        size = None
+        while True:
+            batch.extend(self.claim(self.batch_size - len(batch), size))
+            if size is None and len(batch) > 0:
+                size = self.batch_size_of(batch)
+            if len(batch) >= self.batch_size:
+                self.count_duplicates(batch)
+                return batch
+            now = time.time()
+            if len(batch) > 0:
+                if deadline is None:
+                    deadline = now + self.max_wait
+                elif now >= deadline:
+                    self.count_duplicates(batch)
+                    return batch
+                wait = deadline - now
+            elif timeout is not None:
+                if now - start >= timeout:
+                    return batch
+                wait = start + timeout - now
+            else:
+                wait = None
+            self.wait_for_frames(wait, size)
+    
+    #input size a batch runs at, None if cameras don't have their own
+    def batch_size_of(self, batch):
+        if self.sizes is None or len(batch) == 0:
+            return None
+        return self.sizes[batch[0][0]]
+    
+    #live cameras left out of a batch because their latest frame has already been run,
+    #each one is an inference the old round robin over every camera would have repeated
+    def count_duplicates(self, batch):
+        taken = set(item[0] for item in batch)
+        skipped = sum(1 for i, buf in enumerate(self.bufs)
+                      if i not in taken and buf.seq > 0 and buf.seq == self.claimed[i] and buf.live())
+        if skipped > 0:
+            self.tracer.count('duplicates_skipped', skipped)
+    
+    #whether camera i has an unclaimed frame worth running, frames left over from a
+    #stream that has since dropped or frozen are skipped
+    def ready(self, i, size=None):
+        if size is not None and self.sizes is not None and self.sizes[i] != size:
+            return False
+        buf = self.bufs[i]
+        return buf.seq > self.claimed[i] and buf.live()
+    
+    def has_new(self, size=None):
+        return any(self.ready(i, size) for i in range(len(self.bufs)))
+    
+    ###-----------------------------------------------------------------------
+    #   Sleeps until some camera (of the given input size) has an unclaimed frame
+    #   or timeout passes
+    
+    def wait_for_frames(self, timeout, size=None):
+        cond = self.bufs[0].cond
+        if cond is None:
+            time.sleep(POLL_INTERVAL)
+            return
+        with cond:
+            cond.wait_for(lambda: self.has_new(size), timeout)
+
+###---------------------------------------------------------------------------
+#   Worker loop, runs a batch of frames from across cameras through the model
+#   with one forward pass, then hands each camera its own detections
 
 # def proc_video(worker, ind, i_lock, frames, times, out_q):
-def proc_video(ind, i_lock, frames, times, bbox_q, vids, gpu):
+def proc_video(ind, i_lock, claimed, bufs, bbox_q, replica, stop=None, input_sizes=None, tilings=None):
 
-    worker = Worker(gpu)
+    worker = Worker(replica, input_sizes)
+    tracer = tracing.get_tracer('worker ' + str(getattr(replica, 'name', replica)))
+    scheduler = BatchScheduler(bufs, claimed, i_lock, ind, tracer=tracer, sizes=input_sizes)
     try:
-        while(True):
-            if worker.avail:
-                worker.mark_unavail()
-                # save current index so it doesn't change while processing
-                #lock ensures that multiple processes aren't working on same frame
-                with i_lock:
-                    i = ind.value
-                    ind.value = ind.value + 1
-                    ind.value = ind.value % len(frames)
-                    #loop through frames, find people, record occupants and infractions 
-                    #TODO not sure the best way to protect smae vid from being accessed simultaneously
-                    vid = vids[i]
-                frame_size = vid[7]
-                #TODO could benefit from a lock, would help ensure frame and time are actually corresponding
-                #pretty sure manager objects already have lock control so the smae item isn't accessed from separate processes at once
-                #but that could also be a good lock to have
-                worker.set_frame(np.asarray(frames[i]))
-                bboxes = worker.get_bboxes(frame_size)
-                
-                #combine so bounding boxes remain associated with camera
-                box_ind = np.array([bboxes, i, worker.cur_frame])
-                
+        while stop is None or not stop.is_set():
+            with tracer.stage('wait'):
+                batch = scheduler.next_batch(IDLE_TIMEOUT)
+            if len(batch) == 0:
+                continue
+            tracer.gauge('batch_size', len(batch))
+            worker.mark_unavail()
+            frames = [item[3] for item in batch]
+            tiles = None if tilings is None else [tilings[item[0]] for item in batch]
+            all_bboxes = worker.get_batch_bboxes(frames, scheduler.batch_size_of(batch), tiles)
+            
+            for item, bboxes in zip(batch, all_bboxes):
+                i, seq, timestamp, _ = item
+                #combine so bounding boxes remain associated with camera and frame
+                #the frame itself stays in shared memory and is looked up again by sequence number
+                box_ind = [bboxes, i, seq, timestamp]
                 bbox_q.put(box_ind)
-                #bboxes should be sent to a queue, should also have frame or camera number associated
-                
-                
-                
-                worker.mark_avail()
+            worker.mark_avail()
+            tracer.maybe_report()
     except:
         print("Unexpected error:", sys.exc_info()[0])
     return
                
+###---------------------------------------------------------------------------
+#   Puts item on a bounded queue, dropping the oldest item if it is full so
+#   consumers always see recent data. Never blocks, even if a consumer empties
+#   the queue between the full check and the get.
+
+def put_latest(q, item):
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+#shrinks a rendered frame to width, frames already that size or smaller are returned as they are
+def fit_width(frame, width):
+    if width is None or frame.shape[1] <= width:
+        return frame
+    height = int(frame.shape[0] * width / frame.shape[1])
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
 ###---------------------------------------------------------------------------
 #   input queue of bbox info, output queue of stats
 
@@ -430,148 +591,139 @@ def proc_video(ind, i_lock, frames, times, bbox_q, vids, gpu):
 #monitor queue size so it doesn't get ridiciulously big
 
 #could move writing to a different process but probably not atm
-def post_processor(bbox_q, vids, out_q, frames, times, image_q = None):
+def post_processor(bbox_q, vids, out_q, bufs, image_q = None, stop = None, subs = None):
+    tracer = tracing.get_tracer('post processor')
+    gate = subscribers.RenderGate(subs)
+    writer = record_writer.RecordWriter(binary=BINARY_LOG)
     try:
-        while True:
-            if not bbox_q.empty():
-                box_ind = bbox_q.get()
-                bboxes = box_ind[0]
-                i = box_ind[1]
-                frame = box_ind[2]
-                
-                vid = vids[i]
-                filename = vid[0]
-                frame_save = vid[1]
-                pix_real = vid[2]
-                
-                dt = times[i]
-                
-                #find ft pts and convert to real_world
+        while stop is None or not stop.is_set():
+            tracer.sample_queue('bbox_q', bbox_q)
+            tracer.sample_queue('out_q', out_q)
+            if image_q is not None:
+                tracer.sample_queue('image_q', image_q)
+            tracer.maybe_report()
+            try:
+                box_ind = bbox_q.get(timeout=IDLE_TIMEOUT)
+            except queue.Empty:
+                continue
+            bboxes = box_ind[0]
+            i = box_ind[1]
+            seq = box_ind[2]
+            
+            vid = vids[i]
+            filename = vid.filename
+            frame_save = vid.frame_save
+            pix_real = vid.pix_real
+            
+            #find ft pts and convert to real_world
+            with tracer.stage('geometry', i):
                 ftpts = utils.get_ftpts(bboxes)
                 realpts = tform.transform_pt_array(ftpts, pix_real)
-                # verifies there is more than one p[oint in the list (each point has size 2)]
-                if realpts.size > 2:
-                    mytree = scipy.spatial.cKDTree(realpts)
-                    errors = detector.compliance_count(mytree, realpts)
-                    
-                    #FIXME can probably do these both in 1 function
-                    avg_dist = detector.find_dist(mytree, realpts)
-                    avg_min_dist = detector.find_min_dist(mytree, realpts)
-                else:
-                    errors = 0
-                    avg_min_dist = None
-                    avg_dist = None
+                #violations, average and minimum distance in one pass (None with fewer than 2 people)
+                dist = detector.dist_stats(realpts)
+                errors = dist.errors
+                avg_dist = dist.avg_dist
+                avg_min_dist = dist.min_dist
                 occupants = ftpts.size//2
-                #output info to csv file  
-                with open(filename, 'a', newline='') as base_f:
-                    writer = csv.writer(base_f)
-                    utils.video_write_info(writer, realpts, str(dt), errors, occupants, avg_dist, avg_min_dist)
-                        
-                stats = [i, errors, occupants, avg_min_dist]
-                
-                #put outpt data into queue so it is accessible by the analyzer
-                if out_q.full():
-                    out_q.get()
-                out_q.put(stats)
-                
-                #FIXME this should be set somewhere else
-                frame_show = True
+            #output info to csv file, written out in batches by the writer thread
+            with tracer.stage('csv', i):
+                writer.write(filename, box_ind[3], occupants, errors, avg_dist, avg_min_dist, realpts)
+                    
+            stats = [i, errors, occupants, avg_min_dist]
+            
+            #put outpt data into queue so it is accessible by the analyzer
+            put_latest(out_q, stats)
+            
+            #capture to analytics output, across every process the frame went through
+            tracer.record('latency', (time.time() - box_ind[3]) * 1000, i)
+            
+            #only compose a frame if a subscriber is due one or it is being saved
+            due, width = gate.due(i)
+            frame_show = len(due) > 0
+            if not (frame_show or frame_save):
+                continue
+            if frame_save:
+                width = None
+            
+            with tracer.stage('render', i):
+                frame = get_frame(bufs[i], seq, width)
+                #frame may already have been overwritten in the ring if we've fallen behind
+                if frame is None:
+                    tracer.count('frames overwritten before render')
+                    continue
+                result = prep_frame(ftpts, frame, vid, errors, occupants, bboxes, realpts, dist.nn_dist)
+
+            #save frames
+            if frame_save:
+                outpt_frame(result, vid)
                 
-                result = prep_frame(ftpts, frame, vid, errors, occupants, bboxes)
+            #every subscriber gets the frame in its own queue, at its own size
+            for frames, sub_width in due:
+                if frames is None:
+                    frames = image_q
+                if frames is not None:
+                    put_latest(frames, fit_width(result, sub_width))
                 
-                # if frame_save or frame_show:
-                #     result = prep_frame(ftpts, frame, vid, errors, occupants, bboxes)
-
-                #save frames
-                if frame_save:
-                    outpt_frame(result, vid)
-                    
-                if frame_show:
-                    if image_q.full():
-                        image_q.get()
-                    image_q.put(result)
-                    
-                # # FIXME - just for debugging, show frame on screen
-                # show_frame(result, i)  
-                # if cv2.waitKey(1) & 0xFF == ord('q'): break
+            # # FIXME - just for debugging, show frame on screen
+            # show_frame(result, i)  
+            # if cv2.waitKey(1) & 0xFF == ord('q'): break
     except:
         print("Unexpected error:", sys.exc_info()[0])
         cv2.destroyAllWindows()
+    #write out anything still buffered
+    writer.close()
     return
 ###---------------------------------------------------------------------------
-#   
-def fill_vid_array(name, pix_real, real_pix, save = False):
-    #make an array that's defined # wide, undef tall
-    #fill corresponding # of fields
-    #row # = camera num
-    #TODO could ake this a dictionary to make it easier to understand
-    #0) filename, 1) frame_save, 2) pix_real, 3) real_pix, 4) origin, 5) frame_dir, 6) count, 7) frame_size
-    # filename = vid[0]
-    # frame_save = vid[1]
-    # pix_real = vid[2]
-    # real_pix = vid[3]
-    # origin = vid[4] 
-    # frame_dir = vid[5]
-    # count = vid[6]
-    # frame_size = vid[7]
-    
-    #name of output file
-    filename = 'C:/Users/Nikki/Documents/work/inputs-outputs/txt_output/' + name + '.csv'
-    
-    #create base file and csv writer to add to file
-    # base_f = open(filename, 'a', newline='')
-    # csvfile = csv.writer(base_f)
-    
-    origin = np.array([0,0])
-        
-    #set output directory and frame number in case video is to be saved
-    frame_dir = 'C:/Users/Nikki/Documents/work/inputs-outputs/vid_output/' + name + '_frames/'
-    count = 0  
-    
-    frame_size = 0 #will get updated later        
-    print('Saving frames: ', save)
-    
-    cur_vid = np.array([filename, save, pix_real, real_pix, origin, frame_dir, count, frame_size])
-    return cur_vid
-            
-
-#TODO make function to easily edit size, saving setting
+#   Everything known about one camera. Built once in main and handed to the
+#   post processor when it starts, detections only carry the camera's index
 
-# class VidObj:
+class VidObj():
+    __slots__ = ('name', 'filename', 'frame_save', 'pix_real', 'real_pix', 'origin',
+                 'frame_dir', 'count', 'frame_size', 'options')
     
-#     def __init__(self, name, pix_real, real_pix, save = False):
-#         #name of output file
-#         self.filename = 'C:/Users/Nikki/Documents/work/inputs-outputs/txt_output/' + name + '.csv'
+    def __init__(self, name, pix_real, real_pix = None, save = False, options = None):
+        self.name = name
+        #per camera settings from the transforms csv
+        self.options = {} if options is None else options
+        #name of output file
+        self.filename = 'C:/Users/Nikki/Documents/work/inputs-outputs/txt_output/' + name + '.csv'
         
-#         #create base file and csv writer to add to file
-#         self.base_f = open(self.filename, 'a', newline='')
-#         self.csvfile = csv.writer(self.base_f)
+        #set whether or not to save file
+        self.frame_save = save
         
-#         #set whether or not to save file
-#         self.frame_save = save
+        #set transformation matrices, contiguous float64 so transforms never copy them
+        self.pix_real = np.ascontiguousarray(pix_real, dtype=np.float64).reshape(3, 3)
+        if real_pix is None:
+            real_pix = np.linalg.inv(self.pix_real)
+        self.real_pix = np.ascontiguousarray(real_pix, dtype=np.float64).reshape(3, 3)
+        self.origin = np.array([0,0])
         
-#         #set transformation matrices
-#         self.pix_real = pix_real
-#         self.real_pix = real_pix
-#         self.origin = np.array([0,0])
-#         # self.transform_info = pr.sample_select(name)
-        
-#         #set output directory and frame number in case video is to be saved
-#         self.frame_dir = 'C:/Users/Nikki/Documents/work/inputs-outputs/vid_output/' + name + '_frames/'
-#         self.count = 0  
-                
-#         print('Saving frames: ', self.frame_save)
+        #set output directory and frame number in case video is to be saved
+        self.frame_dir = 'C:/Users/Nikki/Documents/work/inputs-outputs/vid_output/' + name + '_frames/'
+        self.count = 0
         
+        #will get updated once the stream is probed
+        self.frame_size = None
+        print('Saving frames: ', self.frame_save)
         
-#     def set_size(self, frame_size):
-#         self.frame_size = frame_size
-#         self.origin = np.array([frame_size[1]/2, frame_size[0]])
+    ###-----------------------------------------------------------------------
+    #   frame_size - (height, width) of the frames the camera's stream outputs
+    #   native - (height, width) the camera was calibrated at, if frames come out
+    #            smaller the homographies are rescaled to the new pixel coords
+    
+    def set_size(self, frame_size, native = None):
+        self.frame_size = tuple(frame_size[:2])
+        if native is None or tuple(native[:2]) == self.frame_size:
+            return
+        scale = np.diag([self.frame_size[1] / native[1], self.frame_size[0] / native[0], 1.0])
+        self.pix_real = np.ascontiguousarray(self.pix_real @ np.linalg.inv(scale))
+        self.real_pix = np.ascontiguousarray(scale @ self.real_pix)
         
-#     def start_save(self):
-#         self.frame_save = True
+    def start_save(self):
+        self.frame_save = True
         
-#     def end_save(self):
-#         self.frame_save = False
+    def end_save(self):
+        self.frame_save = False
         
             
 if __name__ == '__main__':
@@ -588,9 +740,6 @@ if __name__ == '__main__':
     #should initialize cameras here instead of in mp vid
     num_cams = 2
 
-    updated = manager.Value(c_bool, False)
-    frames = manager.list([None]* num_cams)
-    times = manager.list([None]* num_cams)
     avgs = manager.list([None] * 5)
     avg_lock = manager.Lock()
     i_lock = manager.Lock()
@@ -600,10 +749,12 @@ if __name__ == '__main__':
     
     global image_q
     image_q = manager.Queue(num_cams*2)
+    #nothing is subscribed when run on its own, so frames are only rendered if they're being saved
+    subs = manager.dict()
     
     for i in range(num_cams):
         errs.append(manager.list([None]))
         ocpts.append(manager.list([None]))
         dists.append(manager.list([None]))
         
-    main(errs, ocpts, dists, updated, frames, times, avgs, avg_lock, i_lock, ind,out_q, bbox_q, image_q)
\ No newline at end of file
+    main(errs, ocpts, dists, avgs, avg_lock, i_lock, ind,out_q, bbox_q, image_q, subs=subs)
\ No newline at end of file
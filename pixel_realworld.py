@@ -15,217 +15,168 @@ import scipy.spatial
 import markers
 
 
+#ellipse colours by distance to the nearest other person, (upper bound in ft, colour)
+DIST_BINS = np.array([6, 8, 10])
+#<6ft, <8ft, <10ft, further - in BGR, frames stay in opencv's channel order throughout
+DIST_COLOURS = [(0, 0, 255), (0, 140, 255), (0, 255, 255), (0, 255, 0)]
+#radius in ft of the circle drawn around each person
+RADIUS = 6
+
+
 ###---------------------------------------------------------------------------
 #   Given photo points at people's feet, draws '6 foot' ellipse around them.
 #   Most useful of these functions for implementing with yolo bounding box points.
 #
+#   real_pts - optional, pix_pts already converted with pix_real
+#   nn_dist - optional, each point's distance in ft to its nearest neighbour,
+#             pass these in from detector.dist_stats to avoid recomputing them
+#   scale - frame size relative to the one pix_pts and the transforms are for
+#
+#   Draws onto frame in place.
+#
 #   returns - img - input frame with ellipses drawn at specified points
+#             count - number of people within 6ft of someone else
 ###
 
-def draw_radius(frame, pix_pts, real_pix, pix_real, real_origin):
-    bounds, frame = four_pts(pix_pts, pix_real, real_pix, real_origin, frame)
-    mytree = load_tree(pix_pts, pix_real)
-    img, count = draw_ellipse(frame, bounds, pix_pts, mytree, pix_real)
+def draw_radius(frame, pix_pts, real_pix, pix_real, real_origin, real_pts=None, nn_dist=None, scale=1.0):
+    pix_pts = np.asarray(pix_pts, dtype=np.float64).reshape(-1, 2)
+    if len(pix_pts) == 0:
+        return frame, 0
+    if real_pts is None:
+        real_pts = tform.transform_pt_array(pix_pts, pix_real)
+    real_pts = np.asarray(real_pts, dtype=np.float64).reshape(-1, 2)
+    if nn_dist is None:
+        nn_dist = nearest_dist(real_pts)
+    
+    axes = ellipse_axes(real_pts, real_origin, real_pix)
+    if scale != 1:
+        pix_pts = pix_pts * scale
+        axes = (axes * scale).astype(np.int64)
+    img, count = draw_ellipses(frame, pix_pts, axes, nn_dist)
     # bird_img = overhead(pix_pts, real_origin, pix_real)
     return img, count
 
 
 
 ###---------------------------------------------------------------------------
-#   Given an array of photo pts and conversion matrices, converts to GPS, finds
-#   defining points of 6 ft circle at camera angle, and converts back to pixel coords.
+#   Given real world points, finds the 4 points 6 ft away from each at 90 degree
+#   increments starting from the bearing to the camera, converts all of them back
+#   to pixel coords at once, and measures the axes of the ellipse they define.
+#   Using the bearing to the camera keeps the ellipse properly scaled in the pixel plane.
 #
-#   returns - final - array of arrays of 4 pixel coordinates to be used to define each ellipse's axes
+#   returns - [N, 2] int array of (major, minor) half axes in pixels
 ###
 
-def four_pts(pix_pts, pix_real, real_pix, real_origin, img):
-    #convert to gps coords
-    real_pts = tform.transform_pt_array(pix_pts, pix_real)
-    final = []
+def ellipse_axes(real_pts, real_origin, real_pix):
+    real_origin = np.asarray(real_origin, dtype=np.float64).reshape(2)
     
-    #calculate locations six feet away at given bearings and add to array
-    for pt in real_pts:
-        degrees = calc_angle(pt, real_origin)
-        # print(degrees)
-        for angle in degrees:
-            location = six_ft(pt, angle)            
-            final.append(location)
-            
-    #convert list of pts to numpy array
-    final = np.array([final])
-    final = np.squeeze(np.asarray(final))
-    #check if final has any elements?
-    #convert to pixel coords
-    # pt = final[5]
-    # pt2 = final[7]
-
-    # dist = math.sqrt((pt2[0] - pt[0])**2 + (pt2[1] - pt[1])**2)
-    # print(dist)
-    
-    
-    final = tform.transform_pt_array(final, real_pix)
-    
-    #show edge circles or not
-    # for pt in final:
-        
-    #     pt2 = (int(pt[0]), int(pt[1]))
-    #     cv2.circle(img, pt2, 10, (0,0,255), -1, 8)
-
+    #bearing between camera and each pt, then 90 degree increments
+    opp = real_pts[:, 1] - real_origin[1]
+    adj = real_pts[:, 0] - real_origin[0]
+    #arctan2 stays defined for points level with or on the origin, and only differs from
+    #arctan(opp / adj) by pi, which just reorders the four directions
+    bearing = np.arctan2(opp, adj)
+    angles = bearing[:, None] + np.arange(4) * (np.pi / 2)
     
+    #[N, 4, 2] points 6 ft away, all converted to pixel coords in one go
+    offsets = np.stack([np.cos(angles), np.sin(angles)], axis=-1) * RADIUS
+    bounds = real_pts[:, None, :] + offsets
+    bounds = tform.transform_pt_array(bounds.reshape(-1, 2), real_pix).reshape(-1, 4, 2)
     
+    a, b, c, d = bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]
+    # this has performed worse on all samples except maybe aot2
+    # possible_minor = np.hypot(*(c - a).T) / 2
+    possible_minor = (np.abs(c[:, 1] - a[:, 1]) / 2).astype(np.int64)
+    possible_major = (np.hypot(d[:, 0] - b[:, 0], d[:, 1] - b[:, 1]) / 2).astype(np.int64)
     
-    return final, img
+    major = np.maximum(possible_major, possible_minor)
+    minor = np.minimum(possible_major, possible_minor)
+    return np.stack([major, minor], axis=-1)
 
 
 
 ###---------------------------------------------------------------------------
-#   Given a point, calculates it's bearing in relation to the approximate camera location.
-#   This enables GPS circle points to be found such that they define an ellipse within pixel
-#   plane that appears properly scaled. Uses haversine formula.
-#   Formula from: https://www.movable-type.co.uk/scripts/latlong.html
-#   
-#   returns - array of 4 bearings in degrees, clockwise from north. First is bearing 
-#             between camera and given pt)
+#   Distance from each real world point to its nearest neighbour, inf if there's
+#   nobody else. Only used when the metrics stage hasn't already worked it out.
 ###
-        
-def calc_angle(pt, real_origin):
-    #find angle between two points
-    # print(pt)
-    # print(real_origin)
-    opp = (pt[1] - real_origin[1])
-    adj = (pt[0] - real_origin[0])
-    # print(opp)
-    # print(adj)
-    a = math.atan(opp/adj)
-    # print(a)
-    
-    a = math.degrees(a)
-    # print(a)
-    #fill arrray with 90 degree increments
-    angle = 4 * [None]
-    i = 0
-    while i < 4:
-        angle[i] = (a + i * 90) % 360
-        i = i + 1
-    
-    return angle
 
+def nearest_dist(real_pts):
+    if len(real_pts) < 2:
+        return np.full(len(real_pts), np.inf)
+    mytree = scipy.spatial.cKDTree(real_pts)
+    dist, _ = mytree.query(real_pts, k=2)
+    return dist[:, 1]
 
 
-###---------------------------------------------------------------------------
-#   Given a GPS point and a bearing, finds point six feet away in that direction,
-#   using haversine formula.
-#   Formula from: https://www.movable-type.co.uk/scripts/latlong.html
-#
-#   returns - GPS coord 6 ft away
-### 
-
-def six_ft(pt1, a):
-    a = math.radians(a)
-    #convert to rad
-    
-    #find x and y component of point 6 ft away
-    x = math.cos(a) * 6
-    y = math.sin(a) * 6
-    
-    #add to known point 
-    pt2 = pt1 + (x, y)
-    
-    
-    return(pt2)
 
 ###---------------------------------------------------------------------------
-#   Loads array of pts into a ckd tree for to enable easy finding of nearest pt
-#
-#   returns - ckd tree
-###
-
-def load_tree(pix_pts, pix_real):
-    real = tform.transform_pt_array(pix_pts, pix_real)
-    mytree = scipy.spatial.cKDTree(real)
-      
-    return mytree
+#   Blends translucent ellipses onto frames. Only the rectangle bounding all the
+#   ellipses is copied and blended, and the layer they're drawn into is kept
+#   between frames instead of allocating a full frame copy every time.
+
+class Compositor():
+
+    def __init__(self, alpha=0.25):
+        self.alpha = alpha
+        self.layer = np.zeros((0, 0, 3), dtype=np.uint8)
+
+    ###-----------------------------------------------------------------------
+    #   returns - [h, w, 3] view into the cached layer, grown if needed
+
+    def get_layer(self, h, w):
+        if h > self.layer.shape[0] or w > self.layer.shape[1]:
+            self.layer = np.empty((max(h, self.layer.shape[0]), max(w, self.layer.shape[1]), 3), dtype=np.uint8)
+        return self.layer[:h, :w]
+
+    ###-----------------------------------------------------------------------
+    #   Draws filled ellipses onto frame in place
+    #
+    #   centers - [N, 2] int pixel centers
+    #   axes - [N, 2] int (major, minor) half axes, major along x
+    #   colours - list of N colour tuples
+
+    def ellipses(self, frame, centers, axes, colours):
+        if len(centers) == 0:
+            return frame
+        frame_h, frame_w = frame.shape[:2]
+        
+        #region touched by any ellipse, pixels outside it would blend with themselves
+        x0 = max(int((centers[:, 0] - axes[:, 0]).min()) - 1, 0)
+        y0 = max(int((centers[:, 1] - axes[:, 1]).min()) - 1, 0)
+        x1 = min(int((centers[:, 0] + axes[:, 0]).max()) + 2, frame_w)
+        y1 = min(int((centers[:, 1] + axes[:, 1]).max()) + 2, frame_h)
+        if x0 >= x1 or y0 >= y1:
+            return frame
+        
+        roi = frame[y0:y1, x0:x1]
+        layer = self.get_layer(y1 - y0, x1 - x0)
+        np.copyto(layer, roi)
+        for (x, y), axis, colour in zip(centers.tolist(), axes.tolist(), colours):
+            cv2.ellipse(layer, (x - x0, y - y0), tuple(axis), 0, 0, 360, colour, -1, 8)
+        
+        #combine original image and ellipse image into one
+        cv2.addWeighted(layer, self.alpha, roi, 1 - self.alpha, 0, dst=roi)
+        return frame
 
+#one per process, keeps its layer between frames
+compositor = Compositor()
 
 
 
 ###---------------------------------------------------------------------------
-#   Given array of defining points of several ellipses (endpoints of axes) and 
-#   corresponding center points, draws ellipses on given image
+#   Given ellipse centers and axes, draws ellipses on given image coloured by
+#   distance to the nearest other person
 #
-#   returns - all_img - given image with ellipses drawn onto it
+#   returns - all_img - given image with ellipses drawn onto it (in place)
+#             count - number of people within 6ft of someone else
 ###
 
-def draw_ellipse(frame, pts, centers, mytree, pix_real):
-    #define qualities of the ellipse
-    thickness = -1
-    line_type = 8
-    
-    #set transparency
-    alpha = 0.25
-    
-    #create separate image for ellipses to be drawn into
-    ellipses = frame.copy()
+def draw_ellipses(frame, centers, axes, nn_dist):
+    bins = np.digitize(nn_dist, DIST_BINS)
+    count = int(np.count_nonzero(bins == 0))
+    colours = [DIST_COLOURS[b] for b in bins.tolist()]
     
-    #iterate through list of ellipse points and centers, drawing each into ellipse image    
-    i = 0
-    count = 0
-    ct = 0
-    gps_centers = tform.transform_pt_array(centers, pix_real)
-    while i < pts.shape[0]:
-        a = pts[i]
-        
-        b = pts[i + 1]
-        c = pts[i + 2]
-        d = pts[i + 3]
-        # this has performed worse on all samples except maybe aot2
-        # possible_minor = int((math.sqrt(math.pow((c[0]-a[0]), 2) + math.pow((c[1]-a[1]), 2)))/2)
-        possible_minor = int(abs(c[1]-a[1])/2)
-        possible_major = int((math.sqrt(math.pow((d[0]-b[0]), 2) + math.pow((d[1]-b[1]), 2)))/2)
-        
-        minor = min([possible_major, possible_minor])
-        major = max([possible_major, possible_minor])
-        
-        if centers.size <= 2:
-            centers = np.array([centers])
-        center = centers[i//4]
-        
-        x = int(center[0])
-        y = int(center[1])
-        
-        # TODO could probably query all points simultaneously, could be a little more efficient
-        if centers.size > 2:
-            gps_center = gps_centers[i//4]
-            dist, ind = mytree.query(gps_center, k=2)
-            closest = mytree.data[ind[1]]
-            #dist = GPS_to_ft(gps_center, closest)
-            if dist[1] < 6:
-                cv2.ellipse(ellipses, (x,y), (major, minor), 0, 0, 360, (255, 0, 0), thickness, line_type)
-                count = count + 1
-            elif dist[1] < 8:
-                cv2.ellipse(ellipses, (x,y), (major, minor), 0, 0, 360, (255, 140, 0), thickness, line_type)
-            elif dist[1] < 10:
-                cv2.ellipse(ellipses, (x,y), (major, minor), 0, 0, 360, (255, 255, 0), thickness, line_type)            
-            else:
-                cv2.ellipse(ellipses, (x,y), (major, minor), 0, 0, 360, (0,255,0), thickness, line_type)
-            
-            # if ct<4:
-            #     cv2.ellipse(ellipses, (x,y), (major, minor), 0, 0, 360, (0, 0, 255), thickness, line_type)
-            # elif ct<8:    
-            #     cv2.ellipse(ellipses, (x,y), (major, minor), 0, 0, 360, (0, 255, 255), thickness, line_type)
-            # elif ct<12:
-            #     cv2.ellipse(ellipses, (x,y), (major, minor), 0, 0, 360, (0, 255, 0), thickness, line_type)
-            # elif ct<16:
-            #     cv2.ellipse(ellipses, (x,y), (major, minor), 0, 0, 360, (255, 255, 0), thickness, line_type)
-            
-        else:
-            cv2.ellipse(ellipses, (x,y), (major, minor), 0, 0, 360, (0,255,0), thickness, line_type)
-        i = i + 4
-        ct = ct + 1
-        
-
-    #combine original image and ellipse image into one
-    all_img = cv2.addWeighted(ellipses, alpha, frame, 1-alpha, 0)
+    all_img = compositor.ellipses(frame, centers.astype(np.int64), axes, colours)
     return all_img, count
 
 
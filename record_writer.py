@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered writer for the per frame occupancy records.
+
+A background thread keeps every camera's output files open, collects rows
+and writes them out in batches, once FLUSH_ROWS rows are waiting or
+FLUSH_INTERVAL seconds have passed. Besides the csv, each camera can also
+get a binary append log that keeps the real world points as float arrays,
+which read_log loads straight back into numpy without parsing any text.
+
+@author: Nikki
+"""
+
+import os
+import csv
+import time
+import queue
+import datetime
+import threading
+import numpy as np
+
+#rows buffered before they are written out
+FLUSH_ROWS = 256
+#max seconds a row waits before being written out
+FLUSH_INTERVAL = 5.0
+#rows that can wait for the writer thread, past this the oldest are dropped so a stalled
+#disk can't run the process out of memory
+MAX_QUEUE = 10000
+
+#one record per frame in the .rows log, its points are pts[offset:offset + n] of the .pts log
+ROW_DTYPE = np.dtype([('time', '<f8'), ('people', '<i4'), ('count', '<i4'), ('avg_dist', '<f8'),
+                      ('min_dist', '<f8'), ('offset', '<i8'), ('n', '<i4')])
+PT_DTYPE = np.dtype('<f8')
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+###---------------------------------------------------------------------------
+#   Open output files for one camera
+
+class Outputs():
+
+    def __init__(self, filename, use_csv, binary):
+        self.csv_f = None
+        self.rows_f = None
+        self.pts_f = None
+        if use_csv:
+            self.csv_f = open(filename, 'a', newline='')
+            self.csv = csv.writer(self.csv_f)
+        if binary:
+            base = os.path.splitext(filename)[0]
+            self.rows_f = open_log(base + '.rows', ROW_DTYPE.itemsize)
+            self.pts_f = open_log(base + '.pts', 2 * PT_DTYPE.itemsize)
+            #carry on numbering points after anything already in the log
+            self.offset = self.pts_f.tell() // (2 * PT_DTYPE.itemsize)
+        self.pending = []
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        if self.csv_f is not None:
+            self.csv.writerows(csv_row(*row) for row in self.pending)
+            self.csv_f.flush()
+        if self.rows_f is not None:
+            self.write_binary()
+        self.pending = []
+
+    def write_binary(self):
+        records = np.zeros(len(self.pending), dtype=ROW_DTYPE)
+        pts = []
+        for k, (timestamp, people, count, avg_dist, min_dist, realpts) in enumerate(self.pending):
+            n = len(realpts)
+            records[k] = (timestamp, people, count, nan_if_none(avg_dist), nan_if_none(min_dist), self.offset, n)
+            self.offset += n
+            pts.append(realpts)
+        #points go first so a record never points past the end of the .pts log
+        np.concatenate(pts).astype(PT_DTYPE).tofile(self.pts_f)
+        self.pts_f.flush()
+        records.tofile(self.rows_f)
+        self.rows_f.flush()
+
+    def close(self):
+        for f in [self.csv_f, self.rows_f, self.pts_f]:
+            if f is not None:
+                f.close()
+
+
+###---------------------------------------------------------------------------
+#   Usage:
+#       writer = RecordWriter()
+#       writer.write(filename, timestamp, people, count, avg_dist, min_dist, realpts)
+#       writer.close()      #writes out anything still buffered
+#
+#   use_csv - write the usual csv, rows match utils.video_write_info
+#   binary - also write a .rows/.pts append log next to each csv, see read_log
+#
+#   If the writer thread fails (unopenable path, full disk, ...) the error is
+#   raised again from the next write or close.
+
+class RecordWriter():
+
+    def __init__(self, use_csv=True, binary=False, flush_rows=FLUSH_ROWS, flush_interval=FLUSH_INTERVAL,
+                 max_queue=MAX_QUEUE):
+        self.use_csv = use_csv
+        self.binary = binary
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.q = queue.Queue(max_queue)
+        self.outputs = {}
+        #exception the writer thread died with
+        self.error = None
+        #rows dropped because the queue was full
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    ###-----------------------------------------------------------------------
+    #   Queues one frame's record, never blocks on disk
+    #
+    #   timestamp - capture time in seconds since the epoch
+    #   realpts - [N, 2] real world positions
+
+    def write(self, filename, timestamp, people, count, avg_dist, min_dist, realpts):
+        self.check()
+        realpts = np.asarray(realpts, dtype=np.float64).reshape(-1, 2)
+        self.put((filename, (timestamp, people, count, avg_dist, min_dist, realpts)))
+
+    def flush(self):
+        self.check()
+        self.put(_FLUSH)
+
+    def close(self):
+        self.put(_CLOSE)
+        self.thread.join()
+        self.check()
+
+    #raises the writer thread's error, if it had one
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    #queues item, dropping the oldest row if the writer has fallen MAX_QUEUE rows behind
+    def put(self, item):
+        while True:
+            try:
+                self.q.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.q.get_nowait()
+                except queue.Empty:
+                    continue
+                if self.dropped == 0:
+                    print('Record writer is falling behind, dropping the oldest rows')
+                self.dropped += 1
+
+    def run(self):
+        try:
+            self.write_loop()
+        except Exception as e:
+            self.error = e
+            print('Record writer stopped: ' + repr(e))
+            for out in self.outputs.values():
+                try:
+                    out.close()
+                except Exception:
+                    pass
+            self.outputs = {}
+
+    def write_loop(self):
+        waiting = 0
+        last_flush = time.time()
+        while True:
+            timeout = max(last_flush + self.flush_interval - time.time(), 0)
+            try:
+                item = self.q.get(timeout=timeout)
+            except queue.Empty:
+                item = _FLUSH
+
+            if item is not _FLUSH and item is not _CLOSE:
+                filename, row = item
+                out = self.outputs.get(filename)
+                if out is None:
+                    out = self.outputs[filename] = Outputs(filename, self.use_csv, self.binary)
+                out.pending.append(row)
+                waiting += 1
+                if waiting < self.flush_rows:
+                    continue
+
+            for out in self.outputs.values():
+                out.flush()
+            waiting = 0
+            last_flush = time.time()
+
+            if item is _CLOSE:
+                for out in self.outputs.values():
+                    out.close()
+                self.outputs = {}
+                return
+
+
+###---------------------------------------------------------------------------
+#   Opens a log for appending, first cutting off any partial record left by a
+#   crash mid-write so new records stay aligned
+
+def open_log(path, record_size):
+    f = open(path, 'ab')
+    size = f.tell()
+    if size % record_size != 0:
+        f.truncate(size - size % record_size)
+        f.seek(0, os.SEEK_END)
+    return f
+
+def nan_if_none(x):
+    return np.nan if x is None else x
+
+###---------------------------------------------------------------------------
+#   Same columns utils.video_write_info writes: time, occupants, errors, avg dist, min dist, pts
+
+def csv_row(timestamp, people, count, avg_dist, min_dist, realpts):
+    dt = datetime.datetime.fromtimestamp(timestamp)
+    return [str(dt), people, count, avg_dist, min_dist, realpts.tolist()]
+
+###---------------------------------------------------------------------------
+#   Loads a binary log written by RecordWriter
+#
+#   filename - the camera's csv path, or the log path without extension
+#
+#   returns - rows - structured array with ROW_DTYPE fields, one per frame
+#             pts - [M, 2] every frame's real world points back to back,
+#                   frame k's are pts[rows['offset'][k]:rows['offset'][k] + rows['n'][k]]
+
+def read_log(filename):
+    base = os.path.splitext(filename)[0]
+    pts = np.fromfile(base + '.pts', dtype=PT_DTYPE)
+    pts = pts[:len(pts) // 2 * 2].reshape(-1, 2)
+
+    #a record is only complete if the whole thing and all its points made it to disk
+    raw = np.fromfile(base + '.rows', dtype=np.uint8)
+    rows = raw[:len(raw) // ROW_DTYPE.itemsize * ROW_DTYPE.itemsize].view(ROW_DTYPE)
+    rows = rows[rows['offset'] + rows['n'] <= len(pts)]
+    return rows, pts
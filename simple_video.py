@@ -26,6 +26,8 @@ import sys
 #from threading import Thread
 #from queue import Queue
 import pixel_gps as pg
+import detector
+import tracing
 #uncomment to verify that GPU is being used
 #tf.debugging.set_log_device_placement(True)
 import addresses
@@ -101,11 +103,14 @@ def main():
         print('model built')
         
         
-        #force to run eagerly
-        model.run_eagerly = True
-        
         #load existing weights into model
         utils.load_weights(model, WEIGHTS)
+        
+        #trace the forward pass into a static graph and warm it up
+        model = detector.CompiledModel(model, batch_sizes=(1,), input_sizes=[INPUT_SIZE])
+        
+        #per stage timings, printed every tracing.REPORT_EVERY seconds and when the video ends
+        tracer = tracing.get_tracer('simple video')
  
         #continue reading and showing frames until interrupted
         try:
@@ -131,60 +136,49 @@ def main():
                 
                 #resize image and add another dimension
                 frame_size = frame.shape[:2]
-                cur_frame = np.copy(frame)
-                image_data = utils.image_preprocess(cur_frame, [INPUT_SIZE, INPUT_SIZE]) 
-                image_data = image_data[np.newaxis, ...].astype(np.float32)
+                with tracer.stage('preprocess'):
+                    cur_frame = np.copy(frame)
+                    image_data = utils.image_preprocess(cur_frame, [INPUT_SIZE, INPUT_SIZE]) 
+                    image_data = image_data[np.newaxis, ...].astype(np.float32)
                 
-               
-                prev_time = time.time()  #for calculating how long it takes to process a frame
                 
-                
-                with tf.device('/GPU:0'):
-                    image_data = tf.convert_to_tensor(image_data)
-                    print(image_data.device)
-                
-                #for calculating how long it takes to process a frame
-                curr_time = time.time()
-                exec_time = curr_time - prev_time
-                info = "time1: %.2f ms" %(1000*exec_time)
-                print(info)
-                prev_time = time.time()
+                with tracer.stage('to_gpu'):
+                    with tf.device('/GPU:0'):
+                        image_data = tf.convert_to_tensor(image_data)
                 
                 #make bboxes
-                pred_bbox = model.predict(image_data)
-                pred_bbox = utils.postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE)
-                all_bboxes, probs, classes = utils.postprocess_boxes(pred_bbox, frame_size, INPUT_SIZE, 0.25)#.25
-                bboxes = utils.filter_people(all_bboxes, probs, classes)
+                with tracer.stage('inference'):
+                    pred_bbox = model.predict(image_data)
+                with tracer.stage('postprocess'):
+                    pred_bbox = utils.postprocess_bbbox(pred_bbox, ANCHORS, STRIDES, XYSCALE)
+                    all_bboxes, probs, classes = utils.postprocess_boxes(pred_bbox, frame_size, INPUT_SIZE, 0.25)#.25
+                    bboxes = utils.filter_people(all_bboxes, probs, classes)
+                    #get rid of redundant boxes
+                    if len(bboxes) > 0:
+                        bboxes = utils.nms(bboxes, 0.213, method='nms') #.213
     
                 #only continue processing if there were people identified
-                if len(bboxes) > 0:
-                    #get rid of redundant boxes
-                    bboxes = utils.nms(bboxes, 0.213, method='nms') #.213
-                    
-                    #draw bbox and get centered point at base of box
-                    frame = utils.draw_bbox(frame, bboxes, show_label = False)
-                    pts = utils.get_ftpts(bboxes)
+                with tracer.stage('render'):
+                    if len(bboxes) > 0:
+                        #draw bbox and get centered point at base of box
+                        frame = utils.draw_bbox(frame, bboxes, show_label = False)
+                        pts = utils.get_ftpts(bboxes)
+                        
+                        #draw radii and count people
+                        frame, count_buf[ind] = pg.draw_radius(frame, pts, GPS_pix, pix_GPS, origin)
+                        people_buf[ind] = pts.shape[0]
+                    else:
+                        count_buf[ind] = 0
+                        people_buf[ind] = 0
                     
-                    #draw radii and count people
-                    frame, count_buf[ind] = pg.draw_radius(frame, pts, GPS_pix, pix_GPS, origin)
-                    people_buf[ind] = pts.shape[0]
-                else:
-                    count_buf[ind] = 0
-                    people_buf[ind] = 0
+                    #avg people and count within 6ft buffers   
+                    people = int(sum(people_buf)/len(people_buf))
+                    count = int(sum(count_buf)/len(count_buf))
                     
-                #avg people and count within 6ft buffers   
-                people = int(sum(people_buf)/len(people_buf))
-                count = int(sum(count_buf)/len(count_buf))
-                
-                #write info to file and overlay on video
-                utils.video_write_info(f, bboxes, dt, count, people)
-                utils.overlay_occupancy(frame, count, people, frame_size)
-                
-                #for calculating how long it takes to process a frame
-                curr_time = time.time()
-                exec_time = curr_time - prev_time
-                info = "time2: %.2f ms" %(1000*exec_time)
-                print(info)
+                    #write info to file and overlay on video
+                    utils.video_write_info(f, bboxes, dt, count, people)
+                    utils.overlay_occupancy(frame, count, people, frame_size)
+                tracer.maybe_report()
                 
                 #convert frame to correct cv colors and display/record
                 result = np.asarray(frame)
@@ -202,6 +196,7 @@ def main():
                 ind = (ind + 1) % buf_size
                 
             #end video, close viewer, stop writing to file
+            print(tracer.summary())
             vid.release()
             if RECORD:
                 out_vid.release()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Demand driven rendering. Anything that wants annotated frames (the web feed,
+a recorder, ...) registers itself in a shared manager dict with the rate and
+width it needs, and the post processor only composes frames when some
+subscriber is due one. Analytics keep running at full rate either way.
+
+Each subscriber brings its own latest-only queue, so two viewers never take
+each other's frames.
+
+@author: Nikki
+"""
+
+import time
+
+#how often the post processor re-reads the subscriber dict, each read is a round trip to the manager
+REFRESH = 1.0
+#frames held for each subscriber, only the newest is kept so a slow reader just skips frames
+QUEUE_SIZE = 1
+
+
+###---------------------------------------------------------------------------
+#   Registers interest in rendered frames
+#
+#   subs - manager dict shared with the post processor
+#   fps - max frames per second per camera, None for every frame
+#   width - width in pixels frames should be rendered at, None for full size
+#   cams - list of camera indices wanted, None for all
+#   frames - queue frames are delivered to, from the same manager as subs, e.g.
+#            manager.Queue(QUEUE_SIZE). None to share the post processor's image_q
+
+def subscribe(subs, name, fps=None, width=None, cams=None, frames=None):
+    subs[name] = {'fps': fps, 'width': width, 'cams': cams, 'frames': frames}
+
+def unsubscribe(subs, name):
+    subs.pop(name, None)
+
+
+###---------------------------------------------------------------------------
+#   Decides, per detection result, whether a frame needs to be rendered and at what size
+
+class RenderGate():
+
+    def __init__(self, subs, refresh=REFRESH):
+        self.subs = subs
+        self.refresh = refresh
+        self.active = {}
+        self.fetched = 0
+        #(subscriber, camera) - time of last frame rendered for it
+        self.last = {}
+
+    def get_active(self, now):
+        if self.subs is not None and now - self.fetched >= self.refresh:
+            self.active = dict(self.subs)
+            self.fetched = now
+        return self.active
+
+    ###-----------------------------------------------------------------------
+    #   Checks which subscribers are due a frame from camera cam, and marks them
+    #   as served
+    #
+    #   returns - due - list of (queue, width) for each subscriber that wants this frame,
+    #                   queue is None for subscribers without their own
+    #             width - width to render at, the largest any of them wants, None for full size
+
+    def due(self, cam, now=None):
+        if now is None:
+            now = time.time()
+        due = []
+        width = 0
+        for name, sub in self.get_active(now).items():
+            if sub['cams'] is not None and cam not in sub['cams']:
+                continue
+            key = (name, cam)
+            if sub['fps'] and now - self.last.get(key, 0) < 1.0 / sub['fps']:
+                continue
+            self.last[key] = now
+            due.append((sub.get('frames'), sub['width']))
+            if width is not None:
+                width = None if sub['width'] is None else max(width, sub['width'])
+        return due, width
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Starts the pipeline's child processes and restarts any that die.
+
+The supervising process blocks on the children's sentinels and on the stop
+event, so it uses no cpu while everything is healthy.
+
+A child that dies while holding a lock or condition it shares with the others
+would leave them blocked forever. So whenever one of those children dies the
+supervisor tries the shared locks itself, and if one can't be had it is
+replaced and every child sharing them is restarted together.
+
+@author: Nikki
+"""
+
+import time
+import threading
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+#seconds to wait before restarting a child that died
+RESTART_DELAY = 1.0
+#restart delay doubles each time a child dies within this many seconds of starting, up to MAX_RESTART_DELAY
+QUICK_CRASH = 10.0
+MAX_RESTART_DELAY = 60.0
+#seconds children get to exit on their own after stop is set before being terminated
+JOIN_TIMEOUT = 5.0
+#seconds a shared lock can stay taken after a child died before it's assumed the child died holding it
+LOCK_CHECK = 2.0
+
+
+###---------------------------------------------------------------------------
+#   One supervised child process, remembers how to build it so it can be restarted
+#
+#   args - tuple, or a function returning one, called at every (re)start so a
+#          restarted child picks up replaced locks
+#   shares_locks - whether the child takes the supervisor's shared locks
+
+class Child():
+
+    def __init__(self, name, target, args, shares_locks=False):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.shares_locks = shares_locks
+        self.proc = None
+        self.started = 0
+        self.restarts = 0
+        self.delay = RESTART_DELAY
+        self.restart_at = None
+
+    def start(self):
+        args = self.args() if callable(self.args) else self.args
+        self.proc = mp.Process(target=self.target, args=args, name=self.name)
+        self.proc.daemon = True
+        self.proc.start()
+        self.started = time.time()
+        self.restart_at = None
+
+    def alive(self):
+        return self.proc is not None and self.proc.is_alive()
+
+
+###---------------------------------------------------------------------------
+#   Usage:
+#       sup = Supervisor(stop)
+#       sup.add('worker 0', proc_video, (...))
+#       sup.start()
+#       sup.run()       #returns once stop is set
+#
+#   locks - function returning the locks and conditions children share
+#   reset - function that replaces them with new ones, for children to get through their args
+
+class Supervisor():
+
+    def __init__(self, stop, locks=None, reset=None):
+        self.stop = stop
+        self.locks = locks
+        self.reset = reset
+        self.children = []
+        
+        #mp.Event has no waitable handle, so a helper thread waits on it and sends
+        #down a pipe whose other end can be passed to connection.wait with the sentinels
+        self.stop_reader, stop_writer = mp.Pipe(duplex=False)
+        def watch():
+            self.stop.wait()
+            stop_writer.send(None)
+        threading.Thread(target=watch, daemon=True).start()
+
+    def add(self, name, target, args, shares_locks=False):
+        child = Child(name, target, args, shares_locks)
+        self.children.append(child)
+        return child
+
+    def start(self):
+        for child in self.children:
+            child.start()
+            print(child.name + ' process started')
+
+    ###-----------------------------------------------------------------------
+    #   Blocks until stop is set, restarting children as they die
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                now = time.time()
+                for child in self.children:
+                    if child.restart_at is None and not child.alive():
+                        self.schedule_restart(child, now)
+                        if child.shares_locks and self.orphaned():
+                            self.restart_sharers(child, now)
+                    if child.restart_at is not None and now >= child.restart_at:
+                        child.restarts += 1
+                        print('Restarting ' + child.name + ' (restart ' + str(child.restarts) + ')')
+                        child.start()
+
+                #sleep until a child exits, stop is set, or a restart is due
+                pending = [child.restart_at for child in self.children if child.restart_at is not None]
+                timeout = max(min(pending) - time.time(), 0) if pending else None
+                handles = [child.proc.sentinel for child in self.children if child.alive()]
+                handles.append(self.stop_reader)
+                wait(handles, timeout)
+        finally:
+            self.shutdown()
+
+    def schedule_restart(self, child, now):
+        code = child.proc.exitcode if child.proc is not None else None
+        print(child.name + ' exited with code ' + str(code))
+        if now - child.started < QUICK_CRASH:
+            child.delay = min(child.delay * 2, MAX_RESTART_DELAY)
+        else:
+            child.delay = RESTART_DELAY
+        child.restart_at = now + child.delay
+
+    ###-----------------------------------------------------------------------
+    #   Whether a shared lock is still taken after LOCK_CHECK seconds, meaning a
+    #   dead child was holding it
+    
+    def orphaned(self):
+        if self.locks is None:
+            return False
+        for lock in self.locks():
+            if not lock.acquire(timeout=LOCK_CHECK):
+                return True
+            lock.release()
+        return False
+
+    ###-----------------------------------------------------------------------
+    #   Replaces the shared locks and restarts every child using them, they may
+    #   already be stuck waiting on the old ones
+    
+    def restart_sharers(self, dead, now):
+        print(dead.name + ' died holding a shared lock, restarting everything that shares it')
+        self.reset()
+        for child in self.children:
+            if not child.shares_locks or child is dead:
+                continue
+            if child.alive():
+                child.proc.terminate()
+                child.proc.join()
+            child.restart_at = now + RESTART_DELAY
+
+    ###-----------------------------------------------------------------------
+    #   Sets stop, gives children a chance to exit cleanly then terminates the rest
+
+    def shutdown(self):
+        self.stop.set()
+        deadline = time.time() + JOIN_TIMEOUT
+        for child in self.children:
+            if child.proc is not None:
+                child.proc.join(max(deadline - time.time(), 0))
+        for child in self.children:
+            if child.alive():
+                child.proc.terminate()
+                child.proc.join()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled inference for high resolution wide angle cameras.
+
+Squashing a 2592x1944 frame down to the model input leaves distant people a
+few pixels tall. Instead, the frame is cropped to the calibrated ground region
+(the roi vid_calibrate saves with each camera) and that crop is split into
+overlapping tiles, each scaled down far less than the whole frame would be.
+Every tile goes through the model as its own image in the batch, then the
+boxes are shifted back into frame coordinates and merged across the seams.
+
+Set per camera in the transforms csv: roi=[[x, y], ...] crops to the region,
+tile=True also splits it into tiles, tile_px=<n> sets the tile side in frame
+pixels and overlap=<fraction> how much neighbouring tiles share.
+
+@author: Nikki
+"""
+
+import numpy as np
+from core import utils
+import detector
+
+#tile side in frame pixels for each model input pixel, 2 halves the resolution instead of
+#squashing the whole frame
+TILE_SCALE = 2.0
+#fraction of a tile shared with its neighbours, anyone smaller than this fits whole in one tile
+OVERLAP = 0.2
+#fraction of the roi's height added above it, the roi is where feet are so heads stick out the top
+ROI_MARGIN = 0.15
+#also run the whole roi as one extra image, for people too large to fit in a tile
+GLOBAL_VIEW = True
+#same threshold the per frame nms uses
+MERGE_IOU = 0.213
+#pixels from a tile edge a box counts as cut off by it
+SEAM = 2
+#fraction of a cut off box inside an uncut one for it to count as the same person
+CONTAIN = 0.7
+
+
+###---------------------------------------------------------------------------
+#   Crop rectangle around a region, in the pixel coords of the frames actually
+#   being read
+#
+#   points - [[x, y], ...] polygon in the coords of the calibration frame, None for the whole frame
+#   frame_size - (height, width) of the frames being read
+#   native - (height, width) the points were picked on, None if the same as frame_size
+#
+#   returns - x_min, y_min, x_max, y_max
+
+def roi_rect(points, frame_size, native=None, margin=ROI_MARGIN):
+    height, width = frame_size[:2]
+    if points is None or len(points) == 0:
+        return 0, 0, width, height
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if native is not None:
+        points = points * [width / native[1], height / native[0]]
+
+    x_min, y_min = points.min(axis=0)
+    x_max, y_max = points.max(axis=0)
+    y_min -= margin * (y_max - y_min)
+    x_min, x_max = int(max(np.floor(x_min), 0)), int(min(np.ceil(x_max), width))
+    y_min, y_max = int(max(np.floor(y_min), 0)), int(min(np.ceil(y_max), height))
+    if x_max <= x_min or y_max <= y_min:
+        raise ValueError('Region ' + str(points.tolist()) + ' is outside the ' + str(frame_size) + ' frame')
+    return x_min, y_min, x_max, y_max
+
+#evenly spaced [start, end) spans of side pixels covering start to end, neighbours sharing at least overlap
+def spans(start, end, side, overlap):
+    length = end - start
+    if length <= side:
+        return [(start, end)]
+    num = int(np.ceil((length - overlap) / (side - overlap)))
+    starts = np.linspace(start, end - side, num).round().astype(int)
+    return [(s, s + side) for s in starts]
+
+#largest fraction of each of boxes1 lying inside any of boxes2
+def contained(boxes1, boxes2):
+    top_left = np.maximum(boxes1[:, np.newaxis, :2], boxes2[np.newaxis, :, :2])
+    bottom_right = np.minimum(boxes1[:, np.newaxis, 2:], boxes2[np.newaxis, :, 2:])
+    inter = np.prod(np.maximum(bottom_right - top_left, 0), axis=-1)
+    area = np.prod(boxes1[:, 2:] - boxes1[:, :2], axis=-1)
+    return (inter / np.maximum(area, 1e-9)[:, np.newaxis]).max(axis=1)
+
+
+###---------------------------------------------------------------------------
+#   Where one camera's frames are cut up, built once at startup and sent to the
+#   workers
+#
+#   rect - x_min, y_min, x_max, y_max of the region to run, see roi_rect
+#   tile_px - side of a tile in frame pixels, None for the whole region in one image
+#   overlap - fraction of tile_px neighbouring tiles share
+#   global_view - also run the whole region as one image when it is split
+
+class Tiling():
+    __slots__ = ('rect', 'tiles', 'seams', 'overlap', 'num_tiles')
+
+    def __init__(self, rect, tile_px=None, overlap=OVERLAP, global_view=GLOBAL_VIEW):
+        x_min, y_min, x_max, y_max = rect
+        self.rect = tuple(rect)
+        if tile_px is None:
+            tile_px = max(x_max - x_min, y_max - y_min)
+        self.overlap = int(tile_px * overlap)
+
+        #x_min, y_min, x_max, y_max of each tile, and whether its left, top, right and
+        #bottom edges cut through the region (rather than lying on its border)
+        tiles = []
+        seams = []
+        for y0, y1 in spans(y_min, y_max, tile_px, self.overlap):
+            for x0, x1 in spans(x_min, x_max, tile_px, self.overlap):
+                tiles.append((x0, y0, x1, y1))
+                seams.append((x0 > x_min, y0 > y_min, x1 < x_max, y1 < y_max))
+        self.num_tiles = len(tiles)
+        if global_view and len(tiles) > 1:
+            tiles.append(self.rect)
+            seams.append((False, False, False, False))
+        self.tiles = np.array(tiles, dtype=int)
+        self.seams = np.array(seams, dtype=bool)
+
+    def __repr__(self):
+        return ('Tiling(' + str(self.rect) + ', ' + str(self.num_tiles) + ' tiles'
+                + (' + global' if len(self.tiles) > self.num_tiles else '') + ')')
+
+    ###-----------------------------------------------------------------------
+    #   Every image to run, tiles first then the whole region
+    #
+    #   copy - cut them from a copy of the region instead of views into frame, for
+    #          frames that can be overwritten before all the crops are read
+    
+    def crops(self, frame, copy=False):
+        x_min, y_min = 0, 0
+        if copy:
+            x_min, y_min, x_max, y_max = self.rect
+            frame = frame[y_min:y_max, x_min:x_max].copy()
+        return [frame[y0 - y_min:y1 - y_min, x0 - x_min:x1 - x_min] for x0, y0, x1, y1 in self.tiles]
+
+    ###-----------------------------------------------------------------------
+    #   Combines the boxes found in each crop into one set for the frame
+    #
+    #   Boxes cut off by a seam are dropped when someone that size fits whole in
+    #   the neighbouring tile, or when they mostly lie inside a box some other
+    #   crop (a neighbour or the global view) saw whole. Duplicates from
+    #   overlapping tiles are then removed with nms.
+    #
+    #   tile_bboxes - list of [N, 6] bbox arrays, one per crop, in that crop's own coords
+    #
+    #   returns - [K, 6] bboxes in frame coords
+
+    def merge(self, tile_bboxes):
+        merged = []
+        cuts = []
+        for tile, seam, bboxes in zip(self.tiles, self.seams, tile_bboxes):
+            bboxes = np.array(bboxes, dtype=np.float64).reshape(-1, 6)
+            if len(bboxes) == 0:
+                continue
+            x0, y0, x1, y1 = tile
+            bboxes[:, [0, 2]] += x0
+            bboxes[:, [1, 3]] += y0
+
+            cut = ((seam[0] & (bboxes[:, 0] <= x0 + SEAM)) | (seam[2] & (bboxes[:, 2] >= x1 - 1 - SEAM)),
+                   (seam[1] & (bboxes[:, 1] <= y0 + SEAM)) | (seam[3] & (bboxes[:, 3] >= y1 - 1 - SEAM)))
+            drop = ((cut[0] & (bboxes[:, 2] - bboxes[:, 0] < self.overlap))
+                    | (cut[1] & (bboxes[:, 3] - bboxes[:, 1] < self.overlap)))
+            merged.append(bboxes[~drop])
+            cuts.append((cut[0] | cut[1])[~drop])
+
+        if len(merged) == 0:
+            return np.zeros((0, 6))
+        merged = np.concatenate(merged)
+        cut = np.concatenate(cuts)
+        if cut.any() and not cut.all():
+            covered = np.zeros(len(merged), dtype=bool)
+            covered[cut] = contained(merged[cut, :4], merged[~cut, :4]) > CONTAIN
+            merged = merged[~covered]
+        if len(merged) == 0 or len(self.tiles) == 1:
+            return merged
+        return utils.nms(merged, MERGE_IOU, method='nms')
+
+    #pixels fed to the model per frame
+    def model_pixels(self, input_size):
+        return len(self.tiles) * input_size ** 2
+
+
+###---------------------------------------------------------------------------
+#   Tiling for a camera from its csv options
+#
+#   frame_size - (height, width) of the frames being read
+#   native - (height, width) the camera was calibrated at, None if the same
+#   input_size - model input size the camera runs at, sets the default tile size
+#
+#   returns - Tiling, or None to run whole frames as usual
+
+def from_options(options, frame_size, native=None, input_size=detector.INPUT_SIZE):
+    roi = options.get('roi')
+    tile = options.get('tile', False)
+    if roi is None and not tile:
+        return None
+    rect = roi_rect(roi, frame_size, native)
+    tile_px = None
+    if tile:
+        tile_px = int(options.get('tile_px', input_size * TILE_SCALE))
+    tiling = Tiling(rect, tile_px, options.get('overlap', OVERLAP), options.get('global', GLOBAL_VIEW))
+    if len(tiling.tiles) == 1 and tiling.rect == (0, 0, frame_size[1], frame_size[0]):
+        return None
+    return tiling
+
+
+###---------------------------------------------------------------------------
+#   Same as detector.batch_bboxes, but frames from tiled cameras are cut into
+#   their crops first. All the crops are run batch_size at a time, so one
+#   camera's tiles share forward passes with everyone else's frames.
+#
+#   frames - usually views into the ring buffers, which the streamers can write
+#            over while earlier chunks are running. Frames with crops past the
+#            first chunk are copied once up front so every crop is from the same frame.
+#   tilings - Tiling for each frame, None for frames run whole
+#
+#   returns - list of bbox arrays, one per frame, in that frame's own pixel coords
+
+def batch_bboxes(model, frames, tilings, batch_size, prep=None):
+    images = []
+    counts = []
+    for frame, tiling in zip(frames, tilings):
+        count = 1 if tiling is None else len(tiling.tiles)
+        #the first chunk is all letterboxed before anything runs, so only later ones need copies
+        copy = len(images) + count > batch_size
+        if tiling is None:
+            crops = [frame.copy() if copy else frame]
+        else:
+            crops = tiling.crops(frame, copy)
+        images.extend(crops)
+        counts.append(count)
+
+    found = []
+    for k in range(0, len(images), batch_size):
+        found.extend(detector.batch_bboxes(model, images[k:k + batch_size], batch_size, prep))
+
+    all_bboxes = []
+    k = 0
+    for tiling, count in zip(tilings, counts):
+        all_bboxes.append(found[k] if tiling is None else tiling.merge(found[k:k + count]))
+        k += count
+    return all_bboxes
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight per-stage latency tracing for the detection pipeline.
+
+Every process keeps its own Tracer. Stages are timed with the stage() context
+manager or the timed() decorator, and land in log-bucketed histograms keyed by
+(stage, camera), so recording is a perf_counter call and a dict lookup - cheap
+enough to leave on in production. Queue depths are sampled as gauges. Each
+process prints a p50/p95/p99 summary every REPORT_EVERY seconds, and can also
+write its recent spans out as a Chrome trace (chrome://tracing or Perfetto).
+
+@author: Nikki
+"""
+
+import os
+import json
+import math
+import time
+import functools
+import threading
+import collections
+
+#set to False to turn every stage into a no-op
+ENABLED = True
+#seconds between printed summaries, None to never print
+REPORT_EVERY = 60
+#directory chrome trace json files are written to on every report, None to skip
+TRACE_DIR = None
+#number of recent spans kept per process for the chrome trace
+TRACE_EVENTS = 20000
+
+#histogram buckets grow by 10^(1/BUCKETS_PER_DECADE), ~12% wide at 20 per decade
+BUCKETS_PER_DECADE = 20
+#smallest value given its own bucket, anything below lands in bucket 0
+MIN_VALUE = 0.001
+
+
+###---------------------------------------------------------------------------
+#   Log-bucketed histogram, constant memory no matter how many values are recorded
+
+class Histogram():
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        if value > MIN_VALUE:
+            bucket = int(math.log10(value / MIN_VALUE) * BUCKETS_PER_DECADE) + 1
+        else:
+            bucket = 0
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    ###-----------------------------------------------------------------------
+    #   returns - upper edge of the bucket holding the p-th percentile value
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        target = p / 100. * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                if bucket == 0:
+                    return MIN_VALUE
+                return min(MIN_VALUE * 10 ** (bucket / BUCKETS_PER_DECADE), self.max)
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+
+###---------------------------------------------------------------------------
+#   Context manager returned by Tracer.stage
+
+class Span():
+
+    __slots__ = ('tracer', 'name', 'cam', 'start')
+
+    def __init__(self, tracer, name, cam):
+        self.tracer = tracer
+        self.name = name
+        self.cam = cam
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.tracer.add_span(self.name, self.cam, self.start, end)
+        return False
+
+
+class NoSpan():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NO_SPAN = NoSpan()
+
+
+###---------------------------------------------------------------------------
+#   Collects stage timings, gauges and counters for one process
+
+class Tracer():
+
+    def __init__(self, name=None):
+        if name is None:
+            name = 'pid ' + str(os.getpid())
+        self.name = name
+        self.lock = threading.Lock()
+        self.stages = collections.defaultdict(Histogram)
+        self.gauges = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.events = collections.deque(maxlen=TRACE_EVENTS)
+        self.last_sample = {}
+        self.last_report = time.time()
+        #perf_counter has no fixed epoch, so chrome trace times are made relative to this
+        self.origin = time.perf_counter()
+
+    ###-----------------------------------------------------------------------
+    #   Times the enclosed block as stage name, optionally for a specific camera
+
+    def stage(self, name, cam=None):
+        if not ENABLED:
+            return NO_SPAN
+        return Span(self, name, cam)
+
+    ###-----------------------------------------------------------------------
+    #   Decorator version of stage
+
+    def timed(self, name, cam=None):
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name, cam):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_span(self, name, cam, start, end):
+        ms = (end - start) * 1000
+        with self.lock:
+            self.stages[(name, cam)].record(ms)
+            self.events.append((name, cam, start, end, threading.get_ident()))
+
+    ###-----------------------------------------------------------------------
+    #   Records a duration measured elsewhere, e.g. capture-to-output latency
+
+    def record(self, name, ms, cam=None):
+        if not ENABLED:
+            return
+        with self.lock:
+            self.stages[(name, cam)].record(ms)
+
+    def gauge(self, name, value):
+        if not ENABLED:
+            return
+        with self.lock:
+            self.gauges[name].record(value)
+
+    def count(self, name, n=1):
+        if not ENABLED:
+            return
+        with self.lock:
+            self.counters[name] += n
+
+    ###-----------------------------------------------------------------------
+    #   Records the depth of a queue, at most once every interval seconds since
+    #   qsize on a manager queue is a round trip to the manager process
+
+    def sample_queue(self, name, q, interval=1.0):
+        if not ENABLED:
+            return
+        now = time.time()
+        if now - self.last_sample.get(name, 0) < interval:
+            return
+        self.last_sample[name] = now
+        try:
+            self.gauge(name, q.qsize())
+        except NotImplementedError:
+            #qsize isn't available for mp queues on macOS
+            pass
+
+    ###-----------------------------------------------------------------------
+    #   returns - text table of every stage, gauge and counter recorded so far
+
+    def summary(self):
+        with self.lock:
+            lines = ['--- trace summary: ' + self.name + ' ---']
+            fmt = '%-28s %8d %9.2f %9.2f %9.2f %9.2f'
+            if self.stages:
+                lines.append('%-28s %8s %9s %9s %9s %9s' % ('stage (ms)', 'count', 'mean', 'p50', 'p95', 'p99'))
+            for (name, cam), hist in sorted(self.stages.items(), key=lambda x: (x[0][0], str(x[0][1]))):
+                label = name if cam is None else name + ' [cam ' + str(cam) + ']'
+                lines.append(fmt % (label, hist.count, hist.mean(), hist.percentile(50),
+                                    hist.percentile(95), hist.percentile(99)))
+            if self.gauges:
+                lines.append('%-28s %8s %9s %9s %9s %9s' % ('gauge', 'samples', 'mean', 'p50', 'p95', 'max'))
+            for name, hist in sorted(self.gauges.items()):
+                lines.append(fmt % (name, hist.count, hist.mean(), hist.percentile(50),
+                                    hist.percentile(95), hist.max))
+            for name, n in sorted(self.counters.items()):
+                lines.append('%-28s %8d' % (name, n))
+        return '\n'.join(lines)
+
+    ###-----------------------------------------------------------------------
+    #   Writes recent spans as chrome trace json
+    #
+    #   returns - path written to
+
+    def dump_chrome_trace(self, path):
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        trace = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': self.name}}]
+        for name, cam, start, end, tid in events:
+            event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6}
+            if cam is not None:
+                event['args'] = {'cam': cam}
+            trace.append(event)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        return path
+
+    ###-----------------------------------------------------------------------
+    #   Call from a process's main loop, prints a summary (and dumps a chrome trace
+    #   if TRACE_DIR is set) once every REPORT_EVERY seconds
+
+    def maybe_report(self):
+        if not ENABLED or REPORT_EVERY is None:
+            return
+        now = time.time()
+        if now - self.last_report < REPORT_EVERY:
+            return
+        self.last_report = now
+        print(self.summary())
+        if TRACE_DIR is not None:
+            label = self.name.replace(' ', '_')
+            self.dump_chrome_trace(os.path.join(TRACE_DIR, 'trace_' + label + '_' + str(os.getpid()) + '.json'))
+
+
+_tracer = None
+
+###---------------------------------------------------------------------------
+#   returns - this process's tracer, created on first use
+
+def get_tracer(name=None):
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(name)
+    elif name is not None:
+        _tracer.name = name
+    return _tracer
+
+def stage(name, cam=None):
+    return get_tracer().stage(name, cam)
+
+def timed(name, cam=None):
+    return get_tracer().timed(name, cam)
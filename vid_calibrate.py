@@ -17,7 +17,7 @@ import os.path
 
 #   Goal Input: csv file with ip address, length, width
 
-#   Output: csv file with ip + transform
+#   Output: csv file with ip + transform + roi
 def main():
 
     video_path = 'C:/Users/Nikki/Documents/work/inputs-outputs/video/AOTsample1_1.mp4'
@@ -59,6 +59,9 @@ def main():
     # real_pix = np.array2string(real_pix, separator = ',')
     pix_real = pix_real.tolist()
     real_pix = real_pix.tolist()
+    
+    #ground region people can stand in, detection only runs on this part of the frame (see tiling)
+    roi = corners if len(corners) > 0 else parallel
    
     #if file doesn't exist, create it. Otherwise, append to it
     try:
@@ -68,7 +71,7 @@ def main():
         else:
             csvfile = open(output_file, 'a+', newline = '')
         writer = csv.writer(csvfile)
-        writer.writerow([video_path, pix_real, real_pix])
+        writer.writerow([video_path, pix_real, real_pix, 'roi=' + str(roi)])
         csvfile.close()
     except:
         print("Unexpected error:", sys.exc_info())
@@ -14,11 +14,14 @@ from flask import Flask, render_template, session, request, \
 from flask_socketio import SocketIO, emit, join_room, leave_room, \
     close_room, rooms, disconnect
 import random
+import itertools
 import datetime
 import sys
+import queue
 import multiprocessing as mp
 import multiprocess_video as mv
 import analyze_data as adat
+import subscribers
 import time
 from ctypes import c_bool
 import cv2
@@ -34,6 +37,13 @@ app.config['SECRET_KEY'] = 'secret!'
 socketio = SocketIO(app, async_mode=async_mode)
 thread = None
 thread_lock = Lock()
+#connected socket clients, the pipeline only renders frames for the page while this is above 0
+clients = 0
+#size and rate frames are shown on the page at
+FEED_WIDTH = 419
+FEED_FPS = 2
+#names /vid_feed streams so each can unsubscribe when it closes
+feed_ids = itertools.count()
 
 
 def background_thread():
@@ -41,13 +51,9 @@ def background_thread():
     img = None
     while True:
         socketio.sleep(.5)
-        if not image_q.empty():
-            frame = image_q.get()
-            wdt = frame.shape[1]
-            hgt = frame.shape[0]
-            scale= 419/wdt
-            dim = (int(wdt * scale), int(hgt * scale))
-            frame = cv2.resize(frame, dim, interpolation=cv2.INTER_AREA)
+        if not web_q.empty():
+            #frames arrive already scaled to FEED_WIDTH
+            frame = web_q.get()
             
             success, img = cv2.imencode('.jpg', frame)
             img = img.tobytes()
@@ -78,10 +84,21 @@ def index():
 @socketio.on('connect', namespace='/test')
 def test_connect():
     global thread
+    global clients
     with thread_lock:
+        clients = clients + 1
+        subscribers.subscribe(subs, 'web', fps=FEED_FPS, width=FEED_WIDTH, frames=web_q)
         if thread is None:
             thread = socketio.start_background_task(background_thread)
 
+@socketio.on('disconnect', namespace='/test')
+def test_disconnect():
+    global clients
+    with thread_lock:
+        clients = max(clients - 1, 0)
+        if clients == 0:
+            subscribers.unsubscribe(subs, 'web')
+
 def tester(errs, ocpts, dists):
     count = 5
     while True:
@@ -92,21 +109,30 @@ def tester(errs, ocpts, dists):
         dists.append(count)
     
 def gen():
-    while True:
-        if not image_q.empty():
-            frame = image_q.get()
+    #full size frames at full rate for as long as the stream is open
+    name = 'vid_feed ' + str(next(feed_ids))
+    #its own queue, so several open streams don't split the frames between them
+    frames = manager.Queue(subscribers.QUEUE_SIZE)
+    subscribers.subscribe(subs, name, frames=frames)
+    try:
+        while not stop.is_set():
+            try:
+                frame = frames.get(timeout=1.0)
+            except queue.Empty:
+                continue
             success, encodeImg = cv2.imencode('.jpg', frame)
             # if improperly encoded, retry
             if not success:
                 continue
             
             yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + 
-			bytearray(encodeImg) + b'\r\n')
+                   bytearray(encodeImg) + b'\r\n')
+    finally:
+        subscribers.unsubscribe(subs, name)
     
 @app.route('/vid_feed')
 def vid_feed():
-    if not image_q.empty():
-        return Response(gen(), mimetype = 'multipart/x-mixed-replace; boundary=frame')
+    return Response(gen(), mimetype = 'multipart/x-mixed-replace; boundary=frame')
     
     
 if __name__ == '__main__':
@@ -127,9 +153,6 @@ if __name__ == '__main__':
         #should initialize cameras here instead of in mp vid
         num_cams = 2
 
-        updated = manager.Value(c_bool, False)
-        frames = manager.list([None]* num_cams)
-        times = manager.list([None]* num_cams)
         avgs = manager.list([None] * 5)
         avg_lock = manager.Lock()
         i_lock = manager.Lock()
@@ -139,6 +162,15 @@ if __name__ == '__main__':
         
         global image_q
         image_q = manager.Queue(num_cams*2)
+        #frames for the page's feed, each /vid_feed stream makes its own
+        global web_q
+        web_q = manager.Queue(subscribers.QUEUE_SIZE)
+        #set on exit so the pipeline processes shut down cleanly
+        global stop
+        stop = mp.Event()
+        #consumers of rendered frames, frames are only composed while something is subscribed
+        global subs
+        subs = manager.dict()
         
         for i in range(num_cams):
             errs.append(manager.list([None]))
@@ -150,7 +182,7 @@ if __name__ == '__main__':
         # dists = m.list([None]*buf_num)
         # proc = mp.Process(target=tester, args=(errs, ocpts, dists,))
         #might be good to make this a background task in socketio
-        proc = mp.Process(target=mv.main, args=(errs, ocpts, dists, updated, frames, times, avgs, avg_lock, i_lock, ind, out_q, bbox_q, image_q, ))
+        proc = mp.Process(target=mv.main, args=(errs, ocpts, dists, avgs, avg_lock, i_lock, ind, out_q, bbox_q, image_q, stop, subs, ))
         # thread = socketio.start_background_task(target = tester, args = (errs,))
         # proc.daemon = True
         proc.start()
@@ -164,7 +196,8 @@ if __name__ == '__main__':
         #         cv2.namedWindow("result", cv2.WINDOW_NORMAL)
         #         cv2.imshow("result", result)
         #         if cv2.waitKey(1) & 0xFF == ord('q'): break
-        proc.terminate()
+        stop.set()
+        proc.join()
         # frame = image_q.get()
         # cv2.namedWindow("result", cv2.WINDOW_NORMAL)
         # cv2.imshow("result", result)
@@ -172,6 +205,8 @@ if __name__ == '__main__':
         cv2.destroyAllWindows()
     except:
         print("Unexpected error:", sys.exc_info())
+        stop.set()
+        proc.join(10)
         proc.terminate()
         socketio.stop()
         # frame = image_q.get()
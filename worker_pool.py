@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Plans the detection worker processes. Each replica is bound to one device
+string and gets its own model and thread budget: a GPU when one is listed,
+otherwise a slice of the CPU cores. On a CPU only box this gives e.g. 4
+replicas x 4 threads instead of one replica with every core fighting over
+one session.
+
+@author: Nikki
+"""
+
+import os
+
+#threads each CPU replica runs its ops on
+THREADS_PER_REPLICA = 4
+#cores left for the streamers, post processor and everything else
+RESERVED_CORES = 2
+#threads for running independent ops side by side, yolo is mostly one long chain
+INTER_OP_THREADS = 1
+#pin each CPU replica to its own cores, where the OS allows it
+PIN_CORES = True
+
+
+###---------------------------------------------------------------------------
+#   One model replica, sent to the worker process that runs it
+#
+#   device - tf device string, '/cpu:0' or '/gpu:N'
+#   intra - threads used inside each op
+#   inter - threads used to run independent ops at once
+#   cores - CPU cores the process is pinned to, None to leave it to the OS
+
+class Replica():
+    __slots__ = ('name', 'device', 'intra', 'inter', 'cores')
+
+    def __init__(self, name, device, intra=0, inter=INTER_OP_THREADS, cores=None):
+        self.name = name
+        self.device = device
+        self.intra = intra
+        self.inter = inter
+        self.cores = cores
+
+    def __repr__(self):
+        return 'Replica(' + self.name + ', ' + self.device + ', ' + str(self.intra) + 'x' + str(self.inter) + ')'
+
+    ###-----------------------------------------------------------------------
+    #   Applies the replica's thread budget and device visibility, must run in the
+    #   worker process before it touches tensorflow
+    #
+    #   returns - device string the model should be placed on
+
+    def configure(self):
+        import tensorflow as tf
+
+        if self.cores is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.cores)
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(self.intra)
+            tf.config.threading.set_inter_op_parallelism_threads(self.inter)
+        except RuntimeError:
+            print(self.name + ': tensorflow already initialized, thread limits not applied')
+
+        if not self.device.lower().startswith('/gpu'):
+            return self.device
+        #only the replica's own gpu is visible, so it doesn't grab memory on the others
+        gpus = tf.config.list_physical_devices('GPU')
+        index = int(self.device.split(':')[-1])
+        try:
+            tf.config.set_visible_devices(gpus[index], 'GPU')
+            tf.config.experimental.set_memory_growth(gpus[index], True)
+        except RuntimeError:
+            print(self.name + ': tensorflow already initialized, all gpus stay visible')
+            return self.device
+        return '/gpu:0'
+
+
+#cores this process is allowed to run on
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+###---------------------------------------------------------------------------
+#   Works out the replicas to run
+#
+#   gpu_list - gpu numbers to put one replica each on, CPU replicas are only used
+#              when this is empty
+#   num - number of CPU replicas, None to size from the available cores
+#   threads - intra op threads per CPU replica, None for THREADS_PER_REPLICA
+#             (or all spare cores when num is given)
+#
+#   returns - list of Replicas
+
+def plan(gpu_list=[], num=None, threads=None, reserved=RESERVED_CORES):
+    cores = available_cores()
+    if len(gpu_list) > 0:
+        #gpu replicas only need a couple of threads to feed the device
+        return [Replica('gpu ' + str(g), '/gpu:' + str(g), intra=2) for g in gpu_list]
+
+    spare = max(len(cores) - reserved, 1)
+    if num is None:
+        if threads is None:
+            threads = min(THREADS_PER_REPLICA, spare)
+        num = max(spare // threads, 1)
+    elif threads is None:
+        threads = max(spare // num, 1)
+
+    #only pin when every replica gets cores of its own, taken from the end so the
+    #reserved cores are the first ones
+    pin = PIN_CORES and num * threads <= len(cores)
+    replicas = []
+    for k in range(num):
+        pinned = None
+        if pin:
+            pinned = cores[len(cores) - (k + 1) * threads:len(cores) - k * threads]
+        replicas.append(Replica('cpu ' + str(k), '/cpu:0', intra=threads, cores=pinned))
+    return replicas